@@ -2,8 +2,16 @@
 """
 Generate a report of the vLLM wheel size, including shared object breakdown by CUDA gencode
 and Python code size.
+
+With --import-audit the wheel is also installed (offline, without dependencies) into a
+temporary venv and every entry point module is imported under `python -X importtime`,
+reporting startup cost per module, the import chains that pull in heavy frameworks, and,
+with --compare, the regressions against another wheel:
+
+    python wheel_report.py vllm-new.whl --import-audit --compare vllm-old.whl
 """
 import argparse
+import configparser
 import os
 import re
 import sys
@@ -11,8 +19,17 @@ import shutil
 import subprocess
 import tempfile
 import urllib.request
+import venv
 import zipfile
 
+# Top-level packages that make an import "heavy" when reached from a CLI or server entry point
+HEAVY_MODULES = ('torch', 'transformers', 'triton', 'xformers', 'flash_attn', 'ray', 'tensorflow', 'jax',
+                 'scipy', 'pandas', 'sklearn', 'datasets', 'cv2', 'numba')
+
+# Written to stderr right before the timed import, so interpreter startup imports are left out
+IMPORT_MARKER = '-- wheel_report import --'
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
 
 def detect_gencodes(so_path):
     """
@@ -160,6 +177,295 @@ def analyze_wheel(path):
     return stats
 
 
+def entry_point_modules(path):
+    """
+    Modules to time for the wheel: the targets of its console_scripts, followed by its
+    top-level packages. Returns a list of module names without duplicates.
+    """
+    modules = []
+    with zipfile.ZipFile(path, 'r') as z:
+        names = z.namelist()
+        for name in names:
+            if name.endswith('.dist-info/entry_points.txt'):
+                parser = configparser.ConfigParser(delimiters=('=',))
+                parser.optionxform = str
+                parser.read_string(z.read(name).decode())
+                if parser.has_section('console_scripts'):
+                    for _, target in parser.items('console_scripts'):
+                        modules.append(target.split(':')[0].strip())
+        top_level = [n for n in names if n.endswith('.dist-info/top_level.txt')]
+        if top_level:
+            with z.open(top_level[0]) as f:
+                modules.extend(line.strip() for line in f.read().decode().splitlines() if line.strip())
+        else:
+            # no top_level.txt: packages are the first component of every Python file
+            for name in names:
+                if name.endswith('.py') and '/' in name and '.dist-info' not in name and '.data/' not in name:
+                    modules.append(name.split('/')[0])
+    return list(dict.fromkeys(m for m in modules if not m.startswith('_')))
+
+
+def install_wheel(path, venv_dir):
+    """
+    Install the wheel offline into a new venv and return its interpreter. Dependencies are
+    not installed; the venv sees the system site-packages so they import as they would in
+    the environment the report runs in.
+    """
+    venv.create(venv_dir, system_site_packages=True, with_pip=True)
+    python = os.path.join(venv_dir, 'bin', 'python')
+    subprocess.run([python, '-m', 'pip', 'install', '--quiet', '--no-index', '--no-deps', '--no-compile',
+                    '--disable-pip-version-check', path], check=True)
+    # byte-compile up front, so the first timed import does not pay for it
+    site = subprocess.check_output([python, '-c', 'import sysconfig; print(sysconfig.get_paths()["purelib"])'],
+                                   text=True).strip()
+    subprocess.run([python, '-m', 'compileall', '-q', site], stdout=subprocess.DEVNULL, check=False)
+    return python
+
+
+def parse_importtime(output):
+    """
+    Parse `-X importtime` output into {module: (self_us, cumulative_us)} and the import
+    graph {module: [modules it imported first]}. Children are printed before their parent,
+    one indentation level deeper; the modules imported directly sit under the key None.
+    """
+    modules = {}
+    edges = {}
+    pending = {}
+    if IMPORT_MARKER in output:
+        output = output.split(IMPORT_MARKER, 1)[1]
+    for line in output.splitlines():
+        m = IMPORTTIME_RE.match(line)
+        if not m:
+            continue
+        self_us, cumulative_us, indent, name = int(m.group(1)), int(m.group(2)), len(m.group(3)), m.group(4)
+        depth = indent // 2
+        edges[name] = pending.pop(depth + 1, [])
+        pending.setdefault(depth, []).append(name)
+        modules[name] = (self_us, cumulative_us)
+    edges[None] = pending.get(0, [])
+    return modules, edges
+
+
+def time_import(python, module, repeat=3):
+    """
+    Import `module` in fresh interpreters and keep the fastest self and cumulative time of
+    every module across runs. Returns a dict with modules, edges, total_us (including the
+    parent packages of `module`) and error.
+    """
+    env = {k: v for k, v in os.environ.items() if k not in ('PYTHONPATH', 'PYTHONSTARTUP')}
+    best = {'modules': {}, 'edges': {}, 'total_us': None, 'error': None}
+    with tempfile.TemporaryDirectory() as cwd:
+        for _ in range(repeat):
+            code = f'import sys; sys.stderr.write({IMPORT_MARKER!r} + "\\n"); import {module}'
+            proc = subprocess.run([python, '-X', 'importtime', '-c', code],
+                                  capture_output=True, text=True, cwd=cwd, env=env)
+            if proc.returncode != 0:
+                best['error'] = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'import failed'
+                return best
+            modules, edges = parse_importtime(proc.stderr)
+            for name, (self_us, cumulative_us) in modules.items():
+                prev = best['modules'].get(name)
+                best['modules'][name] = (min(self_us, prev[0]), min(cumulative_us, prev[1])) if prev else (self_us, cumulative_us)
+            best['edges'].update(edges)
+    best['total_us'] = sum(best['modules'][name][1] for name in best['edges'][None])
+    return best
+
+
+def import_chain(edges, root, target):
+    """Shortest import chain from root (None: the timed import) to target through the graph, or None."""
+    parents = {root: None}
+    queue = [root]
+    while queue:
+        node = queue.pop(0)
+        if node == target:
+            chain = []
+            while node is not None:
+                chain.append(node)
+                node = parents[node]
+            return [name for name in chain[::-1] if name is not None]
+        for child in edges.get(node, []):
+            if child not in parents:
+                parents[child] = node
+                queue.append(child)
+    return None
+
+
+def heavy_imports(result, module):
+    """Heavy top-level packages imported by `module`: [(package, cumulative_us, chain)]."""
+    found = []
+    for heavy in HEAVY_MODULES:
+        if heavy in result['modules'] and heavy != module.split('.')[0]:
+            chain = import_chain(result['edges'], None, heavy)
+            found.append((heavy, result['modules'][heavy][1], chain or [module, '...', heavy]))
+    return sorted(found, key=lambda item: -item[1])
+
+
+def audit_imports(path, modules=None, repeat=3):
+    """
+    Install the wheel into a temporary venv and time the import of every entry point module.
+    Returns {module: time_import result plus 'heavy'}.
+    """
+    modules = modules or entry_point_modules(path)
+    audit = {}
+    with tempfile.TemporaryDirectory() as venv_dir:
+        print(f"Installing {os.path.basename(path)} into a temporary venv ...", file=sys.stderr)
+        python = install_wheel(path, venv_dir)
+        for module in modules:
+            print(f"Timing import {module} ...", file=sys.stderr)
+            result = time_import(python, module, repeat)
+            result['heavy'] = heavy_imports(result, module) if result['error'] is None else []
+            audit[module] = result
+    return audit
+
+
+def slowest_modules(result, top=15):
+    """The `top` modules with the largest self time: [(name, self_us, cumulative_us)]."""
+    rows = sorted(result['modules'].items(), key=lambda kv: -kv[1][0])[:top]
+    return [(name, self_us, cumulative_us) for name, (self_us, cumulative_us) in rows]
+
+
+def import_regressions(audit, baseline, top=15):
+    """
+    Compare two audits. Returns (new heavy imports [(module, package)], the `top` modules
+    whose cumulative time grew the most [(name, before_us, after_us)]).
+    """
+    new_heavy = []
+    grown = []
+    for module, result in audit.items():
+        base = baseline.get(module)
+        if result['error'] or not base or base['error']:
+            continue
+        for heavy in sorted({h for h, _, _ in result['heavy']} - {h for h, _, _ in base['heavy']}):
+            new_heavy.append((module, heavy))
+        for name, (_, cumulative_us) in result['modules'].items():
+            before = base['modules'].get(name, (0, 0))[1]
+            if cumulative_us > before:
+                grown.append((name, before, cumulative_us))
+    # a module imported by several entry points is reported once, with its largest growth
+    largest = {}
+    for name, before, after in grown:
+        if name not in largest or after - before > largest[name][1] - largest[name][0]:
+            largest[name] = (before, after)
+    rows = sorted(((name, b, a) for name, (b, a) in largest.items()), key=lambda row: row[1] - row[2])
+    return new_heavy, rows[:top]
+
+
+def _ms(us):
+    return f"{us / 1000:.1f} ms"
+
+
+def _delta_ms(before, after):
+    delta = after - before
+    return f"{'+' if delta >= 0 else ''}{delta / 1000:.1f} ms"
+
+
+def format_import_report(audit, baseline=None, top=15):  # pragma: no cover
+    """Format the import audit (and its diff against a baseline audit) as text."""
+    lines = ["\nImport time per entry point:"]
+    w = max(len(m) for m in audit) if audit else 6
+    for module, result in audit.items():
+        if result['error']:
+            lines.append(f" {module.ljust(w)}  failed: {result['error']}")
+            continue
+        line = f" {module.ljust(w)}  {_ms(result['total_us']):>10s}"
+        base = (baseline or {}).get(module)
+        if base and base['error'] is None:
+            line += f"  (baseline {_ms(base['total_us'])}, {_delta_ms(base['total_us'], result['total_us'])})"
+        lines.append(line)
+
+    for module, result in audit.items():
+        if result['error']:
+            continue
+        lines.append(f"\nSlowest imports under {module} (self / cumulative):")
+        rows = slowest_modules(result, top)
+        width = max((len(row[0]) for row in rows), default=0)
+        for name, self_us, cumulative_us in rows:
+            lines.append(f"    {name.ljust(width)}  {_ms(self_us):>10s}  {_ms(cumulative_us):>10s}")
+        if result['heavy']:
+            lines.append(f" Heavy eager imports reachable from {module}:")
+            for heavy, cumulative_us, chain in result['heavy']:
+                lines.append(f"    {heavy} ({_ms(cumulative_us)}): {' -> '.join(chain)}")
+
+    if baseline:
+        new_heavy, rows = import_regressions(audit, baseline, top)
+        lines.append("\nImport regressions against the baseline wheel (cumulative):")
+        for module, heavy in new_heavy:
+            lines.append(f"    {module} now imports {heavy}")
+        if not new_heavy and not rows:
+            lines.append("    <none>")
+        width = max((len(row[0]) for row in rows), default=0)
+        for name, before, after in rows:
+            lines.append(f"    {name.ljust(width)}  {_ms(before):>10s} -> {_ms(after):>10s}  ({_delta_ms(before, after)})")
+    return "\n".join(lines)
+
+
+def print_import_report(audit, baseline=None, top=15):
+    try:
+        from rich.console import Console
+        from rich.table import Table
+    except ImportError:
+        print(format_import_report(audit, baseline, top))
+        return
+    console = Console()
+
+    # Summary table
+    summary = Table(title="Import Time per Entry Point")
+    summary.add_column("Module", justify="left")
+    summary.add_column("Import time", justify="right")
+    if baseline:
+        summary.add_column("Baseline", justify="right")
+        summary.add_column("Change", justify="right")
+    summary.add_column("Heavy imports", justify="left")
+    for module, result in audit.items():
+        if result['error']:
+            summary.add_row(module, "failed", *(["", ""] if baseline else []), result['error'])
+            continue
+        row = [module, _ms(result['total_us'])]
+        if baseline:
+            base = baseline.get(module)
+            if base and base['error'] is None:
+                row += [_ms(base['total_us']), _delta_ms(base['total_us'], result['total_us'])]
+            else:
+                row += ["-", "-"]
+        row.append(", ".join(h for h, _, _ in result['heavy']) or "-")
+        summary.add_row(*row)
+    console.print(summary)
+
+    # Slowest modules and heavy import chains per entry point
+    for module, result in audit.items():
+        if result['error']:
+            continue
+        slowest = Table(title=f"Slowest Imports under {module}")
+        slowest.add_column("Module", justify="left")
+        slowest.add_column("Self", justify="right")
+        slowest.add_column("Cumulative", justify="right")
+        for name, self_us, cumulative_us in slowest_modules(result, top):
+            slowest.add_row(name, _ms(self_us), _ms(cumulative_us))
+        console.print(slowest)
+        if result['heavy']:
+            chains = Table(title=f"Heavy Eager Imports from {module}")
+            chains.add_column("Package", justify="left")
+            chains.add_column("Cumulative", justify="right")
+            chains.add_column("Import chain", justify="left")
+            for heavy, cumulative_us, chain in result['heavy']:
+                chains.add_row(heavy, _ms(cumulative_us), " -> ".join(chain))
+            console.print(chains)
+
+    # Regressions against the baseline wheel
+    if baseline:
+        new_heavy, rows = import_regressions(audit, baseline, top)
+        regressions = Table(title="Import Regressions vs Baseline")
+        regressions.add_column("Module", justify="left")
+        regressions.add_column("Baseline", justify="right")
+        regressions.add_column("New", justify="right")
+        regressions.add_column("Change", justify="right")
+        for module, heavy in new_heavy:
+            regressions.add_row(f"{module} now imports {heavy}", "-", "-", "-")
+        for name, before, after in rows:
+            regressions.add_row(name, _ms(before), _ms(after), _delta_ms(before, after))
+        console.print(regressions)
+
+
 def human_readable(size):  # pragma: no cover
     """Convert a size in bytes to a human-readable string."""
     for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
@@ -367,21 +673,22 @@ def main():  # pragma: no cover
     parser.add_argument(
         'source', help='Path or URL to .whl file'
     )
+    parser.add_argument(
+        '--import-audit', action='store_true',
+        help='Install the wheel into a temporary venv and report import time of its entry points'
+    )
+    parser.add_argument(
+        '--compare', default=None,
+        help='Path or URL to a baseline .whl; the import audit is diffed against it (implies --import-audit)'
+    )
+    parser.add_argument(
+        '--modules', nargs='+', default=None,
+        help='Modules to time instead of the console_scripts and top-level packages'
+    )
+    parser.add_argument('--repeat', type=int, default=3, help='Imports per module, the fastest is kept')
+    parser.add_argument('--top', type=int, default=15, help='Rows in the slowest-module and regression lists')
     args = parser.parse_args()
-    source = args.source
-    # download if URL
-    if source.startswith(('http://', 'https://')):
-        try:
-            tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.whl')
-            print(f"Downloading {source} ...", file=sys.stderr)
-            urllib.request.urlretrieve(source, tmp.name)
-            print(f"Wheel downloaded to: {tmp.name}", file=sys.stderr)
-            wheel_path = tmp.name
-        except Exception as e:
-            print(f"Error downloading wheel: {e}", file=sys.stderr)
-            sys.exit(1)
-    else:
-        wheel_path = source
+    wheel_path = fetch_wheel(args.source)
     try:
         stats = analyze_wheel(wheel_path)
     except Exception as e:
@@ -390,6 +697,31 @@ def main():  # pragma: no cover
     # render with rich tables
     print_report(stats)
 
+    if args.import_audit or args.compare:
+        modules = args.modules or entry_point_modules(wheel_path)
+        try:
+            audit = audit_imports(wheel_path, modules, args.repeat)
+            baseline = audit_imports(fetch_wheel(args.compare), modules, args.repeat) if args.compare else None
+        except subprocess.CalledProcessError as e:
+            print(f"Error installing wheel: {e}", file=sys.stderr)
+            sys.exit(1)
+        print_import_report(audit, baseline, args.top)
+
+
+def fetch_wheel(source):  # pragma: no cover
+    """Return a local path for the wheel, downloading it first if source is a URL."""
+    if not source.startswith(('http://', 'https://')):
+        return source
+    try:
+        tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.whl')
+        print(f"Downloading {source} ...", file=sys.stderr)
+        urllib.request.urlretrieve(source, tmp.name)
+        print(f"Wheel downloaded to: {tmp.name}", file=sys.stderr)
+        return tmp.name
+    except Exception as e:
+        print(f"Error downloading wheel: {e}", file=sys.stderr)
+        sys.exit(1)
+
 
 if __name__ == '__main__':  # pragma: no cover
     main()
@@ -1,78 +1,273 @@
-# uv pip install https://github.com/flashinfer-ai/flashinfer/releases/download/v0.0.9/flashinfer-0.0.9+cu121torch2.3-cp310-cp310-linux_x86_64.whl
-import torch
-import flashinfer
-import time
+# uv pip install flashinfer-python  (only needed for the flashinfer backend)
+#
+# Attention decode sweep with pluggable backends:
+#   torch      - eager fp32 math on any device (cpu by default), no extra dependencies
+#   flashinfer - single_decode_with_kv_cache for contiguous KV, BatchDecodeWithPagedKVCacheWrapper for paged KV
+# Every point reports latency, achieved bandwidth and the error against an fp32 reference computed
+# from the unquantized inputs, so FP8 KV speedups are always shown next to their accuracy cost.
+#
+#   python benchmark_fp8.py --backends torch --sequence-lengths 128,1024 --gqa 32:8
+#   python benchmark_fp8.py --backends flashinfer,torch --device cuda:0
+import argparse
 import csv
 import itertools
+import math
+import os
+import sys
+from dataclasses import dataclass, asdict
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.microbench import benchmark
+
+# The fp32 reference copies the whole cache to the host and runs sequence by sequence on
+# the CPU, so it is skipped for points with more context tokens than this in total
+REFERENCE_MAX_TOKENS = 1 << 17
+
+DTYPES = {
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+    "fp8_e4m3": torch.float8_e4m3fn,
+    "fp8_e5m2": torch.float8_e5m2,
+}
+
+
+@dataclass
+class DecodeCase:
+    batch_size: int
+    kv_len: int
+    num_qo_heads: int
+    num_kv_heads: int
+    head_dim: int
+    page_size: int  # 0 means one contiguous K/V tensor per sequence
+    q_dtype: str
+    kv_dtype: str
+
+
+def decode_io_bytes(batch_size, kv_len, num_qo_heads, num_kv_heads, head_dim, q_bytes, kv_bytes, o_bytes=2):
+    """Bytes a decode step has to move: read q, K and V for every token in context, write o."""
+    q = batch_size * num_qo_heads * head_dim * q_bytes
+    kv = 2 * batch_size * kv_len * num_kv_heads * head_dim * kv_bytes
+    o = batch_size * num_qo_heads * head_dim * o_bytes
+    return q + kv + o
+
+
+def dtype_bytes(name):
+    return torch.empty((), dtype=DTYPES[name]).element_size()
+
+
+def make_inputs(case: DecodeCase, device, seed=0):
+    """
+    Random fp16 query and paged KV cache for `case`. Pages are handed out in shuffled order,
+    like an allocator that has been running for a while. Layout is NHD:
+    kv_cache[num_pages, 2, page_size, num_kv_heads, head_dim].
+    Everything is generated in fp16 on `device`, so no fp32 or host copy of the cache is
+    ever made; the values depend on the device type for a given seed.
+    """
+    gen = torch.Generator(device=device).manual_seed(seed)
+    page_size = case.page_size or case.kv_len
+    pages_per_seq = math.ceil(case.kv_len / page_size)
+    num_pages = case.batch_size * pages_per_seq
+    q = torch.randn((case.batch_size, case.num_qo_heads, case.head_dim), generator=gen,
+                    dtype=torch.half, device=device)
+    kv_cache = torch.randn((num_pages, 2, page_size, case.num_kv_heads, case.head_dim), generator=gen,
+                           dtype=torch.half, device=device)
+    kv_indices = torch.randperm(num_pages, generator=gen, device=device).int()
+    kv_indptr = torch.arange(0, num_pages + 1, pages_per_seq, dtype=torch.int32, device=device)
+    last_page_len = case.kv_len - (pages_per_seq - 1) * page_size
+    kv_last_page_len = torch.full((case.batch_size,), last_page_len, dtype=torch.int32, device=device)
+    return {
+        "q": q,
+        "kv_cache": kv_cache,
+        "kv_indptr": kv_indptr,
+        "kv_indices": kv_indices,
+        "kv_last_page_len": kv_last_page_len,
+    }
+
+
+def quantize_kv(kv_cache, dtype):
+    """Cast the cache to `dtype`; FP8 gets one per-tensor scale each for K and V."""
+    if not dtype.is_floating_point or torch.finfo(dtype).bits != 8:
+        return kv_cache.to(dtype), 1.0, 1.0
+    finfo = torch.finfo(dtype)
+    k_scale = kv_cache[:, 0].abs().max().float().item() / finfo.max
+    v_scale = kv_cache[:, 1].abs().max().float().item() / finfo.max
+    scales = torch.tensor([k_scale, v_scale], device=kv_cache.device).view(1, 2, 1, 1, 1)
+    quantized = torch.empty_like(kv_cache, dtype=dtype)
+    # A few pages at a time, so the fp32 intermediate stays small next to the cache
+    step = max(1, (256 << 20) // max(1, kv_cache[0].numel() * 4))
+    for start in range(0, kv_cache.shape[0], step):
+        chunk = kv_cache[start:start + step].float() / scales
+        quantized[start:start + step] = chunk.clamp(finfo.min, finfo.max).to(dtype)
+    return quantized, k_scale, v_scale
+
+
+def reference_decode(q, kv_cache, kv_indptr, kv_indices, kv_last_page_len, k_scale=1.0, v_scale=1.0):
+    """Decode attention in fp32, one sequence at a time, returns [batch, num_qo_heads, head_dim]."""
+    batch_size, num_qo_heads, head_dim = q.shape
+    num_kv_heads = kv_cache.shape[3]
+    outputs = []
+    for b in range(batch_size):
+        pages = kv_indices[kv_indptr[b]:kv_indptr[b + 1]].long()
+        kv = kv_cache[pages].float()  # [pages, 2, page_size, heads, dim]
+        kv = kv.transpose(0, 1).reshape(2, -1, num_kv_heads, head_dim)
+        kv_len = kv.shape[1] - (kv_cache.shape[2] - int(kv_last_page_len[b]))
+        k = kv[0, :kv_len] * k_scale
+        v = kv[1, :kv_len] * v_scale
+        # GQA: each KV head serves num_qo_heads // num_kv_heads query heads
+        k = k.repeat_interleave(num_qo_heads // num_kv_heads, dim=1)
+        v = v.repeat_interleave(num_qo_heads // num_kv_heads, dim=1)
+        logits = torch.einsum("hd,lhd->hl", q[b].float(), k) / math.sqrt(head_dim)
+        outputs.append(torch.einsum("hl,lhd->hd", logits.softmax(dim=-1), v))
+    return torch.stack(outputs)
+
+
+class TorchBackend:
+    """Eager fp32 decode on any device. Slow, but runs everywhere and checks the harness."""
+    name = "torch"
+
+    def __init__(self, device):
+        self.device = device
+
+    def supports(self, case):
+        return True
+
+    def prepare(self, case, inputs):
+        q = inputs["q"].to(DTYPES[case.q_dtype])
+        kv_cache, k_scale, v_scale = quantize_kv(inputs["kv_cache"], DTYPES[case.kv_dtype])
+        args = (inputs["kv_indptr"], inputs["kv_indices"], inputs["kv_last_page_len"])
+        return lambda: reference_decode(q, kv_cache, *args, k_scale=k_scale, v_scale=v_scale)
+
+
+class FlashInferBackend:
+    name = "flashinfer"
+
+    def __init__(self, device):
+        import flashinfer
+        self.flashinfer = flashinfer
+        self.device = device
+        self.workspace = torch.empty(128 * 1024 * 1024, dtype=torch.uint8, device=device)
+
+    def supports(self, case):
+        # Contiguous KV only goes through the single-request kernel
+        return case.page_size > 0 or case.batch_size == 1
+
+    def prepare(self, case, inputs):
+        q = inputs["q"].to(DTYPES[case.q_dtype])
+        kv_cache, k_scale, v_scale = quantize_kv(inputs["kv_cache"], DTYPES[case.kv_dtype])
+        if case.page_size == 0:
+            k, v = kv_cache[0, 0], kv_cache[0, 1]
+            decode = self.flashinfer.single_decode_with_kv_cache
+            return lambda: decode(q[0], k, v, k_scale=k_scale, v_scale=v_scale).unsqueeze(0)
+        wrapper = self.flashinfer.BatchDecodeWithPagedKVCacheWrapper(self.workspace, "NHD")
+        wrapper.plan(inputs["kv_indptr"], inputs["kv_indices"], inputs["kv_last_page_len"],
+                     case.num_qo_heads, case.num_kv_heads, case.head_dim, case.page_size,
+                     q_data_type=q.dtype, kv_data_type=kv_cache.dtype)
+        return lambda: wrapper.run(q, kv_cache, k_scale=k_scale, v_scale=v_scale)
+
+
+BACKENDS = {
+    "torch": TorchBackend,
+    "flashinfer": FlashInferBackend,
+}
+
+
+def time_decode(fn, device, max_time, min_sample_ms=1.0):
+    """
+    Latency of one call in microseconds. Calls are grouped so each timed sample takes at
+    least `min_sample_ms`, then the harness adds samples until the estimate is stable, so
+    short sequences get many iterations and long ones only as many as they need.
+    """
+    sync = torch.cuda.synchronize if str(device).startswith("cuda") else None
+    probe = benchmark(fn, warmup=3, min_runs=3, max_runs=3, sync=sync)
+    inner = max(1, math.ceil(min_sample_ms / max(min(probe.samples), 1e-6)))
+
+    def run():
+        for _ in range(inner):
+            fn()
+
+    result = benchmark(run, warmup=1, min_runs=5, max_time=max_time, target_rel_ci=0.02, sync=sync)
+    return result.summary()["p50"] * 1000 / inner, len(result.samples) * inner
+
+
+def benchmark_case(backend, case, max_time, reference_max_tokens=REFERENCE_MAX_TOKENS):
+    """Latency and bandwidth of one point; the error columns are NaN above `reference_max_tokens`."""
+    inputs = make_inputs(case, backend.device)
+    fn = backend.prepare(case, inputs)
+    out = fn()
+    latency, iters = time_decode(fn, backend.device, max_time)
+
+    max_abs_err = rel_l2_err = float("nan")
+    if case.batch_size * case.kv_len <= reference_max_tokens:
+        ref = reference_decode(*(inputs[k].cpu() for k in ["q", "kv_cache", "kv_indptr", "kv_indices",
+                                                           "kv_last_page_len"]))
+        err = out.float().cpu() - ref
+        max_abs_err = err.abs().max().item()
+        rel_l2_err = (err.norm() / ref.norm()).item()
+    total_bytes = decode_io_bytes(case.batch_size, case.kv_len, case.num_qo_heads, case.num_kv_heads,
+                                  case.head_dim, dtype_bytes(case.q_dtype), dtype_bytes(case.kv_dtype),
+                                  out.element_size())
+    return {
+        "backend": backend.name,
+        **asdict(case),
+        "latency": latency,  # microseconds
+        "bw_util": total_bytes / latency / 1e3,  # GB/s
+        "iterations": iters,
+        "max_abs_err": max_abs_err,
+        "rel_l2_err": rel_l2_err,
+    }
+
+
+def parse_list(s, cast=int):
+    return [cast(x) for x in s.split(",") if x]
+
+
+def main(args):
+    backends = [BACKENDS[name](args.device) for name in parse_list(args.backends, str)]
+    gqa = [tuple(int(h) for h in pair.split(":")) for pair in parse_list(args.gqa, str)]
+    dtype_pairs = [pair.split(":") for pair in parse_list(args.dtypes, str)]
+    fieldnames = ["backend"] + list(DecodeCase.__dataclass_fields__) + [
+        "latency", "bw_util", "iterations", "max_abs_err", "rel_l2_err"]
+
+    all_results = []
+    for backend in backends:
+        for (q_dtype, kv_dtype), (qo_heads, kv_heads), batch_size, page_size in itertools.product(
+                dtype_pairs, gqa, parse_list(args.batch_sizes), parse_list(args.page_sizes)):
+            print(f"Running {backend.name} q:{q_dtype} k/v:{kv_dtype} heads:{qo_heads}/{kv_heads} "
+                  f"batch:{batch_size} page_size:{page_size}")
+            for kv_len in parse_list(args.sequence_lengths):
+                case = DecodeCase(batch_size, kv_len, qo_heads, kv_heads, args.head_dim, page_size,
+                                  q_dtype, kv_dtype)
+                if not backend.supports(case):
+                    continue
+                row = benchmark_case(backend, case, args.max_time, args.reference_max_tokens)
+                print(f"  kv_len={kv_len:>6} {row['latency']:>10.2f} us {row['bw_util']:>8.1f} GB/s "
+                      f"rel_l2_err={row['rel_l2_err']:.2e}")
+                all_results.append(row)
+
+    with open(args.output, "w", newline="") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for row in all_results:
+            writer.writerow(row)
+
+    print(f"Benchmark results have been saved to '{args.output}'")
 
 
-def benchmark_flashinfer(q_dtype, kv_dtype, sequence_lengths):
-    num_iters = 10000
-    num_qo_heads = 32
-    num_kv_heads = 32
-    head_dim = 128
-
-    results = []
-
-    for kv_len in sequence_lengths:
-        q = torch.randn((num_qo_heads, head_dim), device="cuda:0").to(q_dtype)
-        k = torch.randn((kv_len, num_kv_heads, head_dim), device="cuda:0").to(kv_dtype)
-        v = torch.randn((kv_len, num_kv_heads, head_dim), device="cuda:0").to(kv_dtype)
-
-        # Warm-up
-        for _ in range(10):
-            o = flashinfer.single_decode_with_kv_cache(q, k, v)
-
-        torch.cuda.synchronize()
-        start_time = time.perf_counter()
-        for _ in range(num_iters):
-            o = flashinfer.single_decode_with_kv_cache(q, k, v)
-        torch.cuda.synchronize()
-        end_time = time.perf_counter()
-
-        latency = (end_time - start_time) / num_iters * 1e6  # Convert to microseconds
-        total_bytes = (
-            q.nelement() * q.element_size()
-            + k.nelement() * k.element_size()
-            + v.nelement() * v.element_size()
-            + o.nelement() * o.element_size()
-        )
-        bw_util = total_bytes / latency  # GB/s
-
-        results.append(
-            {
-                "sequence_length": kv_len,
-                "q_dtype": str(q_dtype),
-                "kv_dtype": str(kv_dtype),
-                "bw_util": bw_util,
-                "latency": latency,
-            }
-        )
-
-    return results
-
-
-sequence_lengths = [32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536]
-
-all_results = []
-
-# Run benchmarks for all combinations of fp16 and fp8 for q and kv, ensuring k and v have the same type
-for q_dtype, kv_dtype in [
-    [torch.float16, torch.float16],
-    [torch.float16, torch.float8_e4m3fn],
-    [torch.float8_e4m3fn, torch.float8_e4m3fn],
-]:
-    print(f"Running benchmark for q:{q_dtype}, k/v:{kv_dtype}")
-    results = benchmark_flashinfer(q_dtype, kv_dtype, sequence_lengths)
-    all_results.extend(results)
-
-# Write results to CSV
-with open("flashinfer_benchmark_results.csv", "w", newline="") as csvfile:
-    fieldnames = ["sequence_length", "q_dtype", "kv_dtype", "bw_util", "latency"]
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-    writer.writeheader()
-    for row in all_results:
-        writer.writerow(row)
-
-print("Benchmark results have been saved to 'flashinfer_benchmark_results.csv'")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Attention decode benchmark across backends and KV formats.")
+    parser.add_argument("--backends", default="flashinfer", help=f"Comma separated, from {list(BACKENDS)}")
+    parser.add_argument("--device", default="cuda:0")
+    parser.add_argument("--sequence-lengths",
+                        default="32,64,128,256,512,1024,2048,4096,8192,16384,32768,65536")
+    parser.add_argument("--batch-sizes", default="1,16")
+    parser.add_argument("--gqa", default="32:32,32:8,32:4", help="num_qo_heads:num_kv_heads pairs")
+    parser.add_argument("--head-dim", type=int, default=128)
+    parser.add_argument("--page-sizes", default="0,16", help="0 for contiguous K/V (batch size 1 only)")
+    parser.add_argument("--dtypes", default="fp16:fp16,fp16:fp8_e4m3", help="q_dtype:kv_dtype pairs")
+    parser.add_argument("--max-time", type=float, default=2.0, help="Timing budget per point in seconds")
+    parser.add_argument("--reference-max-tokens", type=int, default=REFERENCE_MAX_TOKENS,
+                        help="Skip the fp32 reference (errors reported as nan) above batch size x kv_len tokens")
+    parser.add_argument("--output", default="flashinfer_benchmark_results.csv")
+    main(parser.parse_args())
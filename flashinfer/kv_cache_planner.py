@@ -0,0 +1,305 @@
+"""
+Paged KV-cache simulator and memory planner, CPU only.
+
+Reads a model's config.json, then replays a request trace through a simulated paged KV
+allocator (per-sequence block tables, refcounted prefix blocks, preemption when out of
+blocks) once per KV dtype. For each dtype it reports how many sequences actually ran
+concurrently, how much of the allocated KV memory held no tokens, and the bytes moved
+per decode step, using `decode_io_bytes` from benchmark_fp8.py so the numbers line up
+with measured decode bandwidth.
+
+Trace is JSONL, one request per line (`arrival` is in scheduler steps, prefix fields optional):
+    {"arrival": 0, "prompt_len": 812, "output_len": 200, "prefix_id": "sys", "prefix_len": 512}
+
+    python kv_cache_planner.py meta-llama/Llama-3.1-8B-Instruct --kv-memory-gib 40 --trace trace.jsonl
+    python kv_cache_planner.py ./model_dir --kv-memory-gib 20 --num-requests 2000 --shared-prefix-len 1024
+"""
+import argparse
+import json
+import math
+import os
+import random
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from benchmark_fp8 import decode_io_bytes, dtype_bytes
+
+
+@dataclass
+class ModelShape:
+    num_layers: int
+    num_qo_heads: int
+    num_kv_heads: int
+    head_dim: int
+
+
+def load_model_shape(model: str) -> ModelShape:
+    """Attention shape from a local directory, config.json path or Hugging Face model id."""
+    if os.path.isdir(model):
+        path = os.path.join(model, "config.json")
+    elif os.path.isfile(model):
+        path = model
+    else:
+        from huggingface_hub import hf_hub_download
+        path = hf_hub_download(model, "config.json")
+    with open(path) as f:
+        config = json.load(f)
+    # Multimodal configs nest the language model config
+    config = config.get("text_config", config)
+    num_qo_heads = config["num_attention_heads"]
+    head_dim = config.get("head_dim") or config["hidden_size"] // num_qo_heads
+    return ModelShape(
+        num_layers=config["num_hidden_layers"],
+        num_qo_heads=num_qo_heads,
+        num_kv_heads=config.get("num_key_value_heads", num_qo_heads),
+        head_dim=head_dim,
+    )
+
+
+@dataclass
+class Request:
+    arrival: int
+    prompt_len: int
+    output_len: int
+    prefix_id: Optional[str] = None
+    prefix_len: int = 0
+
+
+def load_trace(path: str) -> List[Request]:
+    with open(path) as f:
+        return [Request(**json.loads(line)) for line in f if line.strip()]
+
+
+def synthetic_trace(num_requests, prompt_len, output_len, shared_prefix_len, arrival_rate, seed=0):
+    """Requests with +-50% uniform jitter on lengths, all sharing one prefix if requested."""
+    rng = random.Random(seed)
+    trace, t = [], 0.0
+    for _ in range(num_requests):
+        t += rng.expovariate(arrival_rate) if arrival_rate > 0 else 0
+        trace.append(Request(
+            arrival=int(t),
+            prompt_len=shared_prefix_len + max(1, int(prompt_len * rng.uniform(0.5, 1.5))),
+            output_len=max(1, int(output_len * rng.uniform(0.5, 1.5))),
+            prefix_id="shared" if shared_prefix_len else None,
+            prefix_len=shared_prefix_len,
+        ))
+    return trace
+
+
+@dataclass
+class Sequence:
+    request: Request
+    block_table: List[int] = field(default_factory=list)
+    num_tokens: int = 0
+    generated: int = 0
+
+
+class BlockAllocator:
+    """
+    Fixed pool of KV blocks with refcounts. Full blocks of a shared prefix are registered
+    under (prefix_id, block_idx) and reused by later sequences while any holder is alive.
+    """
+
+    def __init__(self, num_blocks: int, page_size: int):
+        self.page_size = page_size
+        self.free = deque(range(num_blocks))
+        self.refcount = [0] * num_blocks
+        self.prefix_blocks: Dict[tuple, int] = {}
+        self.block_owner: Dict[int, tuple] = {}
+
+    def num_free(self):
+        return len(self.free)
+
+    def allocate(self) -> int:
+        block = self.free.popleft()
+        self.refcount[block] = 1
+        return block
+
+    def release(self, block: int):
+        self.refcount[block] -= 1
+        if self.refcount[block] == 0:
+            key = self.block_owner.pop(block, None)
+            if key is not None:
+                del self.prefix_blocks[key]
+            self.free.append(block)
+
+    def shared_prefix_blocks(self, request: Request) -> List[int]:
+        if request.prefix_id is None:
+            return []
+        blocks = []
+        for i in range(request.prefix_len // self.page_size):
+            block = self.prefix_blocks.get((request.prefix_id, i))
+            if block is None:
+                break
+            blocks.append(block)
+        return blocks
+
+    def register_prefix(self, request: Request, block_table: List[int]):
+        if request.prefix_id is None:
+            return
+        for i in range(request.prefix_len // self.page_size):
+            key = (request.prefix_id, i)
+            if key not in self.prefix_blocks:
+                self.prefix_blocks[key] = block_table[i]
+                self.block_owner[block_table[i]] = key
+
+
+def simulate(trace: List[Request], num_blocks: int, page_size: int, shape: ModelShape,
+             kv_bytes: int, max_num_seqs: int) -> Dict[str, float]:
+    allocator = BlockAllocator(num_blocks, page_size)
+    pending = deque(sorted(trace, key=lambda r: r.arrival))
+    waiting: deque = deque()
+    running: List[Sequence] = []
+    step = 0
+    stats = {"steps": 0, "decode_steps": 0, "preemptions": 0, "max_concurrency": 0,
+             "concurrency_sum": 0, "slot_waste_sum": 0.0, "shared_blocks_sum": 0, "bytes_sum": 0,
+             "finished": 0}
+
+    def blocks_needed(num_tokens):
+        return math.ceil(num_tokens / page_size)
+
+    def free_sequence(seq):
+        for block in seq.block_table:
+            allocator.release(block)
+        seq.block_table = []
+
+    while pending or waiting or running:
+        while pending and pending[0].arrival <= step:
+            waiting.append(Sequence(pending.popleft()))
+
+        # Admit FCFS: the prompt is prefilled in the admission step, reusing cached prefix blocks
+        while waiting and len(running) < max_num_seqs:
+            seq = waiting[0]
+            total = seq.request.prompt_len + seq.request.output_len
+            if blocks_needed(total) > num_blocks:
+                # It would preempt itself forever once its own blocks fill the pool
+                raise ValueError(f"a request of {total} tokens needs {blocks_needed(total)} blocks, "
+                                 f"only {num_blocks} exist")
+            context = seq.request.prompt_len + seq.generated
+            shared = allocator.shared_prefix_blocks(seq.request)
+            needed = blocks_needed(context) - len(shared)
+            if needed > allocator.num_free():
+                if not running and not allocator.prefix_blocks:
+                    raise ValueError(f"a single request needs {blocks_needed(context)} blocks, "
+                                     f"only {num_blocks} exist")
+                break
+            waiting.popleft()
+            for block in shared:
+                allocator.refcount[block] += 1
+            seq.block_table = shared + [allocator.allocate() for _ in range(needed)]
+            seq.num_tokens = context
+            allocator.register_prefix(seq.request, seq.block_table)
+            running.append(seq)
+
+        # One decode step: every running sequence appends a token, growing by a block if needed
+        for seq in list(running):
+            if seq not in running:
+                continue
+            if seq.num_tokens % page_size == 0:
+                while allocator.num_free() == 0:
+                    # Preempt the most recently admitted sequence and recompute it later
+                    victim = running.pop()
+                    if victim is seq and not running:
+                        raise ValueError(f"a sequence of {seq.num_tokens + 1} tokens does not fit in "
+                                         f"{num_blocks} blocks on its own")
+                    free_sequence(victim)
+                    waiting.appendleft(victim)
+                    stats["preemptions"] += 1
+                    if victim is seq:
+                        break
+                if seq not in running:
+                    continue
+                seq.block_table.append(allocator.allocate())
+            seq.num_tokens += 1
+            seq.generated += 1
+
+        if running:
+            used_slots = sum(s.num_tokens for s in running)
+            unique_blocks = {b for s in running for b in s.block_table}
+            logical_blocks = sum(len(s.block_table) for s in running)
+            stats["decode_steps"] += 1
+            stats["concurrency_sum"] += len(running)
+            stats["max_concurrency"] = max(stats["max_concurrency"], len(running))
+            # Slots in allocated blocks that hold no token (the partly filled last block of each sequence)
+            stats["slot_waste_sum"] += 1 - min(1.0, used_slots / max(1, logical_blocks * page_size))
+            stats["shared_blocks_sum"] += logical_blocks - len(unique_blocks)
+            stats["bytes_sum"] += sum(
+                decode_io_bytes(1, s.num_tokens, shape.num_qo_heads, shape.num_kv_heads,
+                                shape.head_dim, 2, kv_bytes) for s in running) * shape.num_layers
+
+        for seq in [s for s in running if s.generated >= s.request.output_len]:
+            running.remove(seq)
+            free_sequence(seq)
+            stats["finished"] += 1
+        step += 1
+
+    stats["steps"] = step
+    return stats
+
+
+def kv_block_bytes(shape: ModelShape, page_size: int, kv_bytes: int) -> int:
+    """K and V for `page_size` tokens across all layers."""
+    return 2 * shape.num_layers * page_size * shape.num_kv_heads * shape.head_dim * kv_bytes
+
+
+def main(args):
+    shape = load_model_shape(args.model)
+    print(f"Model: {shape}")
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = synthetic_trace(args.num_requests, args.prompt_len, args.output_len,
+                                args.shared_prefix_len, args.arrival_rate)
+    budget = int(args.kv_memory_gib * 1024 ** 3)
+
+    rows = []
+    for kv_dtype in args.kv_dtypes.split(","):
+        kv_bytes = dtype_bytes(kv_dtype)
+        block_bytes = kv_block_bytes(shape, args.page_size, kv_bytes)
+        num_blocks = budget // block_bytes
+        stats = simulate(trace, num_blocks, args.page_size, shape, kv_bytes, args.max_num_seqs)
+        decode_steps = max(1, stats["decode_steps"])
+        bytes_per_step = stats["bytes_sum"] / decode_steps
+        rows.append({
+            "kv_dtype": kv_dtype,
+            "block_KiB": block_bytes / 1024,
+            "num_blocks": num_blocks,
+            "token_capacity": num_blocks * args.page_size,
+            "max_concurrency": stats["max_concurrency"],
+            "mean_concurrency": stats["concurrency_sum"] / decode_steps,
+            "waste_pct": 100 * stats["slot_waste_sum"] / decode_steps,
+            "shared_blocks": stats["shared_blocks_sum"] / decode_steps,
+            "preemptions": stats["preemptions"],
+            "steps": stats["steps"],
+            "GB_per_step": bytes_per_step / 1e9,
+            "est_step_ms": bytes_per_step / (args.bandwidth_gbs * 1e9) * 1e3,
+        })
+
+    headers = list(rows[0])
+    widths = [max(len(h), 10) for h in headers]
+    print(" | ".join(h.rjust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        cells = [f"{v:.2f}" if isinstance(v, float) else str(v) for v in row.values()]
+        print(" | ".join(c.rjust(w) for c, w in zip(cells, widths)))
+    print("\nwaste_pct: allocated KV slots holding no token, averaged over decode steps")
+    print("shared_blocks: block-table entries served by a shared prefix block, averaged over decode steps")
+    print(f"est_step_ms: KV + q/o bytes per decode step at {args.bandwidth_gbs} GB/s, weights not included")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a paged KV cache to plan concurrency and memory.")
+    parser.add_argument("model", help="Model id, model directory or config.json path")
+    parser.add_argument("--kv-memory-gib", type=float, required=True, help="Memory reserved for KV cache")
+    parser.add_argument("--page-size", type=int, default=16)
+    parser.add_argument("--kv-dtypes", default="fp16,fp8_e4m3")
+    parser.add_argument("--max-num-seqs", type=int, default=256, help="Scheduler cap on running sequences")
+    parser.add_argument("--bandwidth-gbs", type=float, default=3350.0,
+                        help="Memory bandwidth used for the step-time estimate (H100 SXM by default)")
+    parser.add_argument("--trace", type=str, default=None, help="JSONL request trace")
+    parser.add_argument("--num-requests", type=int, default=1000)
+    parser.add_argument("--prompt-len", type=int, default=1024)
+    parser.add_argument("--output-len", type=int, default=256)
+    parser.add_argument("--shared-prefix-len", type=int, default=0)
+    parser.add_argument("--arrival-rate", type=float, default=0.0, help="Requests per step, 0 for all at once")
+    main(parser.parse_args())
@@ -1,9 +1,16 @@
 import argparse
+import os
+import re
+import sys
 import torch
+import safetensors.torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from datasets import load_dataset
 from typing import List, Tuple, Dict
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.activation_store import ActivationStore
+
 def calculate_scale_and_zero_point(tensor: torch.Tensor, qmin=0, qmax=255) -> Tuple[float, int]:
     # Calculate scale for quantization based on tensor's min and max values.
     min_val, max_val = tensor.min().item(), tensor.max().item()
@@ -15,6 +22,9 @@ def calculate_scale_and_zero_point(tensor: torch.Tensor, qmin=0, qmax=255) -> Tu
     return scale, zero_point
 
 def analyze_activation(activation) -> Dict[str, float]:
+    # quantize_per_tensor only takes float32, and half precision statistics would be less accurate
+    activation = activation.float()
+
     # Basic statistics
     range_val = torch.max(activation).item() - torch.min(activation).item()
     mean_val = torch.mean(activation).item()
@@ -43,37 +53,182 @@ def analyze_activation(activation) -> Dict[str, float]:
     }
     return layer_statistics
 
-def get_forward_hook(layer_name):
+def activation_moments(x: torch.Tensor) -> Tuple:
+    # (min, max, sum, sum of squares, sum of abs, count) of float32 values, merged with merge_moments
+    return x.min().item(), x.max().item(), x.sum().item(), x.pow(2).sum().item(), x.abs().sum().item(), x.numel()
+
+
+def merge_moments(a: Tuple, b: Tuple) -> Tuple:
+    if a is None:
+        return b
+    return min(a[0], b[0]), max(a[1], b[1]), a[2] + b[2], a[3] + b[3], a[4] + b[4], a[5] + b[5]
+
+
+def moment_bounds(moments: Tuple) -> Tuple[float, float, float, int]:
+    # Mean, std dev and uint8 scale / zero point implied by merged moments
+    min_val, max_val, total, sq_total, _, count = moments
+    mean_val = total / count
+    std_dev = max(sq_total - count * mean_val ** 2, 0.0) ** 0.5 / max(count - 1, 1) ** 0.5
+    scale, zero_point = calculate_scale_and_zero_point(torch.tensor([min_val, max_val]))
+    return mean_val, std_dev, scale, zero_point
+
+
+def activation_errors(x: torch.Tensor, bounds: Tuple[float, float, float, int]) -> Tuple[int, float]:
+    # (outliers beyond mean ± 6 std dev, L1 quantization error) of float32 values, given moment_bounds
+    mean_val, std_dev, scale, zero_point = bounds
+    quantized = torch.quantize_per_tensor(x, scale, zero_point, torch.quint8)
+    outliers = ((x < mean_val - 6 * std_dev) | (x > mean_val + 6 * std_dev)).sum().item()
+    return outliers, (x - quantized.dequantize()).abs().sum().item()
+
+
+def merged_statistics(moments: Tuple, errors: Tuple[int, float]) -> Dict[str, float]:
+    # The statistics of analyze_activation from moments and errors accumulated over several chunks
+    mean_val, std_dev, _, _ = moment_bounds(moments)
+    l1_loss_change = errors[1] / moments[5]
+    return {
+        "range": moments[1] - moments[0],
+        "mean": mean_val,
+        "std_dev": std_dev,
+        "l1_loss_change": l1_loss_change,
+        "relative_l1_change": l1_loss_change / moments[4] if moments[4] else 0,
+        "num_outliers": errors[0],
+    }
+
+
+def update_channel_statistics(layer_name, activation, mask=None):
+    # Accumulate per-input-channel sum of squares and absmax, kept on the activation's device.
+    # Rows where mask ([tokens] bool) is False are padding and don't count
+    x = activation.reshape(-1, activation.shape[-1]).float()
+    count = x.shape[0]
+    if mask is not None:
+        # Zeroing padding rows instead of indexing them out keeps this free of host syncs
+        x = x * mask[:, None]
+        count = mask.sum()
+    sq_sum = x.pow(2).sum(dim=0)
+    absmax = x.abs().amax(dim=0)
+    if layer_name in channel_statistics:
+        stats = channel_statistics[layer_name]
+        stats["sq_sum"] += sq_sum
+        stats["absmax"] = torch.maximum(stats["absmax"], absmax)
+        stats["count"] += count
+    else:
+        channel_statistics[layer_name] = {"sq_sum": sq_sum, "absmax": absmax, "count": count}
+
+
+def padding_mask(x):
+    # [tokens] bool mask of the real (non-padding) rows of x ([..., dim]) in the current batch
+    if token_mask is None or token_mask.numel() * x.shape[-1] != x.numel():
+        return None
+    return token_mask.to(x.device).reshape(-1)
+
+
+def get_forward_hook(layer_name, collect_channel_stats=False, analyze=True, capture: ActivationStore = None):
 
     # Hook signature
     def forward_hook(module, input, _):
         # Hook to capture input activations of Linear layers.
         if isinstance(module, torch.nn.Linear):
-            input_statistics[layer_name] = analyze_activation(input[0].detach())
+            # Padding rows are left out everywhere, they would skew every statistic
+            x = input[0].detach()
+            mask = padding_mask(x)
+            if collect_channel_stats and analysis_pass != "errors":
+                update_channel_statistics(layer_name, x, mask)
+            x = x.reshape(-1, x.shape[-1])
+            if mask is not None and (analyze or capture is not None):
+                x = x[mask]
+            if analyze and analysis_pass is None:
+                input_statistics[layer_name] = analyze_activation(x)
+            elif analyze and x.numel():
+                values = x.float()
+                if analysis_pass == "moments":
+                    layer_moments[layer_name] = merge_moments(layer_moments.get(layer_name), activation_moments(values))
+                else:
+                    errors = activation_errors(values, moment_bounds(layer_moments[layer_name]))
+                    previous = layer_errors.get(layer_name, (0, 0.0))
+                    layer_errors[layer_name] = (previous[0] + errors[0], previous[1] + errors[1])
+            if capture is not None and analysis_pass != "errors":
+                capture.append(layer_name, x)
 
     return forward_hook
 
 
-def process_samples(model, tokenizer, samples: List[str]) -> Dict[str, Dict[str, float]]:
+def process_samples(model, tokenizer, samples: List[str], collect_channel_stats=False, analyze=True,
+                    batch_size: int = None, capture: ActivationStore = None,
+                    capture_layers: str = None) -> Dict[str, Dict[str, float]]:
     # Process text samples to collect input activations and layer names.
-    global input_statistics
+    # With analyze=False only the channel statistics are updated, which stay on the device
+    # and never sync with the host, so batches run back to back.
+    # With a capture store, the inputs of the Linears matching capture_layers (a regex, all
+    # by default) are appended to it, one chunk per layer and batch.
+    # With several batches, the statistics cover all of them: like analyze_stored, a first
+    # pass merges moments and range, and a second pass over the same batches counts
+    # outliers and quantization error against the merged bounds.
+    global input_statistics, channel_statistics, token_mask, analysis_pass, layer_moments, layer_errors
     input_statistics = {}
+    channel_statistics = {}
+    token_mask = None
+    layer_moments = {}
+    layer_errors = {}
 
     hooks = []
     for name, module in model.named_modules():
         if isinstance(module, torch.nn.Linear):  # Focus on Linear layers (where MatMul happens)
-            hooks.append(module.register_forward_hook(get_forward_hook(name)))
+            layer_capture = capture if capture_layers is None or re.search(capture_layers, name) else None
+            hooks.append(module.register_forward_hook(
+                get_forward_hook(name, collect_channel_stats, analyze, layer_capture)))
 
+    batch_size = batch_size or len(samples)
+    batches = [samples[start:start + batch_size] for start in range(0, len(samples), batch_size)]
+    passes = ["moments", "errors"] if analyze and len(batches) > 1 else [None]
     with torch.no_grad():
-        inputs = tokenizer(samples, return_tensors="pt", padding=True)
-        model(**inputs)
+        for analysis_pass in passes:
+            for batch in batches:
+                inputs = tokenizer(batch, return_tensors="pt", padding=True)
+                token_mask = inputs["attention_mask"].bool()
+                model(**inputs)
+                if capture is not None and analysis_pass != "errors":
+                    capture.flush()
 
     for hook in hooks:
         hook.remove()
+    for name, moments in layer_moments.items():
+        input_statistics[name] = merged_statistics(moments, layer_errors.get(name, (0, 0.0)))
 
     return input_statistics
 
 
+def calibrate_input_absmax(model, tokenizer, samples: List[str], batch_size: int = 8) -> Dict[str, torch.Tensor]:
+    """Per-tensor input absmax of every Linear over the calibration samples, keyed by module name."""
+    process_samples(model, tokenizer, samples, collect_channel_stats=True, analyze=False, batch_size=batch_size)
+    return {name: stats["absmax"].max().cpu() for name, stats in channel_statistics.items()}
+
+
+def save_channel_statistics(path: str):
+    """
+    Save per-channel input statistics of every Linear as safetensors, keyed by the
+    Linear's name: `<layer>.input_sq_mean` (E[x^2]) and `<layer>.input_absmax`.
+    """
+    tensors = {}
+    for name, stats in channel_statistics.items():
+        tensors[f"{name}.input_sq_mean"] = (stats["sq_sum"] / stats["count"]).cpu().contiguous()
+        tensors[f"{name}.input_absmax"] = stats["absmax"].cpu().contiguous()
+    safetensors.torch.save_file(tensors, path)
+    print(f"Saved per-channel activation statistics for {len(channel_statistics)} layers to {path}")
+
+
+def analyze_stored(store: ActivationStore, layer: str) -> Dict[str, float]:
+    """
+    The statistics of `analyze_activation` computed from a capture store in two streamed
+    passes (moments and range, then outliers and quantization error), without a model.
+    """
+    if store.rows(layer) == 0:
+        return dict.fromkeys(["range", "mean", "std_dev", "l1_loss_change", "relative_l1_change", "num_outliers"], 0)
+    moments = store.reduce(layer, activation_moments, merge_moments)
+    bounds = moment_bounds(moments)
+    errors = store.reduce(layer, lambda x: activation_errors(x, bounds), lambda a, b: (a[0] + b[0], a[1] + b[1]))
+    return merged_statistics(moments, errors)
+
+
 def print_dict(data: Dict[str, Dict]):
     # Print dictionary in a formatted table, sorted by value.
 
@@ -84,7 +239,6 @@ def print_dict(data: Dict[str, Dict]):
     # Find the longest layer name for proper column width setting
     longest_key = max(len(key) for key in data)
     longest_sub_key = max(len(key) for key in list(next(iter(data.values())).keys()))
-    print(longest_sub_key)
     column_widths = [longest_key] + [longest_sub_key] * (len(headers) - 1)
 
     # Create the header template and row template based on the calculated column widths
@@ -103,21 +257,47 @@ def print_dict(data: Dict[str, Dict]):
         print(row_template.format(*row_data))
 
 
-def main(model_name: str, dataset_name: str, dataset_config: str, num_samples: int):
-    # Main function: setup, process samples, analyze and print results.
-    model = AutoModelForCausalLM.from_pretrained(model_name, device_map="auto")
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    tokenizer.pad_token = tokenizer.eos_token
+def load_model(model_name: str):
+    return AutoModelForCausalLM.from_pretrained(model_name, device_map="auto")
+
 
+def load_samples(dataset_name: str, dataset_config: str, num_samples: int) -> List[str]:
     dataset = load_dataset(dataset_name, dataset_config)
     samples = []
     for idx, example in enumerate(dataset['train']):
         if idx >= num_samples:
             break
         samples.append(example['text'])
+    return samples
+
 
-    input_statistics = process_samples(model, tokenizer, samples)
+def main(model_name: str, dataset_name: str, dataset_config: str, num_samples: int, save_stats: str = None,
+         capture: str = None, capture_layers: str = None, capture_dtype: str = None, batch_size: int = None):
+    # Main function: setup, process samples, analyze and print results.
+    model = load_model(model_name)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.pad_token = tokenizer.eos_token
+
+    samples = load_samples(dataset_name, dataset_config, num_samples)
+    store = ActivationStore(capture, mode="a", dtype=capture_dtype) if capture else None
+    input_statistics = process_samples(model, tokenizer, samples, collect_channel_stats=save_stats is not None,
+                                       batch_size=batch_size, capture=store, capture_layers=capture_layers)
+    if store is not None:
+        store.close()
+        print(f"Captured {len(store.layers())} layers to {capture}")
     print_dict(input_statistics)
+    if save_stats:
+        save_channel_statistics(save_stats)
+
+
+def main_from_store(path: str, layers: str = None, num_workers: int = None):
+    # Same report as main, computed from a capture store instead of model forwards
+    store = ActivationStore(path, num_workers=num_workers)
+    selected = [layer for layer in store.layers() if layers is None or re.search(layers, layer)]
+    if not selected:
+        print(f"No layer in {path} matches {layers!r}")
+        return
+    print_dict(store.map_layers(lambda layer: analyze_stored(store, layer), selected))
 
 
 if __name__ == "__main__":
@@ -126,6 +306,21 @@ if __name__ == "__main__":
     parser.add_argument('--dataset', default="wikitext")
     parser.add_argument('--dataset_config', default="wikitext-2-raw-v1")
     parser.add_argument('--num_samples', type=int, default=10)
+    parser.add_argument('--save_stats', type=str, default=None,
+                        help='Save per-channel input statistics of every Linear to this safetensors file')
+    parser.add_argument('--capture', type=str, default=None,
+                        help='Append the inputs of the captured Linears to this activation store directory')
+    parser.add_argument('--capture_layers', type=str, default=None, help='Regex selecting the Linears to capture')
+    parser.add_argument('--capture_dtype', choices=['float32', 'bfloat16', 'float16', 'fp8'], default=None,
+                        help='Storage dtype of a new store (default bfloat16); must match when appending')
+    parser.add_argument('--batch_size', type=int, default=None)
+    parser.add_argument('--from_store', type=str, default=None,
+                        help='Analyze a capture store instead of running the model')
+    parser.add_argument('--num_workers', type=int, default=None)
     args = parser.parse_args()
 
-    main(args.model, args.dataset, args.dataset_config, args.num_samples)
+    if args.from_store:
+        main_from_store(args.from_store, args.capture_layers, args.num_workers)
+    else:
+        main(args.model, args.dataset, args.dataset_config, args.num_samples, args.save_stats,
+             args.capture, args.capture_layers, args.capture_dtype, args.batch_size)
@@ -0,0 +1,351 @@
+"""
+CPU perplexity of a safetensors checkpoint, as a quick gate before scheduling GPU lm_eval runs.
+
+  - tokens come from a fixed set (wikitext-2 test by default) tokenized once and cached,
+    so every checkpoint of a model family is scored on exactly the same chunks
+  - the model runs layer by layer: a layer's weights are read from the mmapped shards,
+    dequantized to the compute dtype (FP8 with weight_scale, GPTQ / AWQ qweight/qzeros/scales,
+    compressed-tensors weight_packed, see utils/int_pack.py), applied to all chunks, and dropped again, so
+    memory is one layer plus the hidden states of the chunks
+  - chunks are split across worker processes, each running the whole stack on its share
+
+Supports the llama, mistral, qwen2, qwen3 and granite architectures.
+
+    python cpu_perplexity.py /path/to/model-FP8 --num-chunks 32 --seq-len 512 --workers 4
+    python cpu_perplexity.py /path/to/model-FP8 --baseline-ppl 6.1 --max-ratio 1.05  # exit 1 if worse
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from safetensors.torch import load_file, save_file
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.int_pack import load_linear, quantization_format
+from utils.safetensors_reader import SafetensorsCheckpoint
+
+SUPPORTED_MODEL_TYPES = {"llama", "mistral", "qwen2", "qwen3", "granite"}
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cpu_perplexity")
+
+
+def load_config(model_dir: str) -> Dict:
+    with open(os.path.join(model_dir, "config.json")) as f:
+        config = json.load(f)
+    config = {**config, **config.get("text_config", {})}
+    if config.get("model_type") not in SUPPORTED_MODEL_TYPES:
+        raise ValueError(f"model_type {config.get('model_type')!r} is not supported, "
+                         f"expected one of {sorted(SUPPORTED_MODEL_TYPES)}")
+    config.setdefault("num_key_value_heads", config["num_attention_heads"])
+    if not config.get("head_dim"):
+        config["head_dim"] = config["hidden_size"] // config["num_attention_heads"]
+    return config
+
+
+# Token set
+
+
+def tokenizer_fingerprint(model_dir: str) -> str:
+    """Hash of the tokenizer files, so quantized variants of one model share a token cache."""
+    h = hashlib.sha256()
+    for filename in ("tokenizer.json", "tokenizer.model", "tokenizer_config.json"):
+        path = os.path.join(model_dir, filename)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def tokenize_dataset(model_dir: str, dataset: str, dataset_config: str, split: str) -> torch.Tensor:
+    from datasets import load_dataset
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    text = "\n\n".join(load_dataset(dataset, dataset_config, split=split)["text"])
+    return torch.tensor(tokenizer(text, add_special_tokens=False)["input_ids"], dtype=torch.int64)
+
+
+def load_token_chunks(model_dir: str, seq_len: int, num_chunks: int, dataset: str, dataset_config: str,
+                      split: str, cache_dir: str = DEFAULT_CACHE_DIR) -> torch.Tensor:
+    """[num_chunks, seq_len] token ids, read from the cache or tokenized and cached once."""
+    key = hashlib.sha256(f"{tokenizer_fingerprint(model_dir)}|{dataset}|{dataset_config}|{split}".encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f"{dataset.replace('/', '__')}-{key}.safetensors")
+    if os.path.exists(path):
+        tokens = load_file(path)["input_ids"]
+    else:
+        tokens = tokenize_dataset(model_dir, dataset, dataset_config, split)
+        os.makedirs(cache_dir, exist_ok=True)
+        save_file({"input_ids": tokens}, path)
+        print(f"Cached {len(tokens)} tokens to {path}")
+    available = len(tokens) // seq_len
+    if available < num_chunks:
+        print(f"Only {available} chunks of {seq_len} tokens available, using all of them")
+    num_chunks = min(num_chunks, available)
+    return tokens[:num_chunks * seq_len].view(num_chunks, seq_len)
+
+
+# Weight loading with on-the-fly dequantization
+
+
+def expand_scale(scale: torch.Tensor, out_features: int, in_features: int) -> torch.Tensor:
+    """Broadcast per-tensor, per-channel, per-group or block scales to the weight shape."""
+    scale = scale.float()
+    if scale.dim() == 0 or scale.numel() == 1:
+        return scale.reshape(())
+    if scale.dim() == 1:
+        scale = scale.view(-1, 1)
+    rows = scale.shape[0]
+    if rows != out_features:
+        scale = scale.repeat_interleave(math.ceil(out_features / rows), dim=0)[:out_features]
+    cols = scale.shape[1]
+    if cols not in (1, in_features):
+        scale = scale.repeat_interleave(math.ceil(in_features / cols), dim=1)[:, :in_features]
+    return scale
+
+
+class WeightLoader:
+    """Reads Linear weights of one checkpoint and returns them dense in the compute dtype."""
+
+    def __init__(self, model_dir: str, config: Dict, dtype: torch.dtype):
+        self.checkpoint = SafetensorsCheckpoint(model_dir)
+        self.dtype = dtype
+        self.quant_format = quantization_format(config)
+
+    def has(self, name: str) -> bool:
+        return name in self.checkpoint
+
+    def tensor(self, name: str) -> torch.Tensor:
+        return self.checkpoint.get_tensor(name, dtype=self.dtype)
+
+    def linear(self, module: str) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        ckpt = self.checkpoint
+        if f"{module}.weight" in ckpt:
+            weight = ckpt.get_tensor(f"{module}.weight")
+            if weight.dtype in (torch.float8_e4m3fn, torch.float8_e5m2):
+                scale_name = next((f"{module}.{s}" for s in ("weight_scale", "weight_scale_inv") if f"{module}.{s}" in ckpt), None)
+                if scale_name is None:
+                    raise ValueError(f"{module}.weight is FP8 but has no weight_scale")
+                scale = expand_scale(ckpt.get_tensor(scale_name), *weight.shape)
+                weight = (weight.float() * scale).to(self.dtype)
+            else:
+                weight = weight.to(self.dtype)
+        elif f"{module}.qweight" in ckpt or f"{module}.weight_packed" in ckpt:
+            # GPTQ, AWQ and compressed-tensors int4/int8 layouts
+            weight = load_linear(ckpt, module, self.quant_format).dequantize(self.dtype)
+        else:
+            raise KeyError(f"No weight for {module} in {self.checkpoint.path}")
+        bias = self.tensor(f"{module}.bias") if f"{module}.bias" in ckpt else None
+        return weight, bias
+
+
+# Forward pass
+
+
+def rms_norm(x: torch.Tensor, weight: torch.Tensor, eps: float) -> torch.Tensor:
+    variance = x.float().pow(2).mean(-1, keepdim=True)
+    return (x.float() * torch.rsqrt(variance + eps)).to(x.dtype) * weight
+
+
+def rope_frequencies(config: Dict) -> torch.Tensor:
+    head_dim = config["head_dim"]
+    base = config.get("rope_theta", 10000.0)
+    inv_freq = 1.0 / (base ** (torch.arange(0, head_dim, 2, dtype=torch.float64) / head_dim))
+    scaling = config.get("rope_scaling") or {}
+    rope_type = scaling.get("rope_type", scaling.get("type"))
+    if rope_type == "linear":
+        inv_freq = inv_freq / scaling["factor"]
+    elif rope_type == "llama3":
+        factor = scaling["factor"]
+        low, high = scaling["low_freq_factor"], scaling["high_freq_factor"]
+        original = scaling["original_max_position_embeddings"]
+        wavelen = 2 * math.pi / inv_freq
+        smooth = (original / wavelen - low) / (high - low)
+        scaled = torch.where(wavelen > original / low, inv_freq / factor, inv_freq)
+        mid = (wavelen <= original / low) & (wavelen >= original / high)
+        inv_freq = torch.where(mid, (1 - smooth) * inv_freq / factor + smooth * inv_freq, scaled)
+    elif rope_type not in (None, "default"):
+        raise ValueError(f"rope_scaling type {rope_type!r} is not supported")
+    return inv_freq
+
+
+def rope_cos_sin(config: Dict, seq_len: int, dtype: torch.dtype) -> Tuple[torch.Tensor, torch.Tensor]:
+    freqs = torch.outer(torch.arange(seq_len, dtype=torch.float64), rope_frequencies(config))
+    emb = torch.cat([freqs, freqs], dim=-1)
+    return emb.cos().to(dtype), emb.sin().to(dtype)
+
+
+def apply_rope(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor) -> torch.Tensor:
+    half = x.shape[-1] // 2
+    rotated = torch.cat([-x[..., half:], x[..., :half]], dim=-1)
+    return x * cos + rotated * sin
+
+
+def decoder_layer(x: torch.Tensor, w: Dict[str, torch.Tensor], config: Dict, cos, sin) -> torch.Tensor:
+    """One pre-norm decoder layer on x [batch, seq, hidden]."""
+    batch, seq, _ = x.shape
+    heads, kv_heads, head_dim = config["num_attention_heads"], config["num_key_value_heads"], config["head_dim"]
+    eps = config.get("rms_norm_eps", 1e-6)
+    residual_multiplier = config.get("residual_multiplier", 1.0)
+
+    def linear(h, name):
+        return F.linear(h, w[name + ".weight"], w.get(name + ".bias"))
+
+    h = rms_norm(x, w["input_layernorm.weight"], eps)
+    q = linear(h, "self_attn.q_proj").view(batch, seq, heads, head_dim).transpose(1, 2)
+    k = linear(h, "self_attn.k_proj").view(batch, seq, kv_heads, head_dim).transpose(1, 2)
+    v = linear(h, "self_attn.v_proj").view(batch, seq, kv_heads, head_dim).transpose(1, 2)
+    if "self_attn.q_norm.weight" in w:
+        q = rms_norm(q, w["self_attn.q_norm.weight"], eps)
+        k = rms_norm(k, w["self_attn.k_norm.weight"], eps)
+    q, k = apply_rope(q, cos, sin), apply_rope(k, cos, sin)
+    k = k.repeat_interleave(heads // kv_heads, dim=1)
+    v = v.repeat_interleave(heads // kv_heads, dim=1)
+    attn = F.scaled_dot_product_attention(q, k, v, is_causal=True, scale=config.get("attention_multiplier"))
+    attn = attn.transpose(1, 2).reshape(batch, seq, heads * head_dim)
+    x = x + linear(attn, "self_attn.o_proj") * residual_multiplier
+
+    h = rms_norm(x, w["post_attention_layernorm.weight"], eps)
+    h = F.silu(linear(h, "mlp.gate_proj")) * linear(h, "mlp.up_proj")
+    return x + linear(h, "mlp.down_proj") * residual_multiplier
+
+
+LINEARS = ["self_attn.q_proj", "self_attn.k_proj", "self_attn.v_proj", "self_attn.o_proj",
+           "mlp.gate_proj", "mlp.up_proj", "mlp.down_proj"]
+NORMS = ["input_layernorm", "post_attention_layernorm", "self_attn.q_norm", "self_attn.k_norm"]
+
+
+def load_layer(loader: WeightLoader, layer: int) -> Dict[str, torch.Tensor]:
+    prefix = f"model.layers.{layer}."
+    weights = {}
+    for name in LINEARS:
+        weight, bias = loader.linear(prefix + name)
+        weights[name + ".weight"] = weight
+        if bias is not None:
+            weights[name + ".bias"] = bias
+    for name in NORMS:
+        if loader.has(f"{prefix}{name}.weight"):
+            weights[name + ".weight"] = loader.tensor(f"{prefix}{name}.weight")
+    return weights
+
+
+def final_hidden(loader: WeightLoader, config: Dict, batches: List[torch.Tensor]) -> Tuple[List[torch.Tensor], torch.Tensor]:
+    """Final-norm hidden states of every batch of token ids, and the lm_head weight."""
+    embed = loader.tensor("model.embed_tokens.weight")
+    hidden = [embed[ids] * config.get("embedding_multiplier", 1.0) for ids in batches]
+    del embed
+    cos, sin = rope_cos_sin(config, batches[0].shape[1], loader.dtype)
+    for layer in range(config["num_hidden_layers"]):
+        weights = load_layer(loader, layer)
+        hidden = [decoder_layer(x, weights, config, cos, sin) for x in hidden]
+        del weights
+
+    norm = loader.tensor("model.norm.weight")
+    hidden = [rms_norm(x, norm, config.get("rms_norm_eps", 1e-6)) for x in hidden]
+    if any(loader.has(f"lm_head.{name}") for name in ("weight", "qweight", "weight_packed")):
+        lm_head = loader.linear("lm_head")[0]
+    else:
+        lm_head = loader.tensor("model.embed_tokens.weight")
+    return hidden, lm_head
+
+
+def chunk_logits(model_dir: str, chunks: torch.Tensor, dtype: str = "float32") -> torch.Tensor:
+    """[num_chunks, seq_len, vocab] float32 logits; meant for a few short chunks."""
+    config = load_config(model_dir)
+    loader = WeightLoader(model_dir, config, getattr(torch, dtype))
+    with torch.no_grad():
+        hidden, lm_head = final_hidden(loader, config, [chunks])
+        logits = F.linear(hidden[0], lm_head).float() / config.get("logits_scaling", 1.0)
+    loader.checkpoint.close()
+    return logits
+
+
+def chunk_nll(job) -> Tuple[float, int]:
+    """Worker: summed next-token NLL and token count over a set of chunks."""
+    model_dir, chunks, dtype_name, threads, batch_size = job
+    torch.set_num_threads(threads)
+    dtype = getattr(torch, dtype_name)
+    config = load_config(model_dir)
+    loader = WeightLoader(model_dir, config, dtype)
+    batches = chunks.split(batch_size)
+
+    with torch.no_grad():
+        hidden, lm_head = final_hidden(loader, config, batches)
+        nll, count = 0.0, 0
+        for x, ids in zip(hidden, batches):
+            x = x[:, :-1].reshape(-1, x.shape[-1])
+            targets = ids[:, 1:].reshape(-1)
+            # Vocab-sized logits in row blocks to bound memory
+            for start in range(0, x.shape[0], 1024):
+                logits = F.linear(x[start:start + 1024], lm_head).float() / config.get("logits_scaling", 1.0)
+                nll += F.cross_entropy(logits, targets[start:start + 1024], reduction="sum").item()
+            count += targets.numel()
+    loader.checkpoint.close()
+    return nll, count
+
+
+def perplexity(model_dir: str, chunks: torch.Tensor, workers: int = 1, dtype: str = "float32",
+               batch_size: int = 4) -> float:
+    workers = max(1, min(workers, len(chunks)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    jobs = [(model_dir, part, dtype, threads, batch_size) for part in chunks.tensor_split(workers)]
+    if workers == 1:
+        results = [chunk_nll(jobs[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(chunk_nll, jobs))
+    nll = sum(r[0] for r in results)
+    count = sum(r[1] for r in results)
+    return math.exp(nll / count)
+
+
+def main(args):
+    if args.tokens:
+        tokens = load_file(args.tokens)["input_ids"].reshape(-1)
+        chunks = tokens[:len(tokens) // args.seq_len * args.seq_len].view(-1, args.seq_len)[:args.num_chunks]
+    else:
+        chunks = load_token_chunks(args.model_dir, args.seq_len, args.num_chunks, args.dataset,
+                                   args.dataset_config, args.split, args.cache_dir)
+
+    start = time.perf_counter()
+    ppl = perplexity(args.model_dir, chunks, args.workers, args.dtype, args.batch_size)
+    elapsed = time.perf_counter() - start
+    print(f"{args.model_dir}: perplexity {ppl:.4f} over {chunks.numel()} tokens "
+          f"({len(chunks)} x {chunks.shape[1]}) in {elapsed:.1f}s")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"model": args.model_dir, "perplexity": ppl, "num_chunks": len(chunks),
+                       "seq_len": chunks.shape[1], "dataset": args.tokens or args.dataset, "seconds": elapsed}, f, indent=2)
+    if args.max_ppl is not None and ppl > args.max_ppl:
+        sys.exit(f"FAIL: perplexity {ppl:.4f} above {args.max_ppl}")
+    if args.baseline_ppl is not None and ppl > args.baseline_ppl * args.max_ratio:
+        sys.exit(f"FAIL: perplexity {ppl:.4f} is more than {args.max_ratio}x the baseline {args.baseline_ppl}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Layer-by-layer CPU perplexity of a (quantized) safetensors checkpoint.")
+    parser.add_argument("model_dir", type=str)
+    parser.add_argument("--seq-len", type=int, default=512)
+    parser.add_argument("--num-chunks", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 8))
+    parser.add_argument("--batch-size", type=int, default=4, help="Chunks per forward inside a worker")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--dataset", default="wikitext")
+    parser.add_argument("--dataset-config", default="wikitext-2-raw-v1")
+    parser.add_argument("--split", default="test")
+    parser.add_argument("--tokens", type=str, default=None,
+                        help="Pre-tokenized safetensors file with an input_ids tensor instead of the dataset")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--output", type=str, default=None, help="Write the result as JSON")
+    parser.add_argument("--max-ppl", type=float, default=None, help="Exit 1 if the perplexity is above this")
+    parser.add_argument("--baseline-ppl", type=float, default=None, help="Perplexity of the unquantized model")
+    parser.add_argument("--max-ratio", type=float, default=1.05,
+                        help="With --baseline-ppl, exit 1 if the perplexity is more than this times the baseline")
+    main(parser.parse_args())
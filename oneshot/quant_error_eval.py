@@ -0,0 +1,189 @@
+"""
+Compare FP8 weight quantization schemes per layer on CPU, without running the model.
+
+Streams Linear weights from a safetensors checkpoint and, for every candidate scheme,
+quantizes, dequantizes and measures the error against the original weight:
+  per_tensor       one scale per tensor (same as safetensor_autofp8_quantize.py)
+  per_channel      one scale per output row
+  block            one scale per 128x128 tile
+  rht_per_tensor   randomized Hadamard rotation of the input dim, then per_tensor
+  rht_per_channel  randomized Hadamard rotation of the input dim, then per_channel
+Rotated schemes are rotated back before measuring, so all errors are in the original
+weight space. With `--act-stats` (from `analyze_activations.py --save_stats`) errors are
+also weighted by E[x^2] per input channel, i.e. they estimate the error of W x rather
+than of W. Layers are spread over a process pool; each worker reads its own tensors.
+
+    python quant_error_eval.py /path/to/model --act-stats stats.safetensors --workers 8
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import torch
+from safetensors import safe_open
+
+from safetensor_autofp8_quantize import per_tensor_quantize
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rht import hadamard_transform, inverse_hadamard_transform, random_signs
+from utils.safetensors_reader import SafetensorsCheckpoint
+
+FP8 = torch.float8_e4m3fn
+FP8_MAX = torch.finfo(FP8).max
+SCHEMES = ["per_tensor", "per_channel", "block", "rht_per_tensor", "rht_per_channel"]
+
+
+def fake_quant_per_tensor(w: torch.Tensor) -> torch.Tensor:
+    qweight, scale = per_tensor_quantize(w)
+    return qweight.float() * scale
+
+
+def fake_quant_per_channel(w: torch.Tensor) -> torch.Tensor:
+    scale = w.abs().amax(dim=1, keepdim=True).clamp(min=1e-12) / FP8_MAX
+    return (w / scale).clamp(-FP8_MAX, FP8_MAX).to(FP8).float() * scale
+
+
+def fake_quant_block(w: torch.Tensor, block: int = 128) -> torch.Tensor:
+    rows, cols = w.shape
+    pad_r, pad_c = -rows % block, -cols % block
+    padded = torch.nn.functional.pad(w, (0, pad_c, 0, pad_r))
+    tiles = padded.view(padded.shape[0] // block, block, padded.shape[1] // block, block)
+    scale = tiles.abs().amax(dim=(1, 3), keepdim=True).clamp(min=1e-12) / FP8_MAX
+    deq = (tiles / scale).clamp(-FP8_MAX, FP8_MAX).to(FP8).float() * scale
+    return deq.view_as(padded)[:rows, :cols]
+
+
+def fake_quant(w: torch.Tensor, scheme: str, signs: torch.Tensor) -> torch.Tensor:
+    if scheme == "per_tensor":
+        return fake_quant_per_tensor(w)
+    if scheme == "per_channel":
+        return fake_quant_per_channel(w)
+    if scheme == "block":
+        return fake_quant_block(w)
+    if scheme.startswith("rht_"):
+        # Quantize W Q^T, then map back with Q so the error is comparable with the other schemes
+        rotated = hadamard_transform(w, signs)
+        deq = fake_quant(rotated, scheme[len("rht_"):], signs)
+        return inverse_hadamard_transform(deq, signs)
+    raise ValueError(f"Unknown scheme {scheme}")
+
+
+def error_metrics(w: torch.Tensor, deq: torch.Tensor, act_sq: Optional[torch.Tensor]) -> Dict[str, float]:
+    err = deq - w
+    sq_err = err.pow(2)
+    metrics = {
+        "mse": sq_err.mean().item(),
+        "sqnr_db": 10 * math.log10(w.pow(2).sum().item() / max(sq_err.sum().item(), 1e-30)),
+        "max_err": err.abs().max().item(),
+    }
+    if act_sq is not None:
+        # E||(W - W_q) x||^2 under a diagonal input covariance
+        weighted_err = (sq_err * act_sq).sum().item()
+        weighted_sig = (w.pow(2) * act_sq).sum().item()
+        metrics["weighted_mse"] = weighted_err / w.shape[0]
+        metrics["weighted_sqnr_db"] = 10 * math.log10(weighted_sig / max(weighted_err, 1e-30))
+    return metrics
+
+
+def evaluate_layers(job) -> List[Dict]:
+    """Worker: evaluate all schemes for a batch of tensors from one shard."""
+    shard_path, names, schemes, act_stats_path, seed, threads = job
+    torch.set_num_threads(threads)
+    act_stats = safe_open(act_stats_path, framework="pt") if act_stats_path else None
+    act_keys = set(act_stats.keys()) if act_stats else set()
+    rows = []
+    with SafetensorsCheckpoint(shard_path) as checkpoint:
+        for name, w in checkpoint.iter_tensors(names=names, dtype=torch.float32):
+            signs = random_signs(w.shape[1], seed)
+            key = f"{name[:-len('.weight')]}.input_sq_mean"
+            act_sq = act_stats.get_tensor(key).float() if key in act_keys else None
+            for scheme in schemes:
+                metrics = error_metrics(w, fake_quant(w, scheme, signs), act_sq)
+                rows.append({"layer": name, "scheme": scheme, "shape": list(w.shape), **metrics})
+    return rows
+
+
+def list_weights(model_dir: str, pattern: str) -> Dict[str, List[str]]:
+    """Shard path -> matching 2D weight names, in on-disk order."""
+    regex = re.compile(pattern)
+    shards = {}
+    with SafetensorsCheckpoint(model_dir) as checkpoint:
+        for info in checkpoint.infos():
+            if regex.search(info.name) and len(info.shape) == 2:
+                shards.setdefault(info.shard, []).append(info.name)
+    return shards
+
+
+def summarize(rows: List[Dict], schemes: List[str]):
+    # Only rank by the activation-weighted metric when every layer has statistics
+    metric = "weighted_sqnr_db" if all("weighted_sqnr_db" in r for r in rows) else "sqnr_db"
+    by_layer = {}
+    for row in rows:
+        by_layer.setdefault(row["layer"], {})[row["scheme"]] = row
+
+    width = max(len(name) for name in by_layer)
+    print(f"{'Layer':<{width}} | " + " | ".join(f"{s:>15}" for s in schemes) + f" | best ({metric})")
+    wins = {s: 0 for s in schemes}
+    for name, results in by_layer.items():
+        best = max(schemes, key=lambda s: results[s][metric])
+        wins[best] += 1
+        print(f"{name:<{width}} | " + " | ".join(f"{results[s][metric]:>15.2f}" for s in schemes) + f" | {best}")
+
+    print(f"\nMean {metric} and layers won per scheme:")
+    for s in schemes:
+        mean = sum(r[s][metric] for r in by_layer.values()) / len(by_layer)
+        worst = min(r[s][metric] for r in by_layer.values())
+        print(f"{s:>16}: mean {mean:6.2f} dB, worst {worst:6.2f} dB, best on {wins[s]} layers")
+
+
+def main(args):
+    schemes = args.schemes.split(",")
+    shards = list_weights(args.model_dir, args.pattern)
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+    jobs = []
+    for shard_path, names in shards.items():
+        for start in range(0, len(names), args.layers_per_job):
+            jobs.append((shard_path, names[start:start + args.layers_per_job], schemes,
+                         args.act_stats, args.seed, threads))
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for i, result in enumerate(pool.map(evaluate_layers, jobs)):
+            rows.extend(result)
+            print(f"[{i + 1}/{len(jobs)}] {result[0]['layer'] if result else ''}", file=sys.stderr)
+    if not rows:
+        print(f"No tensors matching {args.pattern!r} found")
+        return
+
+    summarize(rows, schemes)
+    if args.output:
+        if args.output.endswith(".json"):
+            with open(args.output, "w") as f:
+                json.dump(rows, f, indent=2)
+        else:
+            with open(args.output, "w", newline="") as f:
+                fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(rows)
+        print(f"Per-layer results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-layer FP8 quantization error for several schemes, on CPU.")
+    parser.add_argument("model_dir", type=str, help="Directory with the safetensors checkpoint")
+    parser.add_argument("--schemes", default=",".join(SCHEMES))
+    parser.add_argument("--pattern", default=r"_proj\.weight$", help="Regex selecting weights to evaluate")
+    parser.add_argument("--act-stats", type=str, default=None,
+                        help="Per-channel activation statistics from analyze_activations.py --save_stats")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the Hadamard sign vectors")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 4))
+    parser.add_argument("--layers-per-job", type=int, default=4)
+    parser.add_argument("--output", type=str, default=None, help="Write per-layer rows to .csv or .json")
+    main(parser.parse_args())
@@ -1,9 +1,14 @@
 import argparse
 import os
 import json
+import sys
 import torch
 import safetensors.torch
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.safetensors_reader import SafetensorsCheckpoint
+from utils.checkpoint_manifest import build_manifest, diff_manifests, print_diff, write_manifest
+
 def per_tensor_quantize(tensor):
     """Quantize a tensor to FP8 using per-tensor static scaling factor."""
     finfo = torch.finfo(torch.float8_e4m3fn)
@@ -17,25 +22,38 @@ def per_tensor_quantize(tensor):
     scale = scale.float().reciprocal()
     return qweight, scale
 
-def process_safetensors_file(file_path):
+def input_scale_from_absmax(absmax):
+    """Static per-tensor activation scale: x / input_scale fits the FP8 range."""
+    finfo = torch.finfo(torch.float8_e4m3fn)
+    return (absmax.float().clamp(min=1e-12) / finfo.max).reshape(())
+
+def process_safetensors_file(file_path, read_ahead=4, input_absmax=None):
     """Process a single safetensors file in-place, quantizing weights to FP8."""
     print(f"Processing {file_path}")
-    tensors = safetensors.torch.load_file(file_path)
-    
-    modified_tensors = {}
-    for name, tensor in tensors.items():
-        if name.endswith('_proj.weight'):
+    # Only the quantized tensors are held in memory; everything else stays an mmap view
+    # until save_file copies it, and weights are read ahead in on-disk order
+    with SafetensorsCheckpoint(file_path) as checkpoint:
+        metadata = checkpoint.metadata() or {"format": "pt"}
+        modified_tensors = {}
+        for name, tensor in checkpoint.iter_tensors(filter=lambda info: not info.name.endswith('_proj.weight')):
+            modified_tensors[name] = tensor
+        for name, tensor in checkpoint.iter_tensors(filter=lambda info: info.name.endswith('_proj.weight'),
+                                                    read_ahead=read_ahead):
             print("Quantizing", name)
             qweight, scale = per_tensor_quantize(tensor)
             modified_tensors[name] = qweight
             modified_tensors[f"{name}_scale"] = scale
-        else:
-            modified_tensors[name] = tensor
+            if input_absmax is not None:
+                module = name[:-len('.weight')]
+                modified_tensors[f"{module}.input_scale"] = input_scale_from_absmax(input_absmax[module])
 
-    safetensors.torch.save_file(modified_tensors, file_path)
+        # Write next to the original and swap, the views above still point into the old file
+        tmp_path = file_path + ".tmp"
+        safetensors.torch.save_file(modified_tensors, tmp_path, metadata=metadata)
+    os.replace(tmp_path, file_path)
     print(f"Updated {file_path} with quantized tensors")
 
-def update_index_file(index_file_path):
+def update_index_file(index_file_path, static_activations=False):
     """Update the index file for the quantized model."""
     print(f"Updating index file: {index_file_path}")
     with open(index_file_path, 'r') as f:
@@ -46,6 +64,8 @@ def update_index_file(index_file_path):
         new_weight_map[tensor_name] = file_name
         if tensor_name.endswith('_proj.weight'):
             new_weight_map[f"{tensor_name}_scale"] = file_name
+            if static_activations:
+                new_weight_map[f"{tensor_name[:-len('.weight')]}.input_scale"] = file_name
     
     index['weight_map'] = new_weight_map
     
@@ -58,20 +78,82 @@ def update_index_file(index_file_path):
         json.dump(index, f, indent=2)
     print(f"Updated index file {index_file_path}")
 
-def process_directory(directory):
+def load_input_absmax(stats_path):
+    """Per-tensor input absmax per Linear from `analyze_activations.py --save_stats` output."""
+    absmax = {}
+    with safetensors.safe_open(stats_path, framework="pt") as f:
+        for key in f.keys():
+            if key.endswith(".input_absmax"):
+                absmax[key[:-len(".input_absmax")]] = f.get_tensor(key).max()
+    return absmax
+
+def calibrate(directory, dataset, dataset_config, num_samples, batch_size):
+    """Run the calibration set through the unquantized model and collect per-Linear input absmax."""
+    from transformers import AutoTokenizer
+    from analyze_activations import calibrate_input_absmax, load_model, load_samples
+
+    model = load_model(directory)
+    tokenizer = AutoTokenizer.from_pretrained(directory)
+    tokenizer.pad_token = tokenizer.pad_token or tokenizer.eos_token
+    samples = [s for s in load_samples(dataset, dataset_config, num_samples) if s.strip()]
+    absmax = calibrate_input_absmax(model, tokenizer, samples, batch_size)
+    del model
+    return absmax
+
+def update_config_file(config_path):
+    """Mark the checkpoint as FP8 with static activation scales."""
+    with open(config_path) as f:
+        config = json.load(f)
+    quantization_config = config.get('quantization_config', {})
+    quantization_config.update({"quant_method": "fp8", "activation_scheme": "static"})
+    config['quantization_config'] = quantization_config
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=2)
+    print(f"Updated {config_path} with static activation scheme")
+
+def process_directory(directory, manifest=False, input_absmax=None):
     """Process all safetensors files in the given directory."""
+    if input_absmax is not None:
+        # Every quantized Linear needs its input_scale, fail before anything is rewritten
+        with SafetensorsCheckpoint(directory) as checkpoint:
+            missing = [name for name in checkpoint.keys()
+                       if name.endswith('_proj.weight') and name[:-len('.weight')] not in input_absmax]
+        if missing:
+            raise ValueError(f"No activation statistics for {len(missing)} layers, e.g. {missing[:3]}")
+    if manifest:
+        before = build_manifest(directory)
     for filename in os.listdir(directory):
         file_path = os.path.join(directory, filename)
         if filename.endswith('.safetensors'):
-            process_safetensors_file(file_path)
+            process_safetensors_file(file_path, input_absmax=input_absmax)
         elif filename == 'model.safetensors.index.json':
             index_file_path = file_path
 
-    update_index_file(index_file_path)
+    update_index_file(index_file_path, static_activations=input_absmax is not None)
+    if input_absmax is not None:
+        update_config_file(os.path.join(directory, 'config.json'))
+    if manifest:
+        # Record per-tensor hashes of the result and report what the conversion touched
+        print_diff(diff_manifests(before, write_manifest(directory)))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Convert safetensors model to FP8 in-place.')
     parser.add_argument('directory', type=str, help='The directory containing the safetensors files and index file.')
-    
+    parser.add_argument('--manifest', action='store_true',
+                        help='Write a per-tensor hash manifest and print which tensors changed.')
+    parser.add_argument('--act-stats', type=str, default=None,
+                        help='Write static input_scale tensors from analyze_activations.py --save_stats output.')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='Write static input_scale tensors calibrated on --dataset before quantizing.')
+    parser.add_argument('--dataset', default="wikitext")
+    parser.add_argument('--dataset_config', default="wikitext-2-raw-v1")
+    parser.add_argument('--num_samples', type=int, default=512)
+    parser.add_argument('--batch_size', type=int, default=8)
+
     args = parser.parse_args()
-    process_directory(args.directory)
+    input_absmax = None
+    if args.act_stats:
+        input_absmax = load_input_absmax(args.act_stats)
+    elif args.calibrate:
+        input_absmax = calibrate(args.directory, args.dataset, args.dataset_config, args.num_samples, args.batch_size)
+    process_directory(args.directory, args.manifest, input_absmax)
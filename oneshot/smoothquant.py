@@ -0,0 +1,257 @@
+"""
+Migrate activation outliers into the weights (SmoothQuant) in a safetensors checkpoint.
+
+Uses the per-channel input absmax saved by `analyze_activations.py --save_stats`. For
+every group of Linears that read the same input, the smoothing factor of input channel j is
+
+    s_j = max|X_j|^alpha / max|W_:,j|^(1 - alpha)
+
+where the weight max is over all Linears of the group. Inputs are divided by s and the
+weight columns multiplied by s, so the model computes the same function while activation
+outliers shrink. s is folded into whatever produces the input:
+  input_layernorm           -> q_proj, k_proj, v_proj
+  post_attention_layernorm  -> gate_proj, up_proj
+  v_proj output rows        -> o_proj        (shared across the heads of a GQA group)
+  up_proj output rows       -> down_proj     (silu(gate) * up is linear in up)
+
+The first pass only reads Linear weights to get their per-column absmax; the second
+streams the checkpoint shard by shard, rewriting the affected tensors.
+
+    python analyze_activations.py --model /path/to/model --save_stats stats.safetensors
+    python smoothquant.py /path/to/model stats.safetensors /path/to/model-smooth --alpha 0.5
+
+`--verify` then runs a few calibration chunks through both checkpoints with the CPU
+forward of cpu_perplexity.py and fails if the logits moved by more than rounding.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+from typing import Dict, List, Tuple
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.safetensors_reader import INDEX_NAME, SafetensorsCheckpoint
+
+SUPPORTED_MODEL_TYPES = {"llama", "mistral", "qwen2", "qwen3", "granite"}
+
+# (name of the tensor the factor is folded into, how, Linears reading the smoothed input)
+GROUPS = [
+    ("input_layernorm", "norm", ["self_attn.q_proj", "self_attn.k_proj", "self_attn.v_proj"]),
+    ("post_attention_layernorm", "norm", ["mlp.gate_proj", "mlp.up_proj"]),
+    ("self_attn.v_proj", "rows", ["self_attn.o_proj"]),
+    ("mlp.up_proj", "rows", ["mlp.down_proj"]),
+]
+
+
+def column_absmax(checkpoint: SafetensorsCheckpoint, names: List[str]) -> Dict[str, torch.Tensor]:
+    """Per input channel absmax of every listed Linear weight, read in on-disk order."""
+    return {name: tensor.abs().amax(dim=0).float()
+            for name, tensor in checkpoint.iter_tensors(names=names, read_ahead=4)}
+
+
+def smoothing_factors(act_absmax: torch.Tensor, weight_absmax: torch.Tensor, alpha: float) -> torch.Tensor:
+    act = act_absmax.float().clamp(min=1e-5)
+    weight = weight_absmax.float().clamp(min=1e-5)
+    return (act.pow(alpha) / weight.pow(1 - alpha)).clamp(min=1e-5)
+
+
+def share_across_gqa_groups(scales: torch.Tensor, num_heads: int, num_kv_heads: int, head_dim: int) -> torch.Tensor:
+    """o_proj input channels of heads sharing a KV head come from the same v_proj row, so they need one factor."""
+    per_head = scales.view(num_kv_heads, num_heads // num_kv_heads, head_dim)
+    return per_head.amax(dim=1, keepdim=True).expand_as(per_head).reshape(-1)
+
+
+def compute_scales(checkpoint: SafetensorsCheckpoint, stats_path: str, config: Dict, alpha: float,
+                   skip_rows: bool = False) -> Tuple[Dict[str, torch.Tensor], List[Dict]]:
+    """
+    Smoothing factors keyed by the tensor they are folded into (norm weight or Linear
+    producing the input), plus per-group before/after absmax for the report.
+    """
+    num_heads = config["num_attention_heads"]
+    num_kv_heads = config.get("num_key_value_heads") or num_heads
+    head_dim = config.get("head_dim") or config["hidden_size"] // num_heads
+
+    with safe_open(stats_path, framework="pt") as f:
+        act_stats = {key[:-len(".input_absmax")]: f.get_tensor(key)
+                     for key in f.keys() if key.endswith(".input_absmax")}
+
+    groups = []
+    for layer in range(config["num_hidden_layers"]):
+        prefix = f"model.layers.{layer}."
+        for source, kind, consumers in GROUPS:
+            if skip_rows and kind == "rows":
+                continue
+            linears = [prefix + c for c in consumers]
+            available = [act_stats[name] for name in linears if name in act_stats]
+            if not available or any(f"{name}.weight" not in checkpoint for name in linears):
+                continue
+            groups.append((prefix + source, kind, linears, torch.stack(available).amax(dim=0)))
+
+    weight_absmax = column_absmax(checkpoint, [f"{name}.weight" for _, _, linears, _ in groups for name in linears])
+
+    scales = {}
+    report = []
+    for source, kind, linears, act in groups:
+        w_max = torch.stack([weight_absmax[f"{name}.weight"] for name in linears]).amax(dim=0)
+        s = smoothing_factors(act, w_max, alpha)
+        if source.endswith("v_proj"):
+            s = share_across_gqa_groups(s, num_heads, num_kv_heads, head_dim)
+        scales[source] = s
+        report.append({"source": source, "linears": linears,
+                       "act_absmax": act.max().item(), "smoothed_act_absmax": (act / s).max().item(),
+                       "weight_absmax": w_max.max().item(), "smoothed_weight_absmax": (w_max * s).max().item()})
+    return scales, report
+
+
+class SmoothFolder:
+    def __init__(self, scales: Dict[str, torch.Tensor], num_heads: int, num_kv_heads: int, head_dim: int):
+        self.scales = scales
+        self.head_dim = head_dim
+        self.group_size = num_heads // num_kv_heads
+        # Linear name -> source whose factors scale its input columns
+        self.consumers = {}
+        for source in scales:
+            for src, _, linears in GROUPS:
+                if source.endswith("." + src):
+                    layer_prefix = source[:-len(src)]
+                    for linear in linears:
+                        self.consumers[layer_prefix + linear] = source
+
+    def _row_scales(self, source: str) -> torch.Tensor:
+        s = self.scales[source]
+        if source.endswith("v_proj"):
+            # One factor per v_proj row: take the first head of every GQA group
+            s = s.view(-1, self.group_size, self.head_dim)[:, 0].reshape(-1)
+        return s
+
+    def transform(self, name: str, tensor: torch.Tensor) -> torch.Tensor:
+        module, _, kind = name.rpartition(".")
+        if kind not in ("weight", "bias") or (module not in self.scales and module not in self.consumers):
+            return tensor
+        # v_proj and up_proj can be both: their input columns are scaled up for the
+        # preceding norm and their output rows scaled down for o_proj / down_proj
+        result = tensor.float()
+        if module in self.consumers and kind == "weight":
+            result = result * self.scales[self.consumers[module]]
+        if module in self.scales:
+            if module.endswith("layernorm"):
+                result = result / self.scales[module]
+            else:
+                s = self._row_scales(module)
+                result = result / (s[:, None] if kind == "weight" else s)
+        return result.to(tensor.dtype)
+
+
+def smooth_checkpoint(model_dir: str, stats_path: str, output_dir: str, alpha: float = 0.5,
+                      skip_rows: bool = False) -> List[Dict]:
+    with open(os.path.join(model_dir, "config.json")) as f:
+        config = json.load(f)
+    if config.get("model_type") not in SUPPORTED_MODEL_TYPES:
+        raise ValueError(f"model_type {config.get('model_type')!r} is not supported, "
+                         f"expected one of {sorted(SUPPORTED_MODEL_TYPES)}")
+    num_heads = config["num_attention_heads"]
+    num_kv_heads = config.get("num_key_value_heads") or num_heads
+    head_dim = config.get("head_dim") or config["hidden_size"] // num_heads
+
+    checkpoint = SafetensorsCheckpoint(model_dir)
+    scales, report = compute_scales(checkpoint, stats_path, config, alpha, skip_rows)
+    folder = SmoothFolder(scales, num_heads, num_kv_heads, head_dim)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for shard in checkpoint.shards:
+        print(f"Processing {shard}")
+        tensors = {}
+        for info in checkpoint.infos(shard):
+            tensors[info.name] = folder.transform(info.name, checkpoint.get_tensor(info.name))
+        save_file(tensors, os.path.join(output_dir, shard), metadata=checkpoint.metadata(shard) or {"format": "pt"})
+    checkpoint.close()
+
+    for filename in os.listdir(model_dir):
+        src = os.path.join(model_dir, filename)
+        if filename.endswith(".safetensors") or filename.endswith(".manifest.json"):
+            continue
+        if os.path.isfile(src):
+            shutil.copy2(src, os.path.join(output_dir, filename))
+    if os.path.exists(os.path.join(model_dir, INDEX_NAME)):
+        with open(os.path.join(output_dir, INDEX_NAME)) as f:
+            index = json.load(f)
+        index.setdefault("metadata", {})["total_size"] = sum(
+            os.path.getsize(os.path.join(output_dir, shard)) for shard in set(index["weight_map"].values()))
+        with open(os.path.join(output_dir, INDEX_NAME), "w") as f:
+            json.dump(index, f, indent=2)
+
+    with open(os.path.join(output_dir, "smoothquant_config.json"), "w") as f:
+        json.dump({"alpha": alpha, "stats": os.path.abspath(stats_path), "smoothed": sorted(scales)}, f, indent=2)
+    print(f"Wrote smoothed checkpoint to {output_dir}")
+    return report
+
+
+def verify_folding(model_dir: str, output_dir: str, chunks: torch.Tensor) -> Dict[str, float]:
+    """Logits of the original and the smoothed checkpoint on the same [num_chunks, seq_len] tokens."""
+    from cpu_perplexity import chunk_logits
+
+    before = chunk_logits(model_dir, chunks)
+    after = chunk_logits(output_dir, chunks)
+    max_abs_diff = (after - before).abs().max().item()
+    return {
+        "max_abs_diff": max_abs_diff,
+        "relative_diff": max_abs_diff / max(before.abs().max().item(), 1e-12),
+        "top1_agreement": (after.argmax(dim=-1) == before.argmax(dim=-1)).float().mean().item(),
+    }
+
+
+def print_report(report: List[Dict]):
+    width = max(len(row["source"]) for row in report)
+    print(f"{'Smoothed into':<{width}} | {'act max':>9} -> {'after':>9} | {'weight max':>10} -> {'after':>9}")
+    for row in report:
+        print(f"{row['source']:<{width}} | {row['act_absmax']:>9.3f} -> {row['smoothed_act_absmax']:>9.3f} | "
+              f"{row['weight_absmax']:>10.4f} -> {row['smoothed_weight_absmax']:>9.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fold SmoothQuant factors into a safetensors checkpoint.")
+    parser.add_argument("model_dir", type=str)
+    parser.add_argument("stats", type=str, help="Per-channel statistics from analyze_activations.py --save_stats")
+    parser.add_argument("output_dir", type=str)
+    parser.add_argument("--alpha", type=float, default=0.5, help="Migration strength, 0 keeps the weights unchanged")
+    parser.add_argument("--norms-only", action="store_true",
+                        help="Only smooth the inputs of q/k/v and gate/up, not o_proj and down_proj")
+    parser.add_argument("--verify", action="store_true",
+                        help="Compare the logits of both checkpoints on a few calibration chunks, exit 1 on a mismatch")
+    parser.add_argument("--verify-chunks", type=int, default=4)
+    parser.add_argument("--verify-seq-len", type=int, default=128)
+    parser.add_argument("--verify-tolerance", type=float, default=2e-2,
+                        help="Largest logit difference allowed, relative to the largest logit; the default "
+                             "leaves room for rounding the folded weights back to 16 bits")
+    parser.add_argument("--dataset", default="wikitext")
+    parser.add_argument("--dataset-config", default="wikitext-2-raw-v1")
+    parser.add_argument("--tokens", type=str, default=None,
+                        help="Pre-tokenized safetensors file with an input_ids tensor instead of the dataset")
+    args = parser.parse_args()
+
+    report = smooth_checkpoint(args.model_dir, args.stats, args.output_dir, args.alpha, args.norms_only)
+    if report:
+        print_report(report)
+    else:
+        print("No layers had both statistics and weights, nothing was smoothed")
+
+    if args.verify:
+        from cpu_perplexity import load_token_chunks
+
+        if args.tokens:
+            tokens = load_file(args.tokens)["input_ids"].reshape(-1)
+            usable = len(tokens) // args.verify_seq_len * args.verify_seq_len
+            chunks = tokens[:usable].view(-1, args.verify_seq_len)[:args.verify_chunks]
+        else:
+            chunks = load_token_chunks(args.model_dir, args.verify_seq_len, args.verify_chunks, args.dataset,
+                                       args.dataset_config, "train")
+        result = verify_folding(args.model_dir, args.output_dir, chunks)
+        print(f"Logits on {chunks.numel()} tokens: max abs diff {result['max_abs_diff']:.4g} "
+              f"({result['relative_diff']:.2%} of the largest logit), top-1 agreement {result['top1_agreement']:.2%}")
+        if result["relative_diff"] > args.verify_tolerance:
+            sys.exit(f"FAIL: smoothed logits differ by more than {args.verify_tolerance:.2%}")
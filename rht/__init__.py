@@ -1 +1,11 @@
-
+from .hadamard import (
+    fwht_,
+    get_hadamard_factors,
+    hadamard_matrix,
+    hadamard_transform,
+    inverse_hadamard_transform,
+    is_pow2,
+    random_signs,
+    rotate_columns,
+    rotate_rows,
+)
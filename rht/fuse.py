@@ -0,0 +1,194 @@
+"""
+Fuse randomized Hadamard rotations into the Linear weights of a safetensors checkpoint.
+
+Two rotations are applied, both exactly cancelling in the forward pass so the fused
+model computes the same function with no extra ops at runtime:
+  - residual (QuaRot/SpinQuant R1): RMSNorm weights are folded into the Linears that
+    read the normalized residual, then every weight reading the residual stream is
+    rotated on its input (W Q^T: embed_tokens, q/k/v, gate/up, lm_head) and every weight
+    writing to it is rotated on its output (Q W: o_proj, down_proj). RMSNorm is
+    invariant to the rotation once its weight is all ones.
+  - per head (R2): v_proj outputs and o_proj inputs are rotated with a head_dim sized
+    Hadamard inside each head, which commutes with the attention-weighted sum (also with GQA).
+The rotated weights have much flatter distributions (outliers spread across channels),
+so quantizing them to FP8/INT4 afterwards loses less accuracy.
+
+    python -m rht.fuse /path/to/model /path/to/model-rht --seed 0
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from .hadamard import hadamard_transform, random_signs, rotate_columns, rotate_rows
+
+SUPPORTED_MODEL_TYPES = {"llama", "mistral", "qwen2", "qwen3", "granite"}
+
+LAYER_RE = re.compile(r"model\.layers\.(\d+)\.(.*)")
+
+
+def rotate_head_outputs(weight, head_dim, signs):
+    """Q_h W per head block of output rows, for v_proj weight [heads * head_dim, hidden] or bias."""
+    if weight.dim() == 1:
+        return hadamard_transform(weight.float().view(-1, head_dim), signs).view(-1).to(weight.dtype)
+    rows, cols = weight.shape
+    w = weight.float().view(rows // head_dim, head_dim, cols).transpose(1, 2)
+    return hadamard_transform(w, signs).transpose(1, 2).reshape(rows, cols).to(weight.dtype)
+
+
+def rotate_head_inputs(weight, head_dim, signs):
+    """W Q_h^T per head block of input columns, for o_proj weight [hidden, heads * head_dim]."""
+    rows, cols = weight.shape
+    w = weight.float().view(rows, cols // head_dim, head_dim)
+    return hadamard_transform(w, signs).view(rows, cols).to(weight.dtype)
+
+
+def fold_norm(weight, norm_weight):
+    """W diag(gamma): fold an RMSNorm scale into the columns of a Linear that reads its output."""
+    return (weight.float() * norm_weight.float()).to(weight.dtype)
+
+
+class RotationFuser:
+    def __init__(self, norms, hidden_size, head_dim, seed=0, residual=True, heads=True):
+        self.norms = norms
+        self.head_dim = head_dim
+        self.residual = residual
+        self.heads = heads
+        self.residual_signs = random_signs(hidden_size, seed)
+        self.head_signs = random_signs(head_dim, seed + 1)
+
+    def _consumer(self, weight, norm_name=None):
+        if norm_name is not None:
+            weight = fold_norm(weight, self.norms[norm_name])
+        return rotate_rows(weight, self.residual_signs)
+
+    def transform(self, name, tensor):
+        if not self.residual and not self.heads:
+            return tensor
+        if name == "model.embed_tokens.weight":
+            return rotate_rows(tensor, self.residual_signs) if self.residual else tensor
+        if name == "lm_head.weight":
+            return self._consumer(tensor, "model.norm.weight") if self.residual else tensor
+        if name == "model.norm.weight":
+            return torch.ones_like(tensor) if self.residual else tensor
+
+        match = LAYER_RE.match(name)
+        if match is None:
+            return tensor
+        layer, rest = match.groups()
+        prefix = f"model.layers.{layer}."
+
+        if rest in ("input_layernorm.weight", "post_attention_layernorm.weight"):
+            return torch.ones_like(tensor) if self.residual else tensor
+        if rest == "self_attn.v_proj.weight" or rest == "self_attn.v_proj.bias":
+            if self.heads:
+                tensor = rotate_head_outputs(tensor, self.head_dim, self.head_signs)
+            if self.residual and rest.endswith("weight"):
+                tensor = self._consumer(tensor, prefix + "input_layernorm.weight")
+            return tensor
+        if rest in ("self_attn.q_proj.weight", "self_attn.k_proj.weight"):
+            return self._consumer(tensor, prefix + "input_layernorm.weight") if self.residual else tensor
+        if rest in ("mlp.gate_proj.weight", "mlp.up_proj.weight"):
+            return self._consumer(tensor, prefix + "post_attention_layernorm.weight") if self.residual else tensor
+        if rest == "self_attn.o_proj.weight":
+            if self.heads:
+                tensor = rotate_head_inputs(tensor, self.head_dim, self.head_signs)
+            return rotate_columns(tensor, self.residual_signs) if self.residual else tensor
+        if rest in ("self_attn.o_proj.bias", "mlp.down_proj.bias"):
+            return hadamard_transform(tensor.float(), self.residual_signs).to(tensor.dtype) if self.residual else tensor
+        if rest == "mlp.down_proj.weight":
+            return rotate_columns(tensor, self.residual_signs) if self.residual else tensor
+        return tensor
+
+
+def get_weight_map(model_dir):
+    """Tensor name -> shard file name, for sharded and single-file checkpoints."""
+    index_path = os.path.join(model_dir, "model.safetensors.index.json")
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            return json.load(f)["weight_map"]
+    with safe_open(os.path.join(model_dir, "model.safetensors"), framework="pt") as f:
+        return {name: "model.safetensors" for name in f.keys()}
+
+
+def fuse_checkpoint(model_dir, output_dir, seed=0, residual=True, heads=True):
+    with open(os.path.join(model_dir, "config.json")) as f:
+        config = json.load(f)
+    if config.get("model_type") not in SUPPORTED_MODEL_TYPES:
+        raise ValueError(f"model_type {config.get('model_type')!r} is not supported, "
+                         f"expected one of {sorted(SUPPORTED_MODEL_TYPES)}")
+    hidden_size = config["hidden_size"]
+    head_dim = config.get("head_dim") or hidden_size // config["num_attention_heads"]
+
+    weight_map = get_weight_map(model_dir)
+    shards = sorted(set(weight_map.values()))
+
+    # Norm weights are tiny and needed while streaming the Linears, so read them up front
+    norms = {}
+    for shard in shards:
+        with safe_open(os.path.join(model_dir, shard), framework="pt") as f:
+            for name in f.keys():
+                if name.endswith("layernorm.weight") or name == "model.norm.weight":
+                    norms[name] = f.get_tensor(name)
+
+    # With tied embeddings the lm_head must become its own tensor once the final norm is folded in
+    untie = residual and "lm_head.weight" not in weight_map
+
+    fuser = RotationFuser(norms, hidden_size, head_dim, seed=seed, residual=residual, heads=heads)
+    os.makedirs(output_dir, exist_ok=True)
+    for shard in shards:
+        print(f"Processing {shard}")
+        tensors = {}
+        with safe_open(os.path.join(model_dir, shard), framework="pt") as f:
+            metadata = f.metadata() or {"format": "pt"}
+            for name in f.keys():
+                tensor = f.get_tensor(name)
+                if untie and name == "model.embed_tokens.weight":
+                    tensors["lm_head.weight"] = fuser.transform("lm_head.weight", tensor.clone())
+                    weight_map["lm_head.weight"] = shard
+                tensors[name] = fuser.transform(name, tensor)
+        save_file(tensors, os.path.join(output_dir, shard), metadata=metadata)
+
+    for filename in os.listdir(model_dir):
+        src = os.path.join(model_dir, filename)
+        if filename.endswith(".safetensors") or filename in ("config.json", "model.safetensors.index.json"):
+            continue
+        if os.path.isfile(src):
+            shutil.copy2(src, os.path.join(output_dir, filename))
+
+    if untie:
+        config["tie_word_embeddings"] = False
+    with open(os.path.join(output_dir, "config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+
+    if os.path.exists(os.path.join(model_dir, "model.safetensors.index.json")):
+        with open(os.path.join(model_dir, "model.safetensors.index.json")) as f:
+            index = json.load(f)
+        index["weight_map"] = dict(sorted(weight_map.items()))
+        index.setdefault("metadata", {})["total_size"] = sum(
+            os.path.getsize(os.path.join(output_dir, shard)) for shard in set(weight_map.values()))
+        with open(os.path.join(output_dir, "model.safetensors.index.json"), "w") as f:
+            json.dump(index, f, indent=2)
+
+    with open(os.path.join(output_dir, "rht_config.json"), "w") as f:
+        json.dump({"seed": seed, "residual": residual, "heads": heads,
+                   "hidden_size": hidden_size, "head_dim": head_dim}, f, indent=2)
+    print(f"Wrote rotated checkpoint to {output_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fuse randomized Hadamard rotations into a safetensors checkpoint.")
+    parser.add_argument("model_dir", type=str)
+    parser.add_argument("output_dir", type=str)
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the random sign vectors")
+    parser.add_argument("--no-residual", action="store_true", help="Skip the residual stream rotation")
+    parser.add_argument("--no-heads", action="store_true", help="Skip the per-head v_proj/o_proj rotation")
+    args = parser.parse_args()
+
+    fuse_checkpoint(args.model_dir, args.output_dir, seed=args.seed,
+                    residual=not args.no_residual, heads=not args.no_heads)
@@ -0,0 +1,175 @@
+"""
+Fast Walsh-Hadamard transform and randomized Hadamard rotations.
+
+All transforms act on the last dimension and are orthonormal (scaled by 1/sqrt(n)), so
+applying one to a weight row and the inverse to the matching activation leaves the
+product unchanged. Dimensions that are not a power of two are handled as a Kronecker
+product H_m (x) H_2^k, where H_m is an explicit Hadamard matrix from a Paley
+construction (12, 20, 28, 36, 44, 60, ... i.e. what Llama/Mistral/Qwen MLP widths
+factor into). For sizes with no such factor the transform falls back to block-diagonal
+Hadamard over the largest power-of-two divisor, which is still orthonormal.
+"""
+import math
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import torch
+
+
+def is_pow2(n: int) -> bool:
+    return n > 0 and n & (n - 1) == 0
+
+
+def _is_prime(q: int) -> bool:
+    return q > 1 and all(q % p for p in range(2, int(q ** 0.5) + 1))
+
+
+def _jacobsthal(q: int) -> torch.Tensor:
+    # Q[i, j] = legendre(j - i, q) for prime q
+    residues = [0] + [1 if pow(a, (q - 1) // 2, q) == 1 else -1 for a in range(1, q)]
+    idx = (torch.arange(q).view(1, -1) - torch.arange(q).view(-1, 1)) % q
+    return torch.tensor(residues, dtype=torch.float64)[idx]
+
+
+def _paley(m: int) -> Optional[torch.Tensor]:
+    """Hadamard matrix of order m from Paley I (q = m - 1) or Paley II (q = m / 2 - 1), q prime."""
+    q = m - 1
+    if _is_prime(q) and q % 4 == 3:
+        s = torch.zeros(m, m, dtype=torch.float64)
+        s[0, 1:] = 1
+        s[1:, 0] = -1
+        s[1:, 1:] = _jacobsthal(q)
+        return s + torch.eye(m, dtype=torch.float64)
+    q = m // 2 - 1
+    if m % 2 == 0 and _is_prime(q) and q % 4 == 1:
+        c = torch.zeros(q + 1, q + 1, dtype=torch.float64)
+        c[0, 1:] = 1
+        c[1:, 0] = 1
+        c[1:, 1:] = _jacobsthal(q)
+        zero_block = torch.tensor([[1.0, -1.0], [-1.0, -1.0]], dtype=torch.float64)
+        sign_block = torch.tensor([[1.0, 1.0], [1.0, -1.0]], dtype=torch.float64)
+        return torch.kron(c, sign_block) + torch.kron((c == 0).double(), zero_block)
+    return None
+
+
+@lru_cache(maxsize=None)
+def _construct(m: int) -> Optional[torch.Tensor]:
+    if m == 1:
+        return torch.ones(1, 1, dtype=torch.float64)
+    # Powers of two always use Sylvester so they match the FWHT butterfly ordering
+    h = None if is_pow2(m) else _paley(m)
+    if h is None and m % 2 == 0:
+        half = _construct(m // 2)
+        if half is not None:
+            # Sylvester doubling: [[H, H], [H, -H]]
+            h = torch.kron(torch.tensor([[1.0, 1.0], [1.0, -1.0]], dtype=torch.float64), half)
+    return h
+
+
+def hadamard_matrix(m: int) -> torch.Tensor:
+    """Unnormalized +-1 Hadamard matrix of order m, as float64 on CPU."""
+    h = _construct(m)
+    if h is None:
+        raise ValueError(f"No Hadamard construction available for order {m}")
+    return h
+
+
+@lru_cache(maxsize=None)
+def get_hadamard_factors(n: int, max_factor: int = 256) -> Tuple[int, int]:
+    """
+    Split n into (m, 2^k) with n == m * 2^k and a Hadamard matrix of order m available,
+    preferring the smallest m. The dense H_m multiply costs O(m) per element, so m is
+    capped at `max_factor`. Returns (1, block) for the block-diagonal fallback, where
+    block is the largest power of two dividing n (e.g. 11008 = 43 * 256 -> blocks of 256).
+    """
+    pow2 = n & -n
+    odd = n // pow2
+    if odd == 1:
+        return 1, n
+    m = odd * 4
+    while m <= min(n, max_factor):
+        if _construct(m) is not None:
+            return m, n // m
+        m *= 2
+    return 1, pow2
+
+
+def fwht_(x: torch.Tensor) -> torch.Tensor:
+    """
+    In-place orthonormal fast Walsh-Hadamard transform over the last dimension, which
+    must be a power of two. O(n log n) with one half-size temporary per butterfly stage.
+    """
+    n = x.shape[-1]
+    if not is_pow2(n):
+        raise ValueError(f"fwht_ needs a power-of-two last dimension, got {n}")
+    y = x.view(-1, n)
+    h = 1
+    while h < n:
+        pairs = y.view(-1, n // (2 * h), 2, h)
+        a, b = pairs[:, :, 0], pairs[:, :, 1]
+        tmp = a.clone()
+        a.add_(b)
+        b.sub_(tmp).neg_()
+        h *= 2
+    return x.mul_(1.0 / math.sqrt(n))
+
+
+def hadamard_transform(x: torch.Tensor, signs: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    Orthonormal Hadamard transform over the last dimension of `x`, applied after an
+    optional elementwise sign flip: H @ (signs * x) / sqrt(n). Returns a new tensor.
+    """
+    n = x.shape[-1]
+    if signs is not None:
+        x = (x * signs.to(device=x.device, dtype=x.dtype)).contiguous()
+    else:
+        x = x.clone(memory_format=torch.contiguous_format)
+    m, block = get_hadamard_factors(n)
+    if m == 1:
+        # Power of two, or block-diagonal fallback over `block`-sized chunks
+        return fwht_(x.view(*x.shape[:-1], n // block, block)).view(x.shape)
+    # H_m (x) H_block: FWHT inside each block, then mix the m blocks with the explicit matrix
+    y = fwht_(x.view(*x.shape[:-1], m, block))
+    h_m = hadamard_matrix(m).to(device=x.device, dtype=x.dtype) / math.sqrt(m)
+    return torch.matmul(h_m, y).view(x.shape)
+
+
+def inverse_hadamard_transform(x: torch.Tensor, signs: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """Inverse of `hadamard_transform`: signs * (H^T @ x) / sqrt(n)."""
+    n = x.shape[-1]
+    m, block = get_hadamard_factors(n)
+    if m == 1:
+        y = fwht_(x.clone(memory_format=torch.contiguous_format).view(*x.shape[:-1], n // block, block)).view(x.shape)
+    else:
+        h_m = hadamard_matrix(m).to(device=x.device, dtype=x.dtype) / math.sqrt(m)
+        y = torch.matmul(h_m.T, x.reshape(*x.shape[:-1], m, block))
+        y = fwht_(y.contiguous()).view(x.shape)
+    if signs is not None:
+        y = y * signs.to(device=x.device, dtype=x.dtype)
+    return y
+
+
+def random_signs(n: int, seed: int = 0) -> torch.Tensor:
+    """Random +-1 vector of length n, reproducible from `seed`."""
+    gen = torch.Generator().manual_seed(seed)
+    return torch.randint(0, 2, (n,), generator=gen).float().mul_(2).sub_(1)
+
+
+def rotate_rows(weight: torch.Tensor, signs: Optional[torch.Tensor] = None,
+                chunk_rows: int = 4096, compute_dtype=torch.float32) -> torch.Tensor:
+    """
+    Apply the (randomized) Hadamard rotation to every row of a 2D weight, in chunks of
+    `chunk_rows` so large matrices do not need a full-size float32 copy.
+    For a Linear consuming a rotated input x' = Q x this computes W Q^T.
+    """
+    out = torch.empty_like(weight)
+    for start in range(0, weight.shape[0], chunk_rows):
+        chunk = weight[start:start + chunk_rows].to(compute_dtype)
+        out[start:start + chunk_rows] = hadamard_transform(chunk, signs).to(weight.dtype)
+    return out
+
+
+def rotate_columns(weight: torch.Tensor, signs: Optional[torch.Tensor] = None,
+                   chunk_rows: int = 4096, compute_dtype=torch.float32) -> torch.Tensor:
+    """Rotate the output dimension of a Linear: Q W, for a producer whose output gets rotated."""
+    return rotate_rows(weight.T.contiguous(), signs, chunk_rows, compute_dtype).T.contiguous()
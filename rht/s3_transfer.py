@@ -0,0 +1,305 @@
+"""
+Parallel multipart S3 transfers for staging model checkpoints.
+
+  - listing is paginated, so prefixes with more than 1000 objects are complete
+  - large objects are split into `part_size` ranges that are downloaded (ranged GET) or
+    uploaded (multipart upload) concurrently on one bounded thread pool shared by all files
+  - files whose size and ETag already match the other side are skipped
+  - downloads go to `<file>.part` with a `<file>.part.json` sidecar listing finished
+    parts, so an interrupted download resumes where it stopped if the object is unchanged
+
+Works with any S3 endpoint (AWS, MinIO) and with moto's mock for testing:
+
+    client = make_client()  # AWS_S3_ENDPOINT / AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY
+    download_prefix(client, bucket, "base_model", "/opt/app-root/src/base_model")
+    upload_directory(client, bucket, "granite-fp8", "./base_model-FP8-Dynamic")
+"""
+import hashlib
+import json
+import math
+import os
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from typing import Dict, Iterator, List, Optional
+
+MiB = 1024 * 1024
+DEFAULT_PART_SIZE = 64 * MiB
+DEFAULT_MAX_WORKERS = 16
+
+
+def make_client(endpoint_url=None, access_key=None, secret_key=None, verify=False, max_pool_connections=None):
+    """S3 client configured from the workbench data connection env vars by default."""
+    from boto3 import client
+    from botocore.config import Config
+
+    return client(
+        "s3",
+        endpoint_url=endpoint_url or os.environ.get("AWS_S3_ENDPOINT"),
+        aws_access_key_id=access_key or os.environ.get("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=secret_key or os.environ.get("AWS_SECRET_ACCESS_KEY"),
+        verify=verify,
+        # One connection per worker, otherwise urllib3 discards and reopens connections
+        config=Config(max_pool_connections=max_pool_connections or DEFAULT_MAX_WORKERS),
+    )
+
+
+def list_objects(client, bucket: str, prefix: str) -> Iterator[Dict]:
+    """Yield every object under `prefix`, following continuation tokens."""
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            yield obj
+
+
+def local_etag(path: str, part_size: int) -> str:
+    """S3-style ETag of a local file: plain MD5, or MD5 of part MD5s plus "-N" if multipart."""
+    size = os.path.getsize(path)
+    digests = []
+    with open(path, "rb") as f:
+        # Parts are hashed a MiB at a time, so memory doesn't grow with the part size
+        for start in range(0, max(size, 1), part_size):
+            md5 = hashlib.md5()
+            remaining = min(part_size, size - start)
+            while remaining > 0:
+                chunk = f.read(min(MiB, remaining))
+                if not chunk:
+                    raise IOError(f"{path} shrank while it was being hashed")
+                md5.update(chunk)
+                remaining -= len(chunk)
+            digests.append(md5.digest())
+    if size <= part_size:
+        return digests[0].hex()
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def etag_matches(path: str, size: int, etag: str, part_size: int = DEFAULT_PART_SIZE) -> bool:
+    """
+    Whether a local file matches a remote object's size and ETag. A multipart ETag only
+    records the number of parts, so the part sizes that produce that many parts are tried:
+    ours, the boto3/aws cli defaults, and the smallest whole MiB that fits.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) != size:
+        return False
+    etag = etag.strip('"')
+    if "-" not in etag:
+        return local_etag(path, max(size, 1)) == etag
+    num_parts = int(etag.split("-")[1])
+    candidates = dict.fromkeys([part_size, 8 * MiB, 16 * MiB, math.ceil(size / num_parts / MiB) * MiB])
+    for guess in candidates:
+        if guess > 0 and math.ceil(size / guess) == num_parts and local_etag(path, guess) == etag:
+            return True
+    return False
+
+
+class _PartLog:
+    """Sidecar file recording which parts of a `.part` download are complete."""
+
+    def __init__(self, path: str, etag: str, size: int, part_size: int, resume: bool = True):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {"etag": etag, "size": size, "part_size": part_size, "done": []}
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if (saved.get("etag"), saved.get("size"), saved.get("part_size")) == (etag, size, part_size):
+                self.state = saved
+
+    @property
+    def done(self):
+        return set(self.state["done"])
+
+    def mark(self, part: int):
+        with self.lock:
+            self.state["done"].append(part)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.state, f)
+            os.replace(tmp, self.path)
+
+
+def _download_range(client, bucket, key, fd, start, end):
+    body = client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")["Body"]
+    offset = start
+    for chunk in body.iter_chunks(chunk_size=MiB):
+        os.pwrite(fd, chunk, offset)
+        offset += len(chunk)
+    if offset != end + 1:
+        raise IOError(f"Short read for s3://{bucket}/{key} range {start}-{end}: got {offset - start} bytes")
+
+
+def download_prefix(client, bucket: str, prefix: str, local_dir: str, part_size: int = DEFAULT_PART_SIZE,
+                    max_workers: int = DEFAULT_MAX_WORKERS, verbose: bool = True,
+                    max_open_files: Optional[int] = None) -> List[str]:
+    """
+    Download every object under `prefix` into `local_dir`, keeping the path below the
+    prefix. Returns the keys that were actually transferred. At most `max_open_files`
+    files (default twice `max_workers`) are open at once; a file is opened when its parts
+    are scheduled and closed after its last part.
+    """
+    prefix = prefix.rstrip("/")
+    max_open_files = max_open_files or 2 * max_workers
+    plans = deque()  # (key, final path, part log, size, parts still to download)
+    transferred = []
+
+    for obj in list_objects(client, bucket, prefix):
+        key, size, etag = obj["Key"], obj["Size"], obj["ETag"].strip('"')
+        if key.endswith("/"):
+            continue
+        rel = key[len(prefix):].lstrip("/") or os.path.basename(key)
+        path = os.path.join(local_dir, rel)
+        if etag_matches(path, size, etag, part_size):
+            if verbose:
+                print(f"Unchanged, skipping {rel}")
+            continue
+        log = _PartLog(path + ".part.json", etag, size, part_size, resume=os.path.exists(path + ".part"))
+        done = log.done
+        parts = [(part, start, min(start + part_size, size) - 1)
+                 for part, start in enumerate(range(0, size, part_size)) if part not in done]
+        plans.append((key, path, log, size, parts))
+
+    def finalize(key, path, log):
+        os.replace(path + ".part", path)
+        if os.path.exists(log.path):
+            os.remove(log.path)
+        transferred.append(key)
+        if verbose:
+            print(f"Downloaded {path}")
+
+    open_files = {}  # key -> [fd, final path, part log, parts in flight]
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        try:
+            while plans or futures:
+                while plans and len(open_files) < max_open_files:
+                    key, path, log, size, parts = plans.popleft()
+                    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                    fd = os.open(path + ".part", os.O_RDWR | os.O_CREAT)
+                    open_files[key] = [fd, path, log, len(parts)]
+                    os.ftruncate(fd, size)
+                    if not parts:
+                        # Fully present from an earlier interrupted run, only needs the rename
+                        del open_files[key]
+                        try:
+                            os.fsync(fd)
+                        finally:
+                            os.close(fd)
+                        finalize(key, path, log)
+                        continue
+                    for part, start, end in parts:
+                        futures[pool.submit(_download_range, client, bucket, key, fd, start, end)] = (key, part)
+
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key, part = futures.pop(future)
+                    future.result()
+                    entry = open_files[key]
+                    entry[2].mark(part)
+                    entry[3] -= 1
+                    if entry[3] == 0:
+                        del open_files[key]
+                        try:
+                            os.fsync(entry[0])
+                        finally:
+                            os.close(entry[0])
+                        finalize(key, entry[1], entry[2])
+        finally:
+            # On failure no part may still be writing into an fd when it is closed. The .part
+            # files and their sidecars stay, so the next run resumes them
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            for fd, _, _, _ in open_files.values():
+                os.close(fd)
+    return transferred
+
+
+def _upload_part(client, bucket, key, upload_id, part_number, path, start, length):
+    with open(path, "rb") as f:
+        data = os.pread(f.fileno(), length, start)
+    response = client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=data)
+    return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+
+def _put_object(client, bucket, key, path):
+    # Single PUT so the ETag is the plain MD5 of the file
+    with open(path, "rb") as f:
+        client.put_object(Bucket=bucket, Key=key, Body=f)
+
+
+def _remote_object(client, bucket, key) -> Optional[Dict]:
+    from botocore.exceptions import ClientError
+
+    try:
+        return client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+
+def upload_directory(client, bucket: str, prefix: str, local_dir: str, part_size: int = DEFAULT_PART_SIZE,
+                     max_workers: int = DEFAULT_MAX_WORKERS, verbose: bool = True) -> List[str]:
+    """
+    Upload every file under `local_dir` to `prefix`, skipping files whose remote copy
+    has the same size and ETag. Returns the keys that were actually transferred.
+    """
+    uploads = []
+    for root, _, filenames in os.walk(local_dir):
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            key = "/".join([prefix.rstrip("/"), os.path.relpath(path, local_dir).replace(os.sep, "/")])
+            remote = _remote_object(client, bucket, key)
+            if remote and etag_matches(path, remote["ContentLength"], remote["ETag"], part_size):
+                if verbose:
+                    print(f"Unchanged, skipping {path}")
+                continue
+            uploads.append((path, key, os.path.getsize(path)))
+
+    transferred = []
+    # Every multipart upload created and not yet completed; they are all aborted on failure,
+    # otherwise their uploaded parts stay billed
+    open_uploads = {}
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        try:
+            small = {pool.submit(_put_object, client, bucket, key, path): key
+                     for path, key, size in uploads if size <= part_size}
+            futures.extend(small)
+            multipart = []
+            for path, key, size in uploads:
+                if size <= part_size:
+                    continue
+                upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+                open_uploads[upload_id] = key
+                parts = [pool.submit(_upload_part, client, bucket, key, upload_id, i + 1, path, start,
+                                     min(part_size, size - start))
+                         for i, start in enumerate(range(0, size, part_size))]
+                futures.extend(parts)
+                multipart.append((path, key, upload_id, parts))
+
+            for future in as_completed(small):
+                future.result()
+                transferred.append(small[future])
+                if verbose:
+                    print(f"Uploaded {small[future]}")
+            for path, key, upload_id, parts in multipart:
+                completed = [p.result() for p in parts]
+                client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                                 MultipartUpload={"Parts": completed})
+                del open_uploads[upload_id]
+                transferred.append(key)
+                if verbose:
+                    print(f"Uploaded {path}")
+        except BaseException:
+            # Parts still uploading would outlive an abort, so let them finish first
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            for upload_id, key in open_uploads.items():
+                try:
+                    client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+                except Exception as e:
+                    print(f"Could not abort multipart upload {upload_id} of {key}: {e}")
+            raise
+    return transferred
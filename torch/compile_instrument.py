@@ -0,0 +1,198 @@
+"""
+Instrumentation ops that survive torch.compile(fullgraph=True) without graph breaks.
+
+Grown out of print_in_torch_compile.py: every probe is a custom op in the `mylib`
+library, so dynamo records it as a single opaque node instead of tracing into Python.
+Probes write into buffers that are allocated once by an `InstrumentCollector` and only
+ever updated in place, so they need no host sync inside the step and never trigger a
+recompile. `collector.read()` syncs once after the step and turns the buffers into
+numbers.
+
+  mylib::print(str message)                                    host print, as before
+  mylib::mark(Tensor(a!) hits, int collector, int slot, Tensor after)
+      timestamp once `after` has been computed: a CUDA event on GPU, perf_counter_ns on CPU
+  mylib::tensor_stats(Tensor x, Tensor(a!) stats, int slot)
+      running min / max / absmax / NaN count / Inf count / numel, all on device
+  mylib::histogram(Tensor x, Tensor(a!) hist, int slot, float lo, float hi)
+      running histogram with out-of-range values clamped into the edge bins
+
+    collector = InstrumentCollector(device="cuda")
+
+    def step(x):
+        h = layer1(x)
+        collector.stats(h, "layer1")
+        collector.histogram(h, "layer1", -8, 8)
+        collector.mark(h, "layer1_done")
+        return layer2(h)
+
+    torch.compile(step, fullgraph=True)(x)
+    print(collector.read())
+
+Timestamps are taken when the op's Python body runs, so they are not meaningful under
+CUDA graph replay (mode="reduce-overhead"); stats and histograms are, since they are
+plain device kernels.
+"""
+import time
+from typing import Dict
+
+import torch
+from torch.library import Library, impl
+
+lib = Library("mylib", "DEF")
+lib.define("print(str message) -> ()")
+lib.define("mark(Tensor(a!) hits, int collector, int slot, Tensor after) -> ()")
+lib.define("tensor_stats(Tensor x, Tensor(a!) stats, int slot) -> ()")
+lib.define("histogram(Tensor x, Tensor(a!) hist, int slot, float lo, float hi) -> ()")
+
+# Columns of the stats buffer
+STAT_MIN, STAT_MAX, STAT_ABSMAX, STAT_NAN, STAT_INF, STAT_NUMEL = range(6)
+
+_collectors: Dict[int, "InstrumentCollector"] = {}
+
+
+@impl(lib, "print", "CompositeExplicitAutograd")
+def print_op(message):
+    print(message)
+    return
+
+
+@impl(lib, "mark", "CompositeExplicitAutograd")
+def mark_op(hits, collector, slot, after):
+    _collectors[collector]._record(slot)
+    hits[slot] += 1
+    return
+
+
+@impl(lib, "tensor_stats", "CompositeExplicitAutograd")
+def tensor_stats_op(x, stats, slot):
+    if x.numel() == 0:
+        return
+    x = x.detach().float()
+    nan = torch.isnan(x)
+    lo = torch.where(nan, float("inf"), x).amin()
+    hi = torch.where(nan, float("-inf"), x).amax()
+    row = stats[slot]
+    row[STAT_MIN] = torch.minimum(row[STAT_MIN], lo)
+    row[STAT_MAX] = torch.maximum(row[STAT_MAX], hi)
+    row[STAT_ABSMAX] = torch.maximum(row[STAT_ABSMAX], torch.maximum(hi, -lo))
+    row[STAT_NAN] += nan.sum()
+    row[STAT_INF] += torch.isinf(x).sum()
+    row[STAT_NUMEL] += x.numel()
+    return
+
+
+@impl(lib, "histogram", "CompositeExplicitAutograd")
+def histogram_op(x, hist, slot, lo, hi):
+    bins = hist.shape[1]
+    x = x.detach().float().reshape(-1)
+    idx = ((x - lo) * (bins / (hi - lo))).floor().nan_to_num(0).clamp_(0, bins - 1).long()
+    # NaNs land in bin 0 with weight 0, they are counted by tensor_stats instead
+    hist[slot].index_add_(0, idx, (~torch.isnan(x)).to(hist.dtype))
+    return
+
+
+# Shape-only implementations used while tracing; none of the ops return anything
+for _name in ["print", "mark", "tensor_stats", "histogram"]:
+    lib.impl(_name, lambda *args: None, "Meta")
+
+
+class InstrumentCollector:
+    """
+    Owns the preallocated buffers the probes write into. Names are mapped to slots at
+    trace time, so they become constants in the compiled graph.
+    """
+
+    def __init__(self, device="cpu", max_slots: int = 256, bins: int = 64):
+        self.device = torch.device(device)
+        self.max_slots = max_slots
+        self.bins = bins
+        self.stats_buf = torch.zeros(max_slots, 6, dtype=torch.float64, device=self.device)
+        self.hist_buf = torch.zeros(max_slots, bins, dtype=torch.int64, device=self.device)
+        self.hits_buf = torch.zeros(max_slots, dtype=torch.int64, device=self.device)
+        self.hist_ranges = {}
+        self._slots = {"stats": {}, "hist": {}, "mark": {}}
+        if self.device.type == "cuda":
+            self._events = [torch.cuda.Event(enable_timing=True) for _ in range(max_slots)]
+        else:
+            self._timestamps = torch.zeros(max_slots, dtype=torch.int64)
+        self.id = id(self)
+        _collectors[self.id] = self
+        self.reset()
+
+    @torch.compiler.assume_constant_result
+    def _slot(self, kind: str, name: str) -> int:
+        # Run eagerly while tracing and baked in as a constant, so registering a new name
+        # does not install a guard on the slot table that would fail on the next call
+        slots = self._slots[kind]
+        if name not in slots:
+            if len(slots) >= self.max_slots:
+                raise ValueError(f"More than {self.max_slots} {kind} probes, raise max_slots")
+            slots[name] = len(slots)
+        return slots[name]
+
+    @torch.compiler.assume_constant_result
+    def _hist_slot(self, name: str, lo: float, hi: float) -> int:
+        self.hist_ranges[name] = (lo, hi)
+        return self._slot("hist", name)
+
+    def _record(self, slot: int):
+        if self.device.type == "cuda":
+            self._events[slot].record()
+        else:
+            self._timestamps[slot] = time.perf_counter_ns()
+
+    def reset(self):
+        """Zero all buffers in place so compiled graphs keep pointing at the same storage."""
+        self.stats_buf.zero_()
+        self.stats_buf[:, STAT_MIN] = float("inf")
+        self.stats_buf[:, STAT_MAX] = float("-inf")
+        self.stats_buf[:, STAT_ABSMAX] = float("-inf")
+        self.hist_buf.zero_()
+        self.hits_buf.zero_()
+
+    def stats(self, x: torch.Tensor, name: str):
+        torch.ops.mylib.tensor_stats(x, self.stats_buf, self._slot("stats", name))
+
+    def histogram(self, x: torch.Tensor, name: str, lo: float, hi: float):
+        torch.ops.mylib.histogram(x, self.hist_buf, self._hist_slot(name, float(lo), float(hi)), float(lo), float(hi))
+
+    def mark(self, after: torch.Tensor, name: str):
+        torch.ops.mylib.mark(self.hits_buf, self.id, self._slot("mark", name), after)
+
+    def read(self) -> Dict[str, dict]:
+        """Sync once and return stats, histograms, and marker times in ms since the first marker."""
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        stats_buf = self.stats_buf.cpu()
+        hist_buf = self.hist_buf.cpu()
+        hits = self.hits_buf.cpu()
+
+        stats = {}
+        for name, slot in self._slots["stats"].items():
+            row = stats_buf[slot].tolist()
+            stats[name] = {"min": row[STAT_MIN], "max": row[STAT_MAX], "absmax": row[STAT_ABSMAX],
+                           "nan": int(row[STAT_NAN]), "inf": int(row[STAT_INF]), "numel": int(row[STAT_NUMEL])}
+
+        histograms = {}
+        for name, slot in self._slots["hist"].items():
+            lo, hi = self.hist_ranges[name]
+            edges = torch.linspace(lo, hi, self.bins + 1).tolist()
+            histograms[name] = {"edges": edges, "counts": hist_buf[slot].tolist()}
+
+        markers = {name: slot for name, slot in self._slots["mark"].items() if hits[slot] > 0}
+        timings = {}
+        if markers:
+            # Relative to the first marker that was registered, normally the earliest in the step
+            first = min(markers.values())
+            for name, slot in markers.items():
+                timings[name] = self._elapsed_ms(first, slot)
+        return {"stats": stats, "histograms": histograms, "timings_ms": timings,
+                "marker_hits": {name: int(hits[slot]) for name, slot in markers.items()}}
+
+    def _elapsed_ms(self, start_slot, end_slot):
+        if self.device.type == "cuda":
+            return self._events[start_slot].elapsed_time(self._events[end_slot])
+        return (int(self._timestamps[end_slot]) - int(self._timestamps[start_slot])) / 1e6
+
+    def close(self):
+        _collectors.pop(self.id, None)
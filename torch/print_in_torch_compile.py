@@ -1,22 +1,31 @@
 import torch
 
-# Register a custom library and print operator
-from torch.library import Library, impl
-lib = Library("mylib", "DEF")
-lib.define("print(str message) -> ()")
-@impl(lib, "print", "CompositeExplicitAutograd")
-def print_op(message):
-    print(message)
-    return
+# Registers the mylib::print, mark, tensor_stats and histogram custom ops
+from compile_instrument import InstrumentCollector
 
 t1 = torch.randn(10, 10)
 t2 = torch.randn(10, 10)
 
+collector = InstrumentCollector(device=t1.device, bins=16)
+
 def foo(x, y):
     a = torch.sin(x)
     torch.ops.mylib.print(f"Hello from torch.compile: {a.shape}")
+    collector.mark(a, "sin")
+    collector.stats(a, "sin")
+    collector.histogram(a, "sin", -1, 1)
     b = torch.cos(y)
+    collector.mark(b, "cos")
+    collector.stats(a + b, "sum")
     return a + b
 
 opt_foo = torch.compile(foo, fullgraph=True)
 print(opt_foo(t1, t2))
+
+# Buffers are updated in place, so a second step reuses the same graph without recompiling
+opt_foo(t2, t1)
+report = collector.read()
+for name, stats in report["stats"].items():
+    print(name, stats)
+print("sin histogram", report["histograms"]["sin"]["counts"])
+print("markers (ms since first)", report["timings_ms"], report["marker_hits"])
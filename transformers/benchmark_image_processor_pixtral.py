@@ -1,82 +1,154 @@
+import argparse
+import os
+import sys
 from transformers import AutoImageProcessor
 from vllm.assets.image import ImageAsset
 from vllm.assets.base import get_vllm_public_assets
 import torch
 import torchvision
-import time
-import numpy
-
-def run_benchmark(processor, image, num_runs=100):
-    times = []
-    for _ in range(num_runs):
-        start = time.perf_counter()
-        _ = processor(image, return_tensors="pt")
-        end = time.perf_counter()
-        times.append((end - start) * 1000)  # Convert to milliseconds
-    
-    return {
-        'mean': numpy.mean(times),
-        'median': numpy.median(times),
-        'stdev': numpy.std(times),
-        'min': min(times),
-        'max': max(times)
-    }
-
-def print_stats(name, stats):
-    print(f"\n{'-' * 50}")
-    print(f"{name} Statistics (milliseconds):")
-    print(f"{'Mean:':>15} {stats['mean']:.3f}")
-    print(f"{'Median:':>15} {stats['median']:.3f}")
-    print(f"{'Std Dev:':>15} {stats['stdev']:.3f}")
-    print(f"{'Min:':>15} {stats['min']:.3f}")
-    print(f"{'Max:':>15} {stats['max']:.3f}")
-
-def main():
+from torchvision.transforms.v2 import functional as TF
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.microbench import benchmark, print_result, print_speedup, save_results
+from pixtral_batch_preprocess import BatchImagePreprocessor
+
+
+def run_benchmark(name, processor, image, **kwargs):
+    return benchmark(lambda: processor(image, return_tensors="pt"), name=name, **kwargs)
+
+
+def make_image_set(torch_image, num_images):
+    # JPEG-encoded copies of the test image at a spread of sizes, so batches span several patch grids
+    scales = [0.25, 0.5, 0.75, 1.0, 1.5]
+    images = []
+    for i in range(num_images):
+        scale = scales[i % len(scales)]
+        size = [max(16, int(torch_image.shape[1] * scale)), max(16, int(torch_image.shape[2] * scale))]
+        resized = TF.resize(torch_image, size, antialias=True)
+        images.append(torchvision.io.encode_jpeg(resized, quality=90).numpy().tobytes())
+    return images
+
+
+def decode(data):
+    return torchvision.io.decode_image(torch.frombuffer(bytearray(data), dtype=torch.uint8),
+                                       mode=torchvision.io.ImageReadMode.RGB)
+
+
+def check_parity(fast_processor, torch_image, num_workers, num_images=10):
+    """
+    The batched pipeline, uncached and cached, against `fast_processor(images=...)` on a
+    mixed-size batch. Values may differ by resize rounding, at most 2 uint8 levels.
+    """
+    images = make_image_set(torch_image, num_images)
+    reference = fast_processor(images=[decode(im) for im in images], return_tensors="pt")
+    batcher = BatchImagePreprocessor(fast_processor, num_workers=num_workers, cache_size=num_images)
+    tolerance = 2 * batcher.scale.max().item()
+    uncached = batcher(images, use_cache=False)
+    batcher(images)
+    cached = batcher(images)
+    assert batcher.cache.hits == num_images, batcher.cache.hits
+    max_diff = 0.0
+    for i in range(num_images):
+        size = uncached["image_sizes"][i]
+        expected = reference["pixel_values"][i]
+        # Older processors nest a list of images per sample, newer ones pad into one batch tensor
+        while isinstance(expected, (list, tuple)):
+            expected = expected[0]
+        if "image_sizes" in reference:
+            assert tuple(int(d) for d in reference["image_sizes"][i]) == size, (i, reference["image_sizes"][i], size)
+        expected = expected[..., :size[0], :size[1]]
+        assert expected.shape == uncached["pixel_values"][i].shape, (i, expected.shape, size)
+        assert torch.equal(cached["pixel_values"][i], uncached["pixel_values"][i]), f"image {i}: cached output differs"
+        max_diff = max(max_diff, (expected - uncached["pixel_values"][i]).abs().max().item())
+    batcher.close()
+    assert max_diff <= tolerance, f"batched pipeline differs from the fast processor by {max_diff:.4f}"
+    print(f"Parity check passed: {num_images} mixed-size images, max abs diff {max_diff:.4f}")
+
+
+def run_batch_benchmarks(fast_processor, torch_image, batch_sizes, num_workers, bench_kwargs):
+    """Images/second on CPU for per-image fast processing vs the batched pipeline."""
+    batcher = BatchImagePreprocessor(fast_processor, num_workers=num_workers, cache_size=max(batch_sizes))
+    results = []
+    print(f"\n{'Batch':>6} | {'per-image img/s':>15} | {'batched img/s':>13} | {'cached img/s':>12}")
+    for batch_size in batch_sizes:
+        images = make_image_set(torch_image, batch_size)
+        per_image = benchmark(lambda: [fast_processor(decode(im), return_tensors="pt") for im in images],
+                              name=f"Fast Processor loop (batch {batch_size})", **bench_kwargs)
+        batched = benchmark(lambda: batcher(images, use_cache=False),
+                            name=f"Batched Pipeline (batch {batch_size})", **bench_kwargs)
+        batcher(images)  # populate the cache
+        cached = benchmark(lambda: batcher(images), name=f"Batched Pipeline cached (batch {batch_size})",
+                           **bench_kwargs)
+        ips = [batch_size / (r.summary()["p50"] / 1000) for r in (per_image, batched, cached)]
+        print(f"{batch_size:>6} | {ips[0]:>15.1f} | {ips[1]:>13.1f} | {ips[2]:>12.1f}")
+        results.extend([per_image, batched, cached])
+    batcher.close()
+    return results
+
+
+def main(args):
     print("\nInitializing processors and loading image...")
-    
+
     # Load image
     pil_image = ImageAsset("stop_sign").pil_image.convert("RGB")
     image_path = get_vllm_public_assets(filename="stop_sign.jpg", s3_prefix="vision_model_images")
     torch_image = torchvision.io.read_image(image_path)
     print(torch_image.shape)
-    
+
     # Initialize processors
     slow_processor = AutoImageProcessor.from_pretrained("mistral-community/pixtral-12b", use_fast=False)
     fast_processor = AutoImageProcessor.from_pretrained("mistral-community/pixtral-12b", use_fast=True)
+    if args.check or args.batch_sizes:
+        check_parity(fast_processor, torch_image, args.num_workers)
+        if args.check:
+            return
     compiled_processor = torch.compile(fast_processor, mode="reduce-overhead")
-    
-    # Warmup runs
+
+    # Warmup runs, mostly so torch.compile is done before anything is timed
     print("Performing warmup runs...")
     for processor in [slow_processor, fast_processor, compiled_processor]:
         _ = processor(pil_image, return_tensors="pt")
         _ = processor(torch_image, return_tensors="pt")
-    
+
     # Run benchmarks
     print("\nRunning benchmarks...")
-    
-    slow_stats = run_benchmark(slow_processor, pil_image)
-    print_stats("Slow Processor (PIL Image)", slow_stats)
-    
-    fast_stats = run_benchmark(fast_processor, pil_image)
-    print_stats("Fast Processor (PIL Image)", fast_stats)
-    
-    compiled_stats = run_benchmark(compiled_processor, pil_image)
-    print_stats("Compiled Processor (PIL Image)", compiled_stats)
-    
-    slow_stats = run_benchmark(slow_processor, pil_image)
-    print_stats("Slow Processor (Torch Image)", slow_stats)
-    
-    fast_stats = run_benchmark(fast_processor, torch_image)
-    print_stats("Fast Processor (Torch Image)", fast_stats)
-    
-    compiled_stats = run_benchmark(compiled_processor, torch_image)
-    print_stats("Compiled Processor (Torch Image)", compiled_stats)
-    
-    # # Print comparison
-    # print("\nPerformance Comparison:")
-    # print(f"Fast vs Slow speedup: {slow_stats['mean'] / fast_stats['mean']:.2f}x")
-    # print(f"Compiled vs Slow speedup: {slow_stats['mean'] / compiled_stats['mean']:.2f}x")
-    # print(f"Compiled vs Fast speedup: {fast_stats['mean'] / compiled_stats['mean']:.2f}x")
+    bench_kwargs = dict(max_time=args.max_time, target_rel_ci=args.target_rel_ci)
+    results = {}
+    for image_name, image in [("PIL Image", pil_image), ("Torch Image", torch_image)]:
+        for proc_name, processor in [("Slow", slow_processor), ("Fast", fast_processor),
+                                     ("Compiled", compiled_processor)]:
+            name = f"{proc_name} Processor ({image_name})"
+            results[name] = run_benchmark(name, processor, image, **bench_kwargs)
+            print_result(results[name])
+
+    print("\nPerformance Comparison:")
+    for image_name in ["PIL Image", "Torch Image"]:
+        slow = results[f"Slow Processor ({image_name})"]
+        fast = results[f"Fast Processor ({image_name})"]
+        compiled = results[f"Compiled Processor ({image_name})"]
+        print_speedup(slow, fast)
+        print_speedup(slow, compiled)
+        print_speedup(fast, compiled)
+
+    if args.batch_sizes:
+        print("\nRunning batched preprocessing benchmarks on CPU...")
+        batch_sizes = [int(b) for b in args.batch_sizes.split(",")]
+        for r in run_batch_benchmarks(fast_processor, torch_image, batch_sizes, args.num_workers, bench_kwargs):
+            results[r.name] = r
+
+    if args.output:
+        save_results(args.output, list(results.values()))
+        print(f"\nResults saved to {args.output}; compare runs with utils/microbench.py")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Benchmark slow vs fast Pixtral image processors.")
+    parser.add_argument("--output", type=str, default=None, help="Save results as JSON for later comparison")
+    parser.add_argument("--max-time", type=float, default=10.0, help="Time budget per benchmark in seconds")
+    parser.add_argument("--target-rel-ci", type=float, default=0.01,
+                        help="Stop once the 95%% CI of the mean is within this fraction of the mean")
+    parser.add_argument("--batch-sizes", type=str, default="1,8,32,128",
+                        help="Comma separated batch sizes for the images/sec benchmark, empty to skip")
+    parser.add_argument("--num-workers", type=int, default=8, help="Decode threads for the batched pipeline")
+    parser.add_argument("--check", action="store_true",
+                        help="Only check the batched pipeline's output against the fast processor")
+    main(parser.parse_args())
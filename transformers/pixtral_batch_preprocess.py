@@ -0,0 +1,190 @@
+"""
+Batched, multi-threaded preprocessing for Pixtral images.
+
+Does the same work as the fast `AutoImageProcessor` for mistral-community/pixtral-12b
+(RGB convert, resize so the image fits `longest_edge` on a whole patch grid, rescale,
+normalize) but for many images at once:
+  - decoding of encoded images (bytes or paths) runs on a thread pool; torchvision's
+    decoders release the GIL so this scales with cores
+  - images are grouped by their target patch grid; images of equal input size within a
+    group are resized with a single batched call and each group is rescaled and
+    normalized as one fused tensor op
+  - processed pixel tensors are kept in an LRU cache keyed by the image content hash and
+    the processor config, so repeated images (system prompts, retries) are free; entries
+    are copies of their row of the group tensor, so the cache holds exactly the bytes it
+    counts and never pins a whole group
+
+    processor = AutoImageProcessor.from_pretrained("mistral-community/pixtral-12b", use_fast=True)
+    batcher = BatchImagePreprocessor(processor, num_workers=8)
+    out = batcher([open(p, "rb").read() for p in paths])
+    out["pixel_values"], out["image_sizes"]
+"""
+import hashlib
+import json
+import math
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+
+import torch
+import torchvision
+from torchvision.io import ImageReadMode
+from torchvision.transforms.v2 import functional as F
+from PIL import Image
+
+ImageInput = Union[bytes, str, Image.Image, torch.Tensor]
+
+
+class LRUTensorCache:
+    """Thread-safe LRU cache of tensors bounded by entry count and optionally total bytes."""
+
+    def __init__(self, max_entries: int, max_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._data[key] = value
+            self.nbytes += value.nbytes
+            while len(self._data) > self.max_entries or (
+                    self.max_bytes is not None and self.nbytes > self.max_bytes and len(self._data) > 1):
+                self.nbytes -= self._data.popitem(last=False)[1].nbytes
+
+    def __len__(self):
+        return len(self._data)
+
+
+def get_resize_output_image_size(height: int, width: int, longest_edge: int,
+                                 patch_height: int, patch_width: int) -> Tuple[int, int]:
+    """Pixtral's target size: fit inside `longest_edge`, then round up to whole patches."""
+    ratio = max(height / longest_edge, width / longest_edge)
+    if ratio > 1:
+        height = int(math.ceil(height / ratio))
+        width = int(math.ceil(width / ratio))
+    num_height_tokens = (height - 1) // patch_height + 1
+    num_width_tokens = (width - 1) // patch_width + 1
+    return num_height_tokens * patch_height, num_width_tokens * patch_width
+
+
+class BatchImagePreprocessor:
+    def __init__(self, processor, num_workers: int = 8, cache_size: int = 1024, cache_bytes: Optional[int] = None):
+        self.longest_edge = processor.size["longest_edge"]
+        self.patch_height = processor.patch_size["height"]
+        self.patch_width = processor.patch_size["width"]
+        self.do_resize = processor.do_resize
+        # Fold rescale and normalize into one multiply-subtract per channel:
+        # (x * rescale - mean) / std == x * (rescale / std) - mean / std
+        rescale = processor.rescale_factor if processor.do_rescale else 1.0
+        mean = torch.tensor(processor.image_mean if processor.do_normalize else [0.0] * 3)
+        std = torch.tensor(processor.image_std if processor.do_normalize else [1.0] * 3)
+        self.scale = (rescale / std).view(1, 3, 1, 1)
+        self.shift = (mean / std).view(1, 3, 1, 1)
+
+        config = {k: v for k, v in processor.to_dict().items() if not k.startswith("_")}
+        self.config_key = hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+        self.cache = LRUTensorCache(cache_size, cache_bytes)
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+
+    @staticmethod
+    def _load(image: ImageInput) -> ImageInput:
+        # Read paths once so hashing and decoding share the same bytes
+        if isinstance(image, str):
+            with open(image, "rb") as f:
+                return f.read()
+        return image
+
+    def _decode(self, image: ImageInput) -> torch.Tensor:
+        """Return a uint8 RGB tensor of shape (3, H, W)."""
+        if isinstance(image, bytes):
+            image = torch.frombuffer(bytearray(image), dtype=torch.uint8)
+        elif isinstance(image, Image.Image):
+            return F.pil_to_tensor(image.convert("RGB"))
+        if image.dim() == 1:
+            return torchvision.io.decode_image(image, mode=ImageReadMode.RGB)
+        if image.shape[0] == 1:
+            return image.expand(3, -1, -1)
+        return image[:3]
+
+    def _cache_key(self, image: ImageInput) -> str:
+        h = hashlib.sha1()
+        if isinstance(image, bytes):
+            h.update(image)
+        elif isinstance(image, Image.Image):
+            h.update(f"{image.mode}{image.size}".encode())
+            h.update(image.tobytes())
+        else:
+            h.update(f"{tuple(image.shape)}{image.dtype}".encode())
+            h.update(image.contiguous().numpy().tobytes())
+        return f"{self.config_key}:{h.hexdigest()}"
+
+    def _target_size(self, height: int, width: int) -> Tuple[int, int]:
+        if not self.do_resize:
+            return height, width
+        return get_resize_output_image_size(height, width, self.longest_edge,
+                                            self.patch_height, self.patch_width)
+
+    def _process_group(self, images: List[torch.Tensor], target: Tuple[int, int]) -> torch.Tensor:
+        # Resize all images sharing an input size with one call, then normalize the group at once
+        by_input_size = defaultdict(list)
+        for idx, image in enumerate(images):
+            by_input_size[tuple(image.shape[-2:])].append(idx)
+        resized = [None] * len(images)
+        for size, indices in by_input_size.items():
+            batch = torch.stack([images[i] for i in indices])
+            if size != target:
+                batch = F.resize(batch, list(target), interpolation=F.InterpolationMode.BICUBIC,
+                                 antialias=True)
+            for i, image in zip(indices, batch):
+                resized[i] = image
+        group = torch.stack(resized).float()
+        return group.mul_(self.scale).sub_(self.shift)
+
+    def __call__(self, images: List[ImageInput], use_cache: bool = True) -> Dict[str, list]:
+        images = list(self.pool.map(self._load, images))
+        keys = list(self.pool.map(self._cache_key, images)) if use_cache else [None] * len(images)
+        pixel_values = [self.cache.get(k) if use_cache else None for k in keys]
+        todo = [i for i, pv in enumerate(pixel_values) if pv is None]
+        # Hits are copies too, so a caller editing its pixel_values in place can't change the cache
+        pixel_values = [pv.clone() if pv is not None else None for pv in pixel_values]
+
+        decoded = list(self.pool.map(self._decode, [images[i] for i in todo]))
+
+        groups = defaultdict(list)
+        for i, image in zip(todo, decoded):
+            groups[self._target_size(*image.shape[-2:])].append((i, image))
+        for target, members in groups.items():
+            out = self._process_group([image for _, image in members], target)
+            for (i, _), pv in zip(members, out):
+                pixel_values[i] = pv
+                if use_cache:
+                    # A row is a view that would keep the whole group tensor alive
+                    self.cache.put(keys[i], pv.clone())
+
+        return {
+            "pixel_values": pixel_values,
+            "image_sizes": [tuple(pv.shape[-2:]) for pv in pixel_values],
+        }
+
+    def close(self):
+        self.pool.shutdown()
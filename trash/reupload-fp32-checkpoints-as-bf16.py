@@ -1,6 +1,50 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import torch
 from huggingface_hub import HfApi, Repository
+from safetensors.torch import save_file
 from transformers import AutoModelForCausalLM
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.checkpoint_manifest import write_manifest
+from utils.reshard import layer_order_key, plan_shards
+from utils.safetensors_reader import INDEX_NAME, SafetensorsCheckpoint
+
+
+def convert_to_bf16(src_dir, dst_dir, max_shard_size=5 * 1024**3):
+    """Stream a safetensors checkpoint into bf16 shards of at most max_shard_size, one shard in memory at a time."""
+    checkpoint = SafetensorsCheckpoint(src_dir)
+
+    # Shard boundaries are planned from the headers alone, so the shard count is known before writing
+    def out_bytes(info):
+        return info.numel * 2 if info.torch_dtype.is_floating_point else info.nbytes
+
+    # Layer-ordered, so loaders read the shards front to back
+    infos = sorted(checkpoint.infos(), key=lambda info: layer_order_key(info.name))
+    shards = plan_shards(infos, max_shard_size, out_bytes)
+
+    weight_map = {}
+    total_size = 0
+    for i, infos in enumerate(shards):
+        filename = f"model-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+        tensors = {}
+        for name, tensor in checkpoint.iter_tensors(names=[info.name for info in infos], read_ahead=8):
+            tensors[name] = tensor.to(torch.bfloat16) if tensor.is_floating_point() else tensor
+            weight_map[name] = filename
+        save_file(tensors, os.path.join(dst_dir, filename), metadata={"format": "pt"})
+        total_size += sum(out_bytes(info) for info in infos)
+        print(f"Wrote {filename}")
+    checkpoint.close()
+
+    with open(os.path.join(dst_dir, INDEX_NAME), "w") as f:
+        json.dump({"metadata": {"total_size": total_size}, "weight_map": dict(sorted(weight_map.items()))}, f, indent=2)
+    # Uploaded with the shards so later verifications and re-uploads can skip unchanged tensors
+    write_manifest(dst_dir)
+
 # List of model repository IDs
 model_repos = [
     "neuralmagic/Llama-2-7b-pruned50-retrained",
@@ -36,6 +80,13 @@ for repo_id in model_repos:
     # Checkout the main branch
     repo.git_checkout(revision="main")
 
+    # Convert the local FP32 safetensors to BFloat16 shards before they are removed
+    local_dir = repo_id.split("/")[-1]
+    has_safetensors = any(file.endswith(".safetensors") for file in os.listdir(local_dir))
+    if has_safetensors:
+        converted_dir = tempfile.mkdtemp()
+        convert_to_bf16(local_dir, converted_dir)
+
     # Remove files with "safetensors" or "pytorch" in their names from the main branch
     files_to_remove = [
         file for file in repo.list_files() 
@@ -43,12 +94,19 @@ for repo_id in model_repos:
     ]
     repo.git_rm(recursive=True, pathspec=files_to_remove)
 
-    # Load the tokenizer and model
-    model = AutoModelForCausalLM.from_pretrained(repo_id, torch_dtype="auto", low_cpu_mem_usage=True)
-
-    # Convert the model to BFloat16 and shard it
-    model.to(dtype="bfloat16")
-    model.save_pretrained(repo_id.split("/")[-1], safe_serialization=True, max_shard_size="5GB")
+    if has_safetensors:
+        for filename in os.listdir(converted_dir):
+            shutil.move(os.path.join(converted_dir, filename), os.path.join(local_dir, filename))
+        with open(os.path.join(local_dir, "config.json")) as f:
+            config = json.load(f)
+        config["torch_dtype"] = "bfloat16"
+        with open(os.path.join(local_dir, "config.json"), "w") as f:
+            json.dump(config, f, indent=2)
+    else:
+        # pytorch_model.bin checkpoints still go through transformers
+        model = AutoModelForCausalLM.from_pretrained(repo_id, torch_dtype="auto", low_cpu_mem_usage=True)
+        model.to(dtype="bfloat16")
+        model.save_pretrained(local_dir, safe_serialization=True, max_shard_size="5GB")
 
     # Stage and commit the changes
     repo.git_add(auto_lfs_track=True)
@@ -0,0 +1,291 @@
+"""
+Append-only on-disk store of captured activations, memory-mapped for reads.
+
+Every layer gets one flat file of rows (one row per token, `dim` values each) that is only
+ever appended to, and `index.json` records the chunks written so far. Rows can be kept as
+float32, bfloat16 / float16, or fp8 e4m3 with one float32 scale per row in a side file.
+Files may hold bytes past the last indexed chunk after a crash; they are truncated away
+when the store is reopened for writing. A layer is entered in the index (with 0 rows)
+before its file is created, so no file is ever left behind that the index doesn't know.
+
+Queries run over memory-mapped blocks of rows in a thread pool, so a pass over a layer is
+bound by disk / page cache bandwidth rather than a model forward:
+
+    store = ActivationStore("/tmp/acts")
+    stats = store.channel_stats("model.layers.0.mlp.down_proj")
+    hist, edges = store.histogram("model.layers.0.mlp.down_proj", bins=512)
+    error = store.quant_error("model.layers.0.mlp.down_proj", fmt="int8", granularity="token")
+
+    python utils/activation_store.py /tmp/acts --quant-error fp8
+"""
+import argparse
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+INDEX = "index.json"
+FP8_MAX = torch.finfo(torch.float8_e4m3fn).max
+
+# dtype name -> (torch dtype on disk, numpy dtype the bytes are mapped as)
+STORAGE = {
+    "float32": (torch.float32, np.float32),
+    "bfloat16": (torch.bfloat16, np.int16),
+    "float16": (torch.float16, np.float16),
+    "fp8": (torch.float8_e4m3fn, np.uint8),
+}
+
+
+def _filename(layer: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", layer)
+
+
+def quantize_rows(x: torch.Tensor, dtype: str) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """Downcast a [rows, dim] float tensor for storage; fp8 gets a per-row scale."""
+    if dtype != "fp8":
+        return x.to(STORAGE[dtype][0]), None
+    scale = (x.abs().amax(dim=1).float() / FP8_MAX).clamp(min=1e-12)
+    return (x.float() / scale[:, None]).to(torch.float8_e4m3fn), scale
+
+
+def fake_quantize(x: torch.Tensor, fmt: str, granularity: str = "tensor", absmax: Optional[float] = None) -> torch.Tensor:
+    """Symmetric int8 / fp8 quantize-dequantize of float32 rows, per tensor (given absmax) or per token."""
+    qmax = 127.0 if fmt == "int8" else FP8_MAX
+    if granularity == "token":
+        scale = (x.abs().amax(dim=1, keepdim=True) / qmax).clamp(min=1e-12)
+    else:
+        scale = torch.tensor(max(absmax, 1e-12) / qmax)
+    if fmt == "int8":
+        return (x / scale).round().clamp(-qmax, qmax) * scale
+    return (x / scale).clamp(-qmax, qmax).to(torch.float8_e4m3fn).float() * scale
+
+
+class ActivationStore:
+    def __init__(self, path: str, mode: str = "r", dtype: Optional[str] = None, block_rows: int = 8192,
+                 num_workers: Optional[int] = None):
+        """`dtype` defaults to bfloat16 for a new store and to the stored dtype otherwise."""
+        if dtype is not None and dtype not in STORAGE:
+            raise ValueError(f"Unknown storage dtype {dtype!r}, expected one of {sorted(STORAGE)}")
+        self.path = path
+        self.writable = mode in ("w", "a")
+        self.block_rows = block_rows
+        self.num_workers = num_workers or min(8, os.cpu_count() or 1)
+        self._lock = threading.Lock()
+        self._files = {}
+        self._maps = {}
+
+        index_path = os.path.join(path, INDEX)
+        if mode == "w" or (mode == "a" and not os.path.exists(index_path)):
+            os.makedirs(path, exist_ok=True)
+            if os.path.exists(index_path):
+                # Only the files of the previous capture are removed, nothing else in the directory
+                with open(index_path) as f:
+                    self.index = json.load(f)
+                for layer in self.index["layers"]:
+                    for file in (self._data_path(layer), self._scale_path(layer)):
+                        if os.path.exists(file):
+                            os.remove(file)
+            self.index = {"dtype": dtype or "bfloat16", "layers": {}}
+            self._write_index()
+        else:
+            with open(index_path) as f:
+                self.index = json.load(f)
+            if mode == "a" and dtype is not None and dtype != self.index["dtype"]:
+                raise ValueError(f"{path} stores {self.index['dtype']}, can't append {dtype} rows to it")
+        self.dtype = self.index["dtype"]
+        if mode == "a":
+            self._truncate_to_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_index(self):
+        tmp = os.path.join(self.path, INDEX + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(tmp, os.path.join(self.path, INDEX))
+
+    def _data_path(self, layer: str) -> str:
+        return os.path.join(self.path, self.index["layers"][layer]["file"])
+
+    def _scale_path(self, layer: str) -> str:
+        return self._data_path(layer)[:-len(".bin")] + ".scales.bin"
+
+    def _truncate_to_index(self):
+        itemsize = np.dtype(STORAGE[self.dtype][1]).itemsize
+        for layer, entry in self.index["layers"].items():
+            with open(self._data_path(layer), "r+b") as f:
+                f.truncate(entry["rows"] * entry["dim"] * itemsize)
+            if self.dtype == "fp8":
+                with open(self._scale_path(layer), "r+b") as f:
+                    f.truncate(entry["rows"] * 4)
+
+    # Writing
+
+    def append(self, layer: str, activation: torch.Tensor):
+        """Append the rows of `activation` ([..., dim]) to `layer` as one chunk."""
+        if not self.writable:
+            raise RuntimeError(f"{self.path} was opened read-only")
+        rows = activation.detach().reshape(-1, activation.shape[-1])
+        data, scale = quantize_rows(rows, self.dtype)
+        data = data.cpu().contiguous()
+        with self._lock:
+            entry = self.index["layers"].get(layer)
+            if entry is None:
+                entry = {"file": _filename(layer) + ".bin", "dim": rows.shape[1], "rows": 0, "chunks": []}
+                self.index["layers"][layer] = entry
+                # Indexed before the file exists, so reopening after a crash truncates whatever
+                # was written to it instead of appending after stale rows
+                self._flush_locked()
+                mode = "wb"
+            elif entry["dim"] != rows.shape[1]:
+                raise ValueError(f"{layer}: rows have {rows.shape[1]} values, the store has {entry['dim']}")
+            else:
+                mode = "ab"
+            if layer not in self._files:
+                self._files[layer] = open(self._data_path(layer), mode)
+                if scale is not None:
+                    self._files[layer + ".scales"] = open(self._scale_path(layer), mode)
+            self._files[layer].write(data.view(torch.uint8).numpy().tobytes())
+            if scale is not None:
+                self._files[layer + ".scales"].write(scale.cpu().numpy().tobytes())
+            entry["chunks"].append([entry["rows"], rows.shape[0]])
+            entry["rows"] += rows.shape[0]
+            self._maps.pop(layer, None)
+
+    def flush(self):
+        """Write out buffered rows and the index, making every appended chunk visible to readers."""
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        for f in self._files.values():
+            f.flush()
+        self._write_index()
+
+    def close(self):
+        if self.writable:
+            self.flush()
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+        self._maps.clear()
+
+    # Reading
+
+    def layers(self) -> List[str]:
+        return list(self.index["layers"])
+
+    def rows(self, layer: str) -> int:
+        return self.index["layers"][layer]["rows"]
+
+    def _map(self, layer: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        if layer not in self._maps:
+            entry = self.index["layers"][layer]
+            if self.writable and layer in self._files:
+                self._files[layer].flush()
+                if self.dtype == "fp8":
+                    self._files[layer + ".scales"].flush()
+            data = np.memmap(self._data_path(layer), dtype=STORAGE[self.dtype][1], mode="r",
+                             shape=(entry["rows"], entry["dim"]))
+            scales = None
+            if self.dtype == "fp8":
+                scales = np.memmap(self._scale_path(layer), dtype=np.float32, mode="r", shape=(entry["rows"],))
+            self._maps[layer] = (data, scales)
+        return self._maps[layer]
+
+    def read(self, layer: str, start: int = 0, end: Optional[int] = None) -> torch.Tensor:
+        """Rows [start, end) of a layer dequantized to float32."""
+        data, scales = self._map(layer)
+        end = self.rows(layer) if end is None else end
+        # np.array copies the mapped pages once; the downcast dtype is then reinterpreted by torch
+        block = torch.from_numpy(np.array(data[start:end])).view(STORAGE[self.dtype][0]).float()
+        if scales is not None:
+            block *= torch.from_numpy(np.array(scales[start:end]))[:, None]
+        return block
+
+    def blocks(self, layer: str) -> Iterator[Tuple[int, int]]:
+        rows = self.rows(layer)
+        for start in range(0, rows, self.block_rows):
+            yield start, min(start + self.block_rows, rows)
+
+    def reduce(self, layer: str, fn: Callable[[torch.Tensor], object], combine: Callable[[object, object], object],
+               initial: object = None):
+        """fn over every block of rows in parallel, folded together with combine; `initial` if the layer is empty."""
+        with ThreadPoolExecutor(self.num_workers) as executor:
+            results = executor.map(lambda block: fn(self.read(layer, *block)), self.blocks(layer))
+            total = initial
+            for result in results:
+                total = result if total is None else combine(total, result)
+        return total
+
+    def map_layers(self, fn: Callable[[str], object], layers: Optional[List[str]] = None) -> Dict[str, object]:
+        """fn(layer) for every (selected) layer, in order."""
+        return {layer: fn(layer) for layer in (self.layers() if layers is None else layers)}
+
+    # Built-in queries
+
+    def channel_stats(self, layer: str) -> Dict[str, torch.Tensor]:
+        """Per input channel absmax and E[x^2], same as analyze_activations.py --save_stats."""
+        dim = self.index["layers"][layer]["dim"]
+        absmax, sq_sum = self.reduce(layer, lambda x: (x.abs().amax(dim=0), x.pow(2).sum(dim=0)),
+                                     lambda a, b: (torch.maximum(a[0], b[0]), a[1] + b[1]),
+                                     (torch.zeros(dim), torch.zeros(dim)))
+        return {"absmax": absmax, "sq_mean": sq_sum / max(self.rows(layer), 1)}
+
+    def absmax(self, layer: str) -> float:
+        return self.reduce(layer, lambda x: x.abs().max().item(), max, 0.0)
+
+    def histogram(self, layer: str, bins: int = 256, lo: Optional[float] = None,
+                  hi: Optional[float] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Value histogram; the range defaults to [-absmax, absmax]."""
+        if lo is None or hi is None:
+            bound = self.absmax(layer)
+            lo, hi = -bound, bound
+        hist = self.reduce(layer, lambda x: torch.histc(x, bins=bins, min=lo, max=hi), torch.add, torch.zeros(bins))
+        return hist, torch.linspace(lo, hi, bins + 1)
+
+    def quant_error(self, layer: str, fmt: str = "int8", granularity: str = "tensor") -> Dict[str, float]:
+        """Simulate symmetric int8 / fp8 activation quantization: relative MSE and SQNR in dB."""
+        if fmt not in ("int8", "fp8") or granularity not in ("tensor", "token"):
+            raise ValueError(f"Unsupported quantization {fmt} per {granularity}")
+        absmax = self.absmax(layer) if granularity == "tensor" else None
+
+        def errors(x):
+            q = fake_quantize(x, fmt, granularity, absmax)
+            return (x - q).pow(2).sum().item(), x.pow(2).sum().item()
+
+        err, signal = self.reduce(layer, errors, lambda a, b: (a[0] + b[0], a[1] + b[1]), (0.0, 0.0))
+        relative = err / signal if signal else 0.0
+        return {"relative_mse": relative, "sqnr_db": float(10 * np.log10(1 / relative)) if relative else float("inf")}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a captured activation store.")
+    parser.add_argument("store", type=str)
+    parser.add_argument("--layers", type=str, default=None, help="Regex selecting layers")
+    parser.add_argument("--quant-error", choices=["int8", "fp8"], default=None)
+    parser.add_argument("--granularity", choices=["tensor", "token"], default="tensor")
+    parser.add_argument("--num-workers", type=int, default=None)
+    args = parser.parse_args()
+
+    store = ActivationStore(args.store, num_workers=args.num_workers)
+    layers = [layer for layer in store.layers() if args.layers is None or re.search(args.layers, layer)]
+    width = max((len(layer) for layer in layers), default=5)
+    header = f"{'Layer':<{width}} | {'rows':>9} | {'absmax':>10}"
+    if args.quant_error:
+        header += f" | {args.quant_error + ' SQNR dB':>12}"
+    print(header)
+    for layer in layers:
+        line = f"{layer:<{width}} | {store.rows(layer):>9} | {store.absmax(layer):>10.4f}"
+        if args.quant_error:
+            line += f" | {store.quant_error(layer, args.quant_error, args.granularity)['sqnr_db']:>12.2f}"
+        print(line)
@@ -0,0 +1,209 @@
+"""
+Per-tensor content hashes for safetensors checkpoints, stored next to the index as
+`model.safetensors.manifest.json`, and diffs between two checkpoints.
+
+Tensor bytes are hashed straight from the mmapped shards on a thread pool (hashlib
+releases the GIL), so a manifest costs one sequential read of the checkpoint. When an
+existing manifest is found, shards whose size and mtime did not change keep their
+hashes and are not read again.
+
+    python utils/checkpoint_manifest.py build /path/to/model
+    python utils/checkpoint_manifest.py verify /path/to/model
+    python utils/checkpoint_manifest.py diff /path/to/model /path/to/model-FP8
+
+`diff` accepts checkpoint directories or manifest files; checkpoints without a manifest
+are hashed on the fly. It exits 1 when the two sides differ.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.safetensors_reader import SafetensorsCheckpoint
+
+MANIFEST_NAME = "model.safetensors.manifest.json"
+DEFAULT_ALGORITHM = "sha256"
+
+
+def manifest_path(path: str) -> str:
+    if os.path.isdir(path):
+        return os.path.join(path, MANIFEST_NAME)
+    return os.path.join(os.path.dirname(path) or ".", MANIFEST_NAME)
+
+
+def _hash(buffer, algorithm: str) -> str:
+    h = hashlib.new(algorithm)
+    h.update(buffer)
+    return h.hexdigest()
+
+
+def _shard_stat(path: str) -> Dict[str, int]:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def checkpoint_digest(tensors: Dict[str, Dict], algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """Single hash over names, dtypes, shapes and tensor hashes; independent of how tensors are sharded."""
+    h = hashlib.new(algorithm)
+    for name in sorted(tensors):
+        entry = tensors[name]
+        h.update(f"{name}|{entry['dtype']}|{entry['shape']}|{entry['hash']}\n".encode())
+    return h.hexdigest()
+
+
+def build_manifest(path: str, workers: int = 8, algorithm: str = DEFAULT_ALGORITHM,
+                   previous: Optional[Dict] = None) -> Dict:
+    """
+    Hash every tensor of a checkpoint. Entries of shards that are unchanged since
+    `previous` (same size and mtime, same algorithm) are reused without reading them.
+    """
+    checkpoint = SafetensorsCheckpoint(path)
+    shards = {shard: _shard_stat(os.path.join(checkpoint.directory, shard)) for shard in checkpoint.shards}
+    reusable = set()
+    if previous and previous.get("algorithm") == algorithm:
+        reusable = {shard for shard, stat in shards.items() if previous["shards"].get(shard) == stat}
+
+    tensors = {}
+    to_hash = []
+    for info in checkpoint.infos():
+        shard = os.path.basename(info.shard)
+        if shard in reusable and info.name in previous["tensors"]:
+            tensors[info.name] = previous["tensors"][info.name]
+            continue
+        tensors[info.name] = {"shard": shard, "dtype": info.dtype, "shape": list(info.shape), "nbytes": info.nbytes}
+        to_hash.append(info.name)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Submitted in on-disk order so the workers read the shards front to back
+        for name, digest in zip(to_hash, pool.map(lambda n: _hash(checkpoint.buffer(n), algorithm), to_hash)):
+            tensors[name]["hash"] = digest
+    checkpoint.close()
+
+    return {
+        "version": 1,
+        "algorithm": algorithm,
+        "checkpoint_hash": checkpoint_digest(tensors, algorithm),
+        "shards": shards,
+        "tensors": dict(sorted(tensors.items())),
+        "rehashed": len(to_hash),
+    }
+
+
+def load_manifest(path: str) -> Optional[Dict]:
+    path = path if path.endswith(".json") else manifest_path(path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(path: str, workers: int = 8, algorithm: str = DEFAULT_ALGORITHM) -> Dict:
+    """Build (incrementally, if a manifest exists) and save the manifest of a checkpoint."""
+    manifest = build_manifest(path, workers, algorithm, previous=load_manifest(path))
+    rehashed = manifest.pop("rehashed")
+    with open(manifest_path(path), "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Hashed {rehashed}/{len(manifest['tensors'])} tensors, wrote {manifest_path(path)}")
+    return manifest
+
+
+def diff_manifests(old: Dict, new: Dict) -> Dict[str, List]:
+    """Compare two manifests: added/removed names, dtype/shape changes, and same-layout content changes."""
+    if old["algorithm"] != new["algorithm"]:
+        raise ValueError(f"Manifests use different hash algorithms: {old['algorithm']} vs {new['algorithm']}")
+    a, b = old["tensors"], new["tensors"]
+    result = {"added": sorted(set(b) - set(a)), "removed": sorted(set(a) - set(b)),
+              "dtype_changed": [], "shape_changed": [], "changed": [], "moved": [], "unchanged": []}
+    for name in sorted(set(a) & set(b)):
+        x, y = a[name], b[name]
+        if x["dtype"] != y["dtype"]:
+            result["dtype_changed"].append((name, x["dtype"], y["dtype"]))
+        elif x["shape"] != y["shape"]:
+            result["shape_changed"].append((name, x["shape"], y["shape"]))
+        elif x["hash"] != y["hash"]:
+            result["changed"].append(name)
+        else:
+            result["unchanged"].append(name)
+            if x["shard"] != y["shard"]:
+                result["moved"].append((name, x["shard"], y["shard"]))
+    return result
+
+
+def changed_shards(diff: Dict[str, List], new: Dict) -> List[str]:
+    """Shards of the new checkpoint holding anything not byte-identical to the old one, i.e. what to re-upload."""
+    names = diff["added"] + diff["changed"] + [entry[0] for key in ("dtype_changed", "shape_changed", "moved")
+                                               for entry in diff[key]]
+    return sorted({new["tensors"][name]["shard"] for name in names})
+
+
+def is_identical(diff: Dict[str, List]) -> bool:
+    return not any(diff[key] for key in ("added", "removed", "dtype_changed", "shape_changed", "changed"))
+
+
+def print_diff(diff: Dict[str, List], limit: int = 20):
+    for key in ("added", "removed", "dtype_changed", "shape_changed", "changed", "moved"):
+        entries = diff[key]
+        if not entries:
+            continue
+        print(f"{key}: {len(entries)}")
+        for entry in entries[:limit]:
+            print("  " + (" ".join(str(e) for e in entry) if isinstance(entry, tuple) else entry))
+        if len(entries) > limit:
+            print(f"  ... {len(entries) - limit} more")
+    print(f"unchanged: {len(diff['unchanged'])}")
+
+
+def _manifest_for(path: str, workers: int, algorithm: Optional[str] = None) -> Dict:
+    if path.endswith(".json"):
+        return load_manifest(path)
+    manifest = load_manifest(path)
+    algorithm = algorithm or (manifest["algorithm"] if manifest else DEFAULT_ALGORITHM)
+    # A stored manifest is only trusted while the shards are the ones it describes
+    fresh = build_manifest(path, workers, algorithm, previous=manifest)
+    fresh.pop("rehashed")
+    return fresh
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-tensor hash manifests for safetensors checkpoints.")
+    parser.add_argument("--workers", type=int, default=8)
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Write the manifest next to the index")
+    build.add_argument("path")
+    build.add_argument("--algorithm", default=DEFAULT_ALGORITHM, choices=sorted(hashlib.algorithms_guaranteed))
+    verify = sub.add_parser("verify", help="Rehash every tensor and compare against the stored manifest")
+    verify.add_argument("path")
+    diff = sub.add_parser("diff", help="Compare two checkpoints or manifests")
+    diff.add_argument("old")
+    diff.add_argument("new")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        write_manifest(args.path, args.workers, args.algorithm)
+    elif args.command == "verify":
+        stored = load_manifest(args.path)
+        if stored is None:
+            sys.exit(f"No {MANIFEST_NAME} in {args.path}, run build first")
+        fresh = build_manifest(args.path, args.workers, stored["algorithm"])
+        result = diff_manifests(stored, fresh)
+        print_diff(result)
+        if not is_identical(result):
+            sys.exit(1)
+        print(f"OK: {len(fresh['tensors'])} tensors match, checkpoint hash {fresh['checkpoint_hash']}")
+    else:
+        old = _manifest_for(args.old, args.workers)
+        new = _manifest_for(args.new, args.workers, old["algorithm"])
+        result = diff_manifests(old, new)
+        print_diff(result)
+        if not is_identical(result):
+            print(f"Shards to re-upload: {changed_shards(result, new)}")
+            sys.exit(1)
+        print(f"Identical, checkpoint hash {new['checkpoint_hash']}")
+
+
+if __name__ == "__main__":
+    main()
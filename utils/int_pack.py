@@ -0,0 +1,469 @@
+"""
+Vectorized CPU packing, unpacking and dequantization of INT2/4/8 weight checkpoints.
+
+Every layout is converted to and from one canonical form, `IntWeights`:
+  q       [out, in]      unsigned integer values in [0, 2^bits)
+  scales  [out, groups]  in the checkpoint's dtype
+  zeros   [out, groups]  so that w = (q - zero) * scale
+  g_idx   [in] or None   group of every input column (act-order), None for contiguous groups
+
+Supported layouts (int32 words, lowest bits first):
+  gptq                qweight [in * bits / 32, out], qzeros [groups, out * bits / 32] holding
+                      zero - 1 (zero in gptq_v2), scales [groups, out], optional g_idx [in]
+  awq                 qweight [in, out / 8], qzeros [groups, out / 8] with the nibbles of each
+                      word interleaved as 0 2 4 6 1 3 5 7, scales [groups, out]
+  compressed-tensors  weight_packed [out, in * bits / 32], weight_scale [out, groups],
+                      optional weight_zero_point [out * bits / 32, groups] (asymmetric, otherwise
+                      zero is 2^(bits - 1)), weight_g_idx [in], weight_shape
+
+Conversions are bit exact, so a GPTQ checkpoint can be rewritten as compressed-tensors (or
+the reverse) and validated on CPU without the CUDA kernels:
+
+    w = from_gptq(qweight, qzeros, scales, g_idx)
+    tensors = to_compressed(w)
+    dense = w.dequantize(torch.bfloat16)
+
+    python utils/int_pack.py self-check
+    python utils/int_pack.py bench --shape 4096 11008
+    python utils/int_pack.py validate /path/to/model-w4a16
+"""
+import argparse
+import json
+import math
+import os
+import sys
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.safetensors_reader import SafetensorsCheckpoint
+
+AWQ_ORDER = [0, 2, 4, 6, 1, 3, 5, 7]
+AWQ_REVERSE_ORDER = [0, 4, 1, 5, 2, 6, 3, 7]
+
+
+def _check_bits(bits: int):
+    if bits not in (2, 4, 8):
+        raise ValueError(f"{bits}-bit values can't be packed into int32 words, expected 2, 4 or 8")
+
+
+def unpack_int32(packed: torch.Tensor, bits: int, dim: int) -> torch.Tensor:
+    """Unpack `32 // bits` unsigned values per int32 along `dim`, lowest bits first, as uint8."""
+    _check_bits(bits)
+    dim = dim % packed.dim()
+    per_word = 32 // bits
+    new_shape = list(packed.shape)
+    new_shape[dim] *= per_word
+    if dim == packed.dim() - 1 and bits in (4, 8):
+        # Little-endian bytes already hold the values in order, only nibbles need splitting
+        data = packed.contiguous().view(torch.uint8)
+        if bits == 8:
+            return data.reshape(new_shape)
+        return torch.stack((data & 0xF, data >> 4), dim=-1).reshape(new_shape)
+    shifts = torch.arange(0, 32, bits, dtype=torch.int32)
+    shape = [1] * (packed.dim() + 1)
+    shape[dim + 1] = per_word
+    values = (packed.unsqueeze(dim + 1) >> shifts.view(shape)) & ((1 << bits) - 1)
+    return values.to(torch.uint8).reshape(new_shape)
+
+
+def pack_int32(values: torch.Tensor, bits: int, dim: int) -> torch.Tensor:
+    """Pack unsigned values in [0, 2^bits) into int32 along `dim`, lowest bits first; the size must divide."""
+    _check_bits(bits)
+    dim = dim % values.dim()
+    per_word = 32 // bits
+    if values.shape[dim] % per_word:
+        raise ValueError(f"Dimension {dim} of size {values.shape[dim]} is not a multiple of {per_word}")
+    shape = list(values.shape)
+    shape[dim:dim + 1] = [shape[dim] // per_word, per_word]
+    grouped = values.reshape(shape)
+    if dim == values.dim() - 1 and bits in (4, 8):
+        data = grouped.to(torch.uint8)
+        if bits == 4:
+            data = data[..., 0::2] | (data[..., 1::2] << 4)
+        return data.contiguous().view(torch.int32).reshape(shape[:-1])
+    words = torch.zeros(shape[:dim + 1] + shape[dim + 2:], dtype=torch.int32)
+    for i in range(per_word):
+        # int32 shifts into the sign bit wrap, which is the two's complement bit pattern we want
+        words |= grouped.select(dim + 1, i).to(torch.int32) << (i * bits)
+    return words
+
+
+@dataclass
+class IntWeights:
+    q: torch.Tensor
+    scales: torch.Tensor
+    zeros: torch.Tensor
+    bits: int
+    g_idx: Optional[torch.Tensor] = None
+
+    @property
+    def shape(self):
+        return tuple(self.q.shape)
+
+    @property
+    def num_groups(self) -> int:
+        return self.scales.shape[1]
+
+    @property
+    def group_size(self) -> int:
+        return math.ceil(self.q.shape[1] / self.num_groups)
+
+    def group_index(self) -> torch.Tensor:
+        """Group of every input column, [in]."""
+        if self.g_idx is not None:
+            return self.g_idx.long()
+        return torch.arange(self.q.shape[1]) // self.group_size
+
+    def dequantize(self, dtype: torch.dtype = torch.float32) -> torch.Tensor:
+        """Dense [out, in] weight, computed in float32."""
+        out_features, in_features = self.q.shape
+        scales, zeros = self.scales.float(), self.zeros.float()
+        # In-place on the one float32 copy of q, which roughly halves the memory traffic
+        if self.g_idx is None and in_features == self.num_groups * self.group_size:
+            # Contiguous groups broadcast without gathering scales to the full weight shape
+            weight = self.q.view(out_features, self.num_groups, self.group_size).float()
+            weight.sub_(zeros[:, :, None]).mul_(scales[:, :, None])
+            return weight.view(out_features, in_features).to(dtype)
+        g_idx = self.group_index()
+        weight = self.q.float()
+        weight.sub_(zeros[:, g_idx]).mul_(scales[:, g_idx])
+        return weight.to(dtype)
+
+    def equal(self, other: "IntWeights") -> bool:
+        """Bit-exact equality of values, scales, zeros and groups."""
+        return (self.bits == other.bits and torch.equal(self.q, other.q) and torch.equal(self.scales, other.scales)
+                and torch.equal(self.zeros.int(), other.zeros.int())
+                and torch.equal(self.group_index(), other.group_index()))
+
+
+def quantize(weight: torch.Tensor, bits: int = 4, group_size: int = 128, symmetric: bool = True,
+             perm: Optional[torch.Tensor] = None, scale_dtype: torch.dtype = torch.float16) -> IntWeights:
+    """
+    Round-to-nearest quantization of a dense [out, in] weight, mainly to build test data.
+    `perm` is an act-order column permutation: groups are formed in permuted order and
+    recorded in g_idx. group_size <= 0 means one group per row.
+    """
+    weight = weight.float()
+    out_features, in_features = weight.shape
+    group_size = in_features if group_size <= 0 else group_size
+    maxq = (1 << bits) - 1
+    g_idx = torch.empty(in_features, dtype=torch.int32)
+    order = perm if perm is not None else torch.arange(in_features)
+    g_idx[order] = (torch.arange(in_features) // group_size).to(torch.int32)
+    num_groups = math.ceil(in_features / group_size)
+
+    index = g_idx.long()
+    lo = torch.full((out_features, num_groups), float("inf")).scatter_reduce(1, index.expand(out_features, -1), weight, "amin")
+    hi = torch.full((out_features, num_groups), float("-inf")).scatter_reduce(1, index.expand(out_features, -1), weight, "amax")
+    if symmetric:
+        hi = torch.maximum(hi.abs(), lo.abs())
+        lo = -hi
+    scales = ((hi - lo) / maxq).clamp(min=1e-8).to(scale_dtype)
+    if symmetric:
+        zeros = torch.full_like(scales, (maxq + 1) // 2, dtype=torch.int32)
+    else:
+        zeros = (-lo / scales.float()).round().clamp(0, maxq).to(torch.int32)
+    q = (weight / scales.float()[:, index]).round() + zeros[:, index]
+    q = q.clamp(0, maxq).to(torch.uint8)
+    # Without g_idx, groups are taken to be ceil(in / groups) wide, which a ragged last group breaks
+    contiguous = perm is None and group_size == math.ceil(in_features / num_groups)
+    return IntWeights(q, scales, zeros, bits, None if contiguous else g_idx)
+
+
+# GPTQ
+
+
+def from_gptq(qweight: torch.Tensor, qzeros: torch.Tensor, scales: torch.Tensor, g_idx: Optional[torch.Tensor] = None,
+              bits: int = 4, zero_offset: int = 1) -> IntWeights:
+    """`zero_offset` is 1 for the original GPTQ format, which stores zero - 1, and 0 for gptq_v2."""
+    # Transposing the int32 words first is cheaper than transposing the unpacked values
+    q = unpack_int32(qweight.t().contiguous(), bits, 1)
+    zeros = unpack_int32(qzeros, bits, 1)[:, :q.shape[0]].t().to(torch.int32) + zero_offset
+    if g_idx is not None and torch.equal(g_idx.long(), torch.arange(q.shape[1]) // math.ceil(q.shape[1] / scales.shape[0])):
+        g_idx = None
+    return IntWeights(q, scales.t().contiguous(), zeros.contiguous(), bits, g_idx)
+
+
+def to_gptq(w: IntWeights, zero_offset: int = 1) -> Dict[str, torch.Tensor]:
+    """qweight, qzeros, scales and g_idx; g_idx is always written, as GPTQ loaders expect it."""
+    zeros = (w.zeros - zero_offset) & ((1 << w.bits) - 1)
+    per_word = 32 // w.bits
+    pad = -w.zeros.shape[0] % per_word
+    zeros = torch.nn.functional.pad(zeros.t(), (0, pad))
+    return {
+        "qweight": pack_int32(w.q, w.bits, 1).t().contiguous(),
+        "qzeros": pack_int32(zeros, w.bits, 1),
+        "scales": w.scales.t().contiguous(),
+        "g_idx": w.group_index().to(torch.int32),
+    }
+
+
+# AWQ
+
+
+def from_awq(qweight: torch.Tensor, qzeros: torch.Tensor, scales: torch.Tensor, bits: int = 4) -> IntWeights:
+    if bits != 4:
+        raise ValueError("AWQ checkpoints are 4-bit")
+    q = unpack_int32(qweight, 4, 1)
+    q = q.view(q.shape[0], -1, 8)[..., AWQ_REVERSE_ORDER].reshape(q.shape)
+    zeros = unpack_int32(qzeros, 4, 1)
+    zeros = zeros.view(zeros.shape[0], -1, 8)[..., AWQ_REVERSE_ORDER].reshape(zeros.shape)
+    return IntWeights(q.t().contiguous(), scales.t().contiguous(), zeros.t().to(torch.int32).contiguous(), 4)
+
+
+def to_awq(w: IntWeights) -> Dict[str, torch.Tensor]:
+    if w.bits != 4:
+        raise ValueError("AWQ checkpoints are 4-bit")
+    if w.g_idx is not None:
+        raise ValueError("AWQ has no act-order, the weights have a g_idx")
+    if w.zeros.max() > 15:
+        raise ValueError("AWQ zero points must fit in 4 bits")
+    q = w.q.t()
+    zeros = w.zeros.t()
+    return {
+        "qweight": pack_int32(q.reshape(q.shape[0], -1, 8)[..., AWQ_ORDER].reshape(q.shape), 4, 1),
+        "qzeros": pack_int32(zeros.reshape(zeros.shape[0], -1, 8)[..., AWQ_ORDER].reshape(zeros.shape), 4, 1),
+        "scales": w.scales.t().contiguous(),
+    }
+
+
+# compressed-tensors (pack-quantized)
+
+
+def from_compressed(weight_packed: torch.Tensor, weight_scale: torch.Tensor,
+                    weight_zero_point: Optional[torch.Tensor] = None, weight_g_idx: Optional[torch.Tensor] = None,
+                    weight_shape: Optional[torch.Tensor] = None, bits: int = 4) -> IntWeights:
+    q = unpack_int32(weight_packed, bits, 1)
+    if weight_shape is not None:
+        out_features, in_features = weight_shape.tolist()
+        q = q[:out_features, :in_features]
+    q = q.contiguous()
+    out_features = q.shape[0]
+    scales = weight_scale if weight_scale.dim() == 2 else weight_scale.view(-1, 1)
+    if scales.shape[0] == 1:
+        # Per-tensor: one scale (and zero point) for every row
+        scales = scales.expand(out_features, -1).contiguous()
+    if weight_zero_point is not None and weight_zero_point.numel() == 1:
+        zeros = torch.full(scales.shape, int(weight_zero_point.item()), dtype=torch.int32)
+    elif weight_zero_point is not None:
+        zeros = weight_zero_point
+        if zeros.dtype == torch.int32 and zeros.shape[0] != out_features:
+            zeros = unpack_int32(zeros, bits, 0)[:out_features]
+        zeros = zeros.to(torch.int32).view(out_features, -1)
+    else:
+        zeros = torch.full(scales.shape, 1 << (bits - 1), dtype=torch.int32)
+    return IntWeights(q, scales, zeros.contiguous(), bits, weight_g_idx)
+
+
+def to_compressed(w: IntWeights, symmetric: Optional[bool] = None) -> Dict[str, torch.Tensor]:
+    """`symmetric` defaults to whether every zero point is 2^(bits - 1)."""
+    if symmetric is None:
+        symmetric = bool((w.zeros == 1 << (w.bits - 1)).all())
+    per_word = 32 // w.bits
+    q = torch.nn.functional.pad(w.q, (0, -w.q.shape[1] % per_word))
+    tensors = {
+        "weight_packed": pack_int32(q, w.bits, 1),
+        "weight_scale": w.scales.contiguous(),
+        "weight_shape": torch.tensor(w.shape, dtype=torch.int64),
+    }
+    if not symmetric:
+        if w.zeros.max() >= 1 << w.bits:
+            raise ValueError(f"Zero points must fit in {w.bits} bits")
+        zeros = torch.nn.functional.pad(w.zeros, (0, 0, 0, -w.zeros.shape[0] % per_word))
+        tensors["weight_zero_point"] = pack_int32(zeros, w.bits, 0)
+    if w.g_idx is not None:
+        tensors["weight_g_idx"] = w.g_idx.to(torch.int32)
+    return tensors
+
+
+# Checkpoints
+
+
+def quantization_format(config: Dict) -> Dict:
+    """Packed weight format of a model config: {"format", "bits", "zero_offset"}, format None if unpacked."""
+    quant = config.get("quantization_config") or {}
+    method = quant.get("quant_method")
+    bits = quant.get("bits", 4)
+    if method == "compressed-tensors":
+        weights = next(iter(quant.get("config_groups", {}).values()), {}).get("weights") or {}
+        return {"format": "compressed-tensors", "bits": weights.get("num_bits", 4), "zero_offset": 0}
+    if method in ("gptq", "awq"):
+        zero_offset = 0 if quant.get("checkpoint_format") == "gptq_v2" else 1
+        return {"format": method, "bits": bits, "zero_offset": zero_offset}
+    return {"format": None, "bits": bits, "zero_offset": 0}
+
+
+def packed_modules(checkpoint: SafetensorsCheckpoint) -> List[str]:
+    return [name[:-len(suffix)] for name in checkpoint.keys()
+            for suffix in (".qweight", ".weight_packed") if name.endswith(suffix)]
+
+
+def load_linear(checkpoint: SafetensorsCheckpoint, module: str, fmt: Dict) -> IntWeights:
+    """Read one packed Linear from a checkpoint into the canonical form."""
+    def get(suffix):
+        name = f"{module}.{suffix}"
+        return checkpoint.get_tensor(name) if name in checkpoint else None
+
+    if f"{module}.weight_packed" in checkpoint:
+        return from_compressed(get("weight_packed"), get("weight_scale"), get("weight_zero_point"),
+                               get("weight_g_idx"), get("weight_shape"), fmt["bits"])
+    if fmt["format"] == "awq":
+        return from_awq(get("qweight"), get("qzeros"), get("scales"), fmt["bits"])
+    return from_gptq(get("qweight"), get("qzeros"), get("scales"), get("g_idx"), fmt["bits"], fmt["zero_offset"])
+
+
+def validate_linear(w: IntWeights) -> List[str]:
+    """Problems that would make the dequantized weight wrong, empty if none."""
+    problems = []
+    out_features, in_features = w.shape
+    if w.scales.shape[0] != out_features or w.zeros.shape != w.scales.shape:
+        problems.append(f"scales {tuple(w.scales.shape)} / zeros {tuple(w.zeros.shape)} don't match {w.shape}")
+        return problems
+    scales = w.scales.float()
+    if not torch.isfinite(scales).all():
+        problems.append("non-finite scales")
+    if (scales <= 0).any():
+        problems.append(f"{int((scales <= 0).sum())} scales <= 0")
+    # The original GPTQ format stores zero - 1, so a zero of 2^bits is representable there
+    if w.zeros.min() < 0 or w.zeros.max() > 1 << w.bits:
+        problems.append(f"zero points outside [0, {1 << w.bits}]")
+    if w.g_idx is not None:
+        g_idx = w.g_idx.long()
+        if g_idx.shape[0] != in_features or g_idx.min() < 0 or g_idx.max() >= w.num_groups:
+            problems.append("g_idx out of range")
+        elif (torch.bincount(g_idx, minlength=w.num_groups) == 0).any():
+            problems.append("g_idx leaves groups empty")
+    return problems
+
+
+def validate(model_dir: str) -> Dict[str, List[str]]:
+    with open(os.path.join(model_dir, "config.json")) as f:
+        fmt = quantization_format(json.load(f))
+    checkpoint = SafetensorsCheckpoint(model_dir)
+    problems = {}
+    for module in packed_modules(checkpoint):
+        try:
+            w = load_linear(checkpoint, module, fmt)
+            problems[module] = validate_linear(w)
+            if not problems[module] and not torch.isfinite(w.dequantize()).all():
+                problems[module].append("non-finite dequantized weights")
+        except (ValueError, RuntimeError, TypeError, AttributeError) as e:
+            problems[module] = [f"unreadable: {e}"]
+    checkpoint.close()
+    return problems
+
+
+# Self-check and benchmarks
+
+
+def self_check(seed: int = 0) -> int:
+    """Bit-exact round trips of every layout; returns the number of failures."""
+    generator = torch.Generator().manual_seed(seed)
+    failures = 0
+
+    def check(label, ok):
+        nonlocal failures
+        failures += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {label}")
+
+    for bits in (2, 4, 8):
+        for dim in (0, 1):
+            values = torch.randint(0, 1 << bits, (64, 96), generator=generator, dtype=torch.uint8)
+            check(f"pack/unpack {bits}-bit dim {dim}", torch.equal(unpack_int32(pack_int32(values, bits, dim), bits, dim), values))
+
+    for bits, group_size, symmetric, act_order in [(4, 32, True, False), (4, 32, False, False), (4, -1, True, False),
+                                                   (4, 32, False, True), (8, 64, False, True), (2, 32, False, False)]:
+        weight = torch.randn(48, 128, generator=generator)
+        perm = torch.randperm(128, generator=generator) if act_order else None
+        w = quantize(weight, bits, group_size, symmetric, perm)
+        label = f"{bits}-bit g{group_size} {'sym' if symmetric else 'asym'}{' act-order' if act_order else ''}"
+        error = (w.dequantize() - weight).abs().max() / weight.abs().max()
+        check(f"quantize {label} max error {error:.3f}", error < 2.0 / (1 << bits))
+        if not symmetric:
+            # Zero 0 is not representable in the original GPTQ format (stored as -1)
+            w.zeros.clamp_(min=1)
+
+        gptq = to_gptq(w)
+        check(f"gptq {label}", from_gptq(**gptq, bits=bits).equal(w))
+        check(f"gptq_v2 {label}", from_gptq(**to_gptq(w, 0), bits=bits, zero_offset=0).equal(w))
+        compressed = to_compressed(w)
+        check(f"compressed-tensors {label}", from_compressed(bits=bits, **compressed).equal(w))
+        if bits == 4 and not act_order:
+            check(f"awq {label}", from_awq(**to_awq(w)).equal(w))
+        check(f"gptq -> compressed-tensors {label}",
+              torch.equal(from_compressed(bits=bits, **to_compressed(from_gptq(**gptq, bits=bits))).dequantize(),
+                          w.dequantize()))
+
+        # Dequantization against a straightforward per-element reference
+        g_idx = w.group_index()
+        reference = torch.empty(w.shape)
+        for col in range(w.shape[1]):
+            group = g_idx[col]
+            reference[:, col] = (w.q[:, col].float() - w.zeros[:, group].float()) * w.scales[:, group].float()
+        check(f"dequantize {label}", torch.equal(w.dequantize(), reference))
+
+    # Odd input size: compressed-tensors pads the packed dim and records weight_shape
+    w = quantize(torch.randn(16, 100, generator=generator), 4, 20, False)
+    check("compressed-tensors padded in_features", from_compressed(bits=4, **to_compressed(w)).equal(w))
+    return failures
+
+
+def bench(out_features: int = 4096, in_features: int = 11008, group_size: int = 128, threads: Optional[int] = None):
+    from utils.microbench import benchmark
+
+    if threads:
+        torch.set_num_threads(threads)
+    w = quantize(torch.randn(out_features, in_features), 4, group_size, symmetric=False,
+                 perm=None, scale_dtype=torch.float16)
+    w.zeros.clamp_(min=1)
+    w_act = IntWeights(w.q, w.scales, w.zeros, 4, w.group_index().to(torch.int32)[torch.randperm(in_features)])
+    gptq, awq, compressed = to_gptq(w), to_awq(w), to_compressed(w)
+    numel = out_features * in_features
+
+    cases = [
+        ("unpack gptq (int32 words along rows)", lambda: unpack_int32(gptq["qweight"], 4, 0), numel),
+        ("unpack compressed-tensors (along cols)", lambda: unpack_int32(compressed["weight_packed"], 4, 1), numel),
+        ("pack compressed-tensors", lambda: pack_int32(w.q, 4, 1), numel),
+        ("pack gptq", lambda: pack_int32(w.q.t(), 4, 0), numel),
+        ("from_gptq", lambda: from_gptq(**gptq), numel),
+        ("from_awq", lambda: from_awq(**awq), numel),
+        ("dequantize bf16 (contiguous groups)", lambda: w.dequantize(torch.bfloat16), numel),
+        ("dequantize bf16 (act-order)", lambda: w_act.dequantize(torch.bfloat16), numel),
+        ("gptq -> compressed-tensors", lambda: to_compressed(from_gptq(**gptq)), numel),
+    ]
+    print(f"[{out_features}, {in_features}] 4-bit, group size {group_size}, {torch.get_num_threads()} threads")
+    for name, fn, values in cases:
+        result = benchmark(fn, name=name, max_time=3.0, target_rel_ci=0.02)
+        # 4-bit weights: half a byte of packed input per value
+        print(f"{name:<40} {result.mean:8.2f} ms  {values / 2 / result.mean / 1e6:7.2f} GB/s packed  "
+              f"{values / result.mean / 1e6:7.2f} Gvalues/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack, unpack and validate INT2/4/8 weight layouts on CPU.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("self-check", help="Bit-exact round trips of every layout")
+    bench_parser = subparsers.add_parser("bench", help="Throughput of packing, unpacking and dequantization")
+    bench_parser.add_argument("--shape", type=int, nargs=2, default=[4096, 11008], metavar=("OUT", "IN"))
+    bench_parser.add_argument("--group-size", type=int, default=128)
+    bench_parser.add_argument("--threads", type=int, default=None)
+    validate_parser = subparsers.add_parser("validate", help="Check every packed Linear of a checkpoint")
+    validate_parser.add_argument("model_dir", type=str)
+    args = parser.parse_args()
+
+    if args.command == "self-check":
+        failures = self_check()
+        print(f"{failures} failures" if failures else "All round trips are bit exact")
+        sys.exit(1 if failures else 0)
+    elif args.command == "bench":
+        bench(*args.shape, args.group_size, args.threads)
+    else:
+        problems = validate(args.model_dir)
+        bad = {module: issues for module, issues in problems.items() if issues}
+        for module, issues in bad.items():
+            print(f"{module}: {'; '.join(issues)}")
+        print(f"{len(problems)} packed Linears checked, {len(bad)} with problems")
+        sys.exit(1 if bad else 0)
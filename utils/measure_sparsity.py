@@ -1,23 +1,48 @@
-import torch
-from transformers import AutoModelForCausalLM
+import argparse
+import os
+import sys
 
-def calculate_sparsity(model):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.safetensors_reader import SafetensorsCheckpoint
+
+
+def resolve_checkpoint(model_name):
+    # Local directory or file as is, otherwise only the safetensors files of the hub repo
+    if os.path.exists(model_name):
+        return model_name
+    from huggingface_hub import snapshot_download
+    return snapshot_download(model_name, allow_patterns=["*.safetensors", "*.json"])
+
+
+def is_linear_weight(info):
+    # Linear weights are the 2D `.weight` tensors apart from the embeddings
+    return len(info.shape) == 2 and info.name.endswith(".weight") and "embed" not in info.name
+
+
+def calculate_sparsity(checkpoint, read_ahead=4):
     sparsity_dict = {}
-    for name, module in model.named_modules():
-        if isinstance(module, torch.nn.Linear):
-            # Calculate sparsity: the fraction of elements that are exactly zero
-            total_elements = module.weight.nelement()
-            zero_elements = (module.weight == 0).sum().item()
-            sparsity = zero_elements / total_elements
-            print(name, total_elements)
-            sparsity_dict[name] = sparsity
+    # Weights are streamed in on-disk order straight from the mmapped shards,
+    # so only `read_ahead` tensors are in memory at any time
+    for name, weight in checkpoint.iter_tensors(filter=is_linear_weight, read_ahead=read_ahead):
+        # Calculate sparsity: the fraction of elements that are exactly zero
+        total_elements = weight.nelement()
+        zero_elements = (weight == 0).sum().item()
+        sparsity_dict[name[:-len(".weight")]] = zero_elements / total_elements
     return sparsity_dict
 
 
-model_name = 'nm-testing/OpenHermes-2.5-Mistral-7B-pruned50'
-model = AutoModelForCausalLM.from_pretrained(model_name)
-sparsity_dict = calculate_sparsity(model)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fraction of exactly-zero weights per Linear layer.")
+    parser.add_argument("model", nargs="?", default="nm-testing/OpenHermes-2.5-Mistral-7B-pruned50",
+                        help="Hub model id or local safetensors checkpoint")
+    parser.add_argument("--read-ahead", type=int, default=4)
+    args = parser.parse_args()
+
+    with SafetensorsCheckpoint(resolve_checkpoint(args.model)) as checkpoint:
+        sparsity_dict = calculate_sparsity(checkpoint, args.read_ahead)
 
-# Print the sparsity of each Linear module
-for name, sparsity in sparsity_dict.items():
-    print(f"{name}: {sparsity:.2%}")
+    # Print the sparsity of each Linear module
+    for name, sparsity in sparsity_dict.items():
+        print(f"{name}: {sparsity:.2%}")
+    total = sum(sparsity_dict.values()) / max(len(sparsity_dict), 1)
+    print(f"Mean over {len(sparsity_dict)} layers: {total:.2%}")
@@ -0,0 +1,265 @@
+"""
+Statistical micro-benchmark harness shared by the benchmark scripts in this repo.
+
+Instead of timing a fixed number of calls, `benchmark` keeps sampling until the 95%
+confidence interval of the mean is within `target_rel_ci` of the mean (or a run/time
+budget runs out), optionally with the garbage collector disabled and after a warmup
+phase. Results carry the raw samples so that speedups can be reported as bootstrap
+ratios with a confidence interval, and saved runs from two library versions can be
+compared to flag regressions automatically:
+
+    from utils.microbench import benchmark, bootstrap_speedup, save_results
+
+    base = benchmark(lambda: slow(x), name="slow")
+    new = benchmark(lambda: fast(x), name="fast")
+    print(bootstrap_speedup(base, new))
+    save_results("bench.json", [base, new])
+
+    python utils/microbench.py old.json new.json --threshold 0.05
+"""
+import argparse
+import gc
+import json
+import math
+import platform
+import random
+import statistics
+import sys
+import time
+from dataclasses import dataclass, field
+from importlib import metadata as importlib_metadata
+from typing import Callable, Dict, List, Optional
+
+# Two-sided 95% Student t quantiles for small sample sizes, normal approximation above
+_T95 = {2: 12.706, 3: 4.303, 4: 3.182, 5: 2.776, 6: 2.571, 7: 2.447, 8: 2.365, 9: 2.306,
+        10: 2.262, 15: 2.145, 20: 2.093, 30: 2.045, 60: 2.001}
+
+
+def _t95(n: int) -> float:
+    """
+    t quantile for n samples, linear in 1/df between the tabulated sizes (and 1.96 at
+    df = inf past them). t is convex in 1/df, so between table entries this errs wide.
+    """
+    sizes = sorted(_T95)
+    if n <= sizes[0]:
+        return _T95[sizes[0]]
+    lower = max(size for size in sizes if size <= n)
+    upper = min((size for size in sizes if size > n), default=None)
+    x, x0, y0 = 1 / (n - 1), 1 / (lower - 1), _T95[lower]
+    x1, y1 = (0.0, 1.96) if upper is None else (1 / (upper - 1), _T95[upper])
+    return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+
+
+def percentile(sorted_samples: List[float], q: float) -> float:
+    """Linear-interpolated percentile of already sorted samples, q in [0, 100]."""
+    if not sorted_samples:
+        return float("nan")
+    pos = (len(sorted_samples) - 1) * q / 100
+    lo, hi = math.floor(pos), math.ceil(pos)
+    return sorted_samples[lo] + (sorted_samples[hi] - sorted_samples[lo]) * (pos - lo)
+
+
+@dataclass
+class BenchResult:
+    name: str
+    samples: List[float]  # milliseconds per call
+    metadata: Dict = field(default_factory=dict)
+
+    @property
+    def mean(self) -> float:
+        return statistics.fmean(self.samples)
+
+    @property
+    def stdev(self) -> float:
+        return statistics.stdev(self.samples) if len(self.samples) > 1 else 0.0
+
+    @property
+    def ci95(self) -> float:
+        """Half-width of the 95% confidence interval of the mean."""
+        n = len(self.samples)
+        return _t95(n) * self.stdev / math.sqrt(n) if n > 1 else float("inf")
+
+    def summary(self) -> Dict[str, float]:
+        s = sorted(self.samples)
+        return {
+            "runs": len(s),
+            "mean": self.mean,
+            "ci95": self.ci95,
+            "stdev": self.stdev,
+            "min": s[0],
+            "p50": percentile(s, 50),
+            "p90": percentile(s, 90),
+            "p99": percentile(s, 99),
+            "max": s[-1],
+        }
+
+
+def benchmark(fn: Callable[[], object], name: str = "", warmup: int = 5, warmup_time: float = 0.0,
+              min_runs: int = 10, max_runs: int = 10000, max_time: float = 10.0,
+              target_rel_ci: float = 0.01, disable_gc: bool = True,
+              sync: Optional[Callable[[], None]] = None, metadata: Optional[Dict] = None) -> BenchResult:
+    """
+    Time `fn()` adaptively. Stops once the 95% CI half-width is below `target_rel_ci` of
+    the mean and at least `min_runs` samples exist, or when `max_runs`/`max_time` is hit.
+    `sync` is called before each clock read, e.g. `torch.cuda.synchronize` for GPU work.
+    """
+    sync = sync or (lambda: None)
+
+    start = time.perf_counter()
+    for _ in range(warmup):
+        fn()
+    while time.perf_counter() - start < warmup_time:
+        fn()
+    sync()
+
+    gc_was_enabled = gc.isenabled()
+    if disable_gc:
+        gc.collect()
+        gc.disable()
+    samples = []
+    try:
+        start = time.perf_counter()
+        # Check convergence on a geometric schedule so the check itself stays cheap
+        next_check = min_runs
+        while len(samples) < max_runs:
+            t0 = time.perf_counter()
+            fn()
+            sync()
+            samples.append((time.perf_counter() - t0) * 1000)
+            if len(samples) >= next_check:
+                result = BenchResult(name, samples)
+                if result.ci95 <= target_rel_ci * result.mean:
+                    break
+                elapsed = time.perf_counter() - start
+                if elapsed > max_time:
+                    break
+                # The next round may not run past max_time at the current time per run
+                remaining_runs = int((max_time - elapsed) / (elapsed / len(samples))) + 1
+                next_check = min(max_runs, int(next_check * 1.5) + 1, len(samples) + remaining_runs)
+    finally:
+        if disable_gc and gc_was_enabled:
+            gc.enable()
+
+    meta = {"disable_gc": disable_gc, "target_rel_ci": target_rel_ci}
+    meta.update(metadata or {})
+    return BenchResult(name, samples, meta)
+
+
+def bootstrap_speedup(baseline: BenchResult, candidate: BenchResult, num_resamples: int = 2000,
+                      stat: Callable[[List[float]], float] = statistics.median,
+                      seed: int = 0) -> Dict[str, float]:
+    """
+    Speedup of `candidate` over `baseline` (baseline_stat / candidate_stat) with a
+    95% percentile-bootstrap confidence interval.
+    """
+    rng = random.Random(seed)
+    ratios = []
+    for _ in range(num_resamples):
+        b = rng.choices(baseline.samples, k=len(baseline.samples))
+        c = rng.choices(candidate.samples, k=len(candidate.samples))
+        ratios.append(stat(b) / stat(c))
+    ratios.sort()
+    return {
+        "speedup": stat(baseline.samples) / stat(candidate.samples),
+        "ci_low": percentile(ratios, 2.5),
+        "ci_high": percentile(ratios, 97.5),
+    }
+
+
+def print_result(result: BenchResult):
+    s = result.summary()
+    print(f"\n{'-' * 50}")
+    print(f"{result.name} Statistics (milliseconds, {s['runs']} runs):")
+    print(f"{'Mean:':>15} {s['mean']:.3f} ± {s['ci95']:.3f}")
+    print(f"{'Std Dev:':>15} {s['stdev']:.3f}")
+    for key in ["min", "p50", "p90", "p99", "max"]:
+        print(f"{key.capitalize() + ':':>15} {s[key]:.3f}")
+
+
+def print_speedup(baseline: BenchResult, candidate: BenchResult):
+    r = bootstrap_speedup(baseline, candidate)
+    print(f"{candidate.name} vs {baseline.name} speedup: "
+          f"{r['speedup']:.2f}x (95% CI {r['ci_low']:.2f}x - {r['ci_high']:.2f}x)")
+
+
+def environment_info(packages=("torch", "transformers", "numpy", "vllm", "pillow",
+                                "safetensors", "flashinfer-python")) -> Dict[str, str]:
+    """Versions of the interpreter and of whichever of `packages` are installed."""
+    info = {"python": platform.python_version(), "platform": platform.platform()}
+    for pkg in packages:
+        try:
+            info[pkg] = importlib_metadata.version(pkg)
+        except importlib_metadata.PackageNotFoundError:
+            continue
+    return info
+
+
+def save_results(path: str, results: List[BenchResult], metadata: Optional[Dict] = None):
+    """Write results with raw samples and environment info to a JSON file."""
+    data = {
+        "environment": environment_info(),
+        "metadata": metadata or {},
+        "results": {r.name: {"summary": r.summary(), "samples": r.samples, "metadata": r.metadata}
+                    for r in results},
+    }
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def load_results(path: str) -> Dict[str, BenchResult]:
+    with open(path) as f:
+        data = json.load(f)
+    return {name: BenchResult(name, r["samples"], r.get("metadata", {}))
+            for name, r in data["results"].items()}
+
+
+def compare_results(old: Dict[str, BenchResult], new: Dict[str, BenchResult],
+                    threshold: float = 0.05) -> List[Dict]:
+    """
+    Compare benchmarks present in both runs. A benchmark is a regression when even the
+    upper end of the bootstrap CI of old/new is below 1 - threshold, i.e. it got slower
+    by more than `threshold` with 95% confidence; an improvement is the mirror case.
+    """
+    rows = []
+    for name in old:
+        if name not in new:
+            continue
+        r = bootstrap_speedup(old[name], new[name])
+        if r["ci_high"] < 1 - threshold:
+            verdict = "REGRESSION"
+        elif r["ci_low"] > 1 + threshold:
+            verdict = "improvement"
+        else:
+            verdict = "unchanged"
+        rows.append({"name": name, "old_p50": statistics.median(old[name].samples),
+                     "new_p50": statistics.median(new[name].samples), **r, "verdict": verdict})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two saved micro-benchmark result files.")
+    parser.add_argument("old", help="Baseline results JSON")
+    parser.add_argument("new", help="Candidate results JSON")
+    parser.add_argument("--threshold", type=float, default=0.05,
+                        help="Relative slowdown tolerated before flagging a regression")
+    args = parser.parse_args()
+
+    with open(args.old) as f_old, open(args.new) as f_new:
+        env_old, env_new = json.load(f_old)["environment"], json.load(f_new)["environment"]
+    for key in sorted(set(env_old) | set(env_new)):
+        if env_old.get(key) != env_new.get(key):
+            print(f"{key}: {env_old.get(key)} -> {env_new.get(key)}")
+
+    rows = compare_results(load_results(args.old), load_results(args.new), args.threshold)
+    width = max([len(r["name"]) for r in rows] + [9])
+    print(f"{'Benchmark':<{width}} | {'old p50':>9} | {'new p50':>9} | {'speedup':>8} | {'95% CI':>13} | verdict")
+    for r in rows:
+        ci = f"{r['ci_low']:.2f}-{r['ci_high']:.2f}x"
+        print(f"{r['name']:<{width}} | {r['old_p50']:>9.3f} | {r['new_p50']:>9.3f} | "
+              f"{r['speedup']:>7.2f}x | {ci:>13} | {r['verdict']}")
+    if any(r["verdict"] == "REGRESSION" for r in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
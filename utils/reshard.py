@@ -0,0 +1,295 @@
+"""
+Rewrite a safetensors checkpoint into layer-ordered shards, optionally pre-split per
+tensor-parallel rank.
+
+Tensors are ordered embeddings, layer 0 (norms, attention, MLP), layer 1, ..., final norm
+and lm_head, and shards are cut at layer boundaries whenever a layer fits, so loading
+walks the files front to back and one layer never spans more shards than necessary.
+
+With `--tp N` every rank gets its own files holding only its slices:
+  column parallel (split outputs, dim 0)  q_proj, k_proj, v_proj, gate_proj, up_proj,
+                                          embed_tokens, lm_head (by vocab rows)
+  row parallel (split inputs, dim 1)      o_proj, down_proj
+  replicated                              norms, biases of row-parallel layers, scalar scales
+q/k/v are split on head boundaries; with fewer KV heads than ranks, each KV head is
+replicated on the ranks that share it. Per-output-channel and block scales follow their
+weight; per-tensor scales are replicated.
+`model.safetensors.tp{N}.index.json` lists every rank's weight_map and, per tensor, the
+split dim and the [start, end) range each rank holds, so rank r can mmap exactly its own
+bytes sequentially.
+
+    python utils/reshard.py /path/to/model /path/to/model-resharded --max-shard-size 2GB
+    python utils/reshard.py /path/to/model /path/to/model-tp4 --tp 4
+"""
+import argparse
+import json
+import math
+import os
+import re
+import shutil
+import sys
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from safetensors.torch import save_file
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.safetensors_reader import INDEX_NAME, SafetensorsCheckpoint, TensorInfo
+
+LAYER_RE = re.compile(r"\.layers\.(\d+)\.")
+
+# Order of submodules inside a decoder layer, matching the forward pass
+SUBMODULE_ORDER = ["input_layernorm", "self_attn.q_proj", "self_attn.k_proj", "self_attn.v_proj",
+                   "self_attn.q_norm", "self_attn.k_norm", "self_attn.o_proj", "post_attention_layernorm",
+                   "mlp.gate_proj", "mlp.up_proj", "mlp.down_proj"]
+
+COLUMN_PARALLEL = ("self_attn.q_proj", "self_attn.k_proj", "self_attn.v_proj", "mlp.gate_proj", "mlp.up_proj")
+ROW_PARALLEL = ("self_attn.o_proj", "mlp.down_proj")
+VOCAB_PARALLEL = ("embed_tokens", "lm_head")
+
+PACKED_SUFFIXES = (".qweight", ".qzeros", ".weight_packed", ".g_idx")
+
+
+def parse_size(size: str) -> int:
+    units = {"KB": 10**3, "MB": 10**6, "GB": 10**9, "KIB": 2**10, "MIB": 2**20, "GIB": 2**30}
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMG]I?B)?\s*", size.upper())
+    if match is None:
+        raise ValueError(f"Can't parse size {size!r}, expected e.g. 5GB or 500MiB")
+    return int(float(match.group(1)) * units.get(match.group(2) or "", 1))
+
+
+def layer_order_key(name: str) -> Tuple:
+    """Sort key: embeddings, then layers in forward order, then everything after the last layer."""
+    match = LAYER_RE.search(name)
+    if match is None:
+        if "embed_tokens" in name:
+            return (0, 0, 0, name)
+        return (2, 0, 0, name)
+    rest = name[match.end():]
+    position = next((i for i, sub in enumerate(SUBMODULE_ORDER) if rest.startswith(sub + ".")), len(SUBMODULE_ORDER))
+    return (1, int(match.group(1)), position, name)
+
+
+def layer_of(name: str) -> Optional[int]:
+    match = LAYER_RE.search(name)
+    return int(match.group(1)) if match else None
+
+
+def plan_shards(infos: List[TensorInfo], max_shard_size: int, out_bytes=lambda info: info.nbytes) -> List[List[TensorInfo]]:
+    """
+    Group tensors (already in layer order) into shards of at most `max_shard_size`,
+    starting a new shard at a layer boundary when the next layer would not fit.
+    """
+    groups = []
+    for info in infos:
+        if groups and layer_of(groups[-1][-1].name) == layer_of(info.name):
+            groups[-1].append(info)
+        else:
+            groups.append([info])
+
+    shards, size = [[]], 0
+    for group in groups:
+        group_size = sum(out_bytes(info) for info in group)
+        if shards[-1] and size + group_size > max_shard_size:
+            shards.append([])
+            size = 0
+        for info in group:
+            # A layer larger than a whole shard is split at tensor boundaries
+            if shards[-1] and size + out_bytes(info) > max_shard_size:
+                shards.append([])
+                size = 0
+            shards[-1].append(info)
+            size += out_bytes(info)
+    return [shard for shard in shards if shard]
+
+
+class TPSplitter:
+    """Which slice of each tensor a tensor-parallel rank holds."""
+
+    def __init__(self, config: Dict, tp: int):
+        self.tp = tp
+        self.num_heads = config["num_attention_heads"]
+        self.num_kv_heads = config.get("num_key_value_heads") or self.num_heads
+        self.head_dim = config.get("head_dim") or config["hidden_size"] // self.num_heads
+        if self.num_heads % tp:
+            raise ValueError(f"{self.num_heads} attention heads can't be split across {tp} ranks")
+        if self.num_kv_heads % tp and tp % self.num_kv_heads:
+            raise ValueError(f"{self.num_kv_heads} KV heads can't be split or replicated across {tp} ranks")
+
+    def _module_kind(self, name: str) -> Optional[str]:
+        module = name.rsplit(".", 1)[0]
+        if any(module.endswith(m) for m in COLUMN_PARALLEL):
+            return "column"
+        if any(module.endswith(m) for m in ROW_PARALLEL):
+            return "row"
+        if any(module.endswith(m) for m in VOCAB_PARALLEL):
+            return "vocab"
+        return None
+
+    def split(self, name: str, shape: Tuple[int, ...]) -> Tuple[Optional[int], List[Tuple[int, int]]]:
+        """(split dim or None if replicated, [start, end) per rank)."""
+        if name.endswith(PACKED_SUFFIXES):
+            raise ValueError(f"{name}: packed quantized tensors can't be pre-split, reshard without --tp")
+        kind = self._module_kind(name)
+        suffix = name.rsplit(".", 1)[1]
+        full = [(0, shape[0] if shape else 0)] * self.tp
+        # Per-tensor scales, whether stored as (), (1,) or (1, 1), are the same on every rank
+        if kind is None or len(shape) == 0 or math.prod(shape) == 1 or suffix == "input_scale":
+            return None, full
+
+        if kind == "row":
+            # Inputs are split; the bias and per-output-channel scales stay whole on every rank.
+            # Block scales ([out / block, in / block]) follow the weight's split of the inputs
+            if len(shape) == 2 and (suffix == "weight" or shape[1] > 1):
+                return 1, self._even_split(name, shape[1])
+            return None, full
+
+        rows = shape[0]
+        if rows == 1:
+            return None, full
+        if kind == "vocab":
+            step = -(-rows // self.tp)
+            return 0, [(min(r * step, rows), min((r + 1) * step, rows)) for r in range(self.tp)]
+        if name.rsplit(".", 2)[-2] in ("k_proj", "v_proj") and self.num_kv_heads < self.tp:
+            # Each KV head lives on tp / num_kv_heads ranks
+            if rows % self.num_kv_heads:
+                raise ValueError(f"{name}: {rows} rows don't split into {self.num_kv_heads} KV heads, "
+                                 f"block scales coarser than a head can't be pre-split")
+            per_head = rows // self.num_kv_heads
+            share = self.tp // self.num_kv_heads
+            return 0, [((r // share) * per_head, (r // share + 1) * per_head) for r in range(self.tp)]
+        return 0, self._even_split(name, rows)
+
+    def _even_split(self, name: str, size: int) -> List[Tuple[int, int]]:
+        if size % self.tp:
+            raise ValueError(f"{name}: dimension of size {size} can't be split evenly across {self.tp} ranks")
+        step = size // self.tp
+        return [(r * step, (r + 1) * step) for r in range(self.tp)]
+
+
+def _slice(tensor: torch.Tensor, dim: Optional[int], start: int, end: int) -> torch.Tensor:
+    if dim is None:
+        return tensor
+    return tensor.narrow(dim, start, end - start).contiguous()
+
+
+def _copy_side_files(model_dir: str, output_dir: str):
+    for filename in os.listdir(model_dir):
+        src = os.path.join(model_dir, filename)
+        if filename.endswith(".safetensors") or filename.startswith("model.safetensors.") or not os.path.isfile(src):
+            continue
+        shutil.copy2(src, os.path.join(output_dir, filename))
+
+
+def reshard(model_dir: str, output_dir: str, max_shard_size: int = 5 * 10**9, dtype: Optional[torch.dtype] = None,
+            read_ahead: int = 8):
+    """Layer-ordered shards with a standard index; `dtype` casts floating point tensors on the way."""
+    checkpoint = SafetensorsCheckpoint(model_dir)
+    infos = sorted(checkpoint.infos(), key=lambda info: layer_order_key(info.name))
+
+    def out_bytes(info):
+        if dtype is not None and info.torch_dtype.is_floating_point and info.torch_dtype.itemsize > 1:
+            return info.numel * dtype.itemsize
+        return info.nbytes
+
+    shards = plan_shards(infos, max_shard_size, out_bytes)
+    os.makedirs(output_dir, exist_ok=True)
+    weight_map = {}
+    for i, shard in enumerate(shards):
+        filename = f"model-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+        tensors = {}
+        names = [info.name for info in shard]
+        loaded = dict(checkpoint.iter_tensors(names=names, read_ahead=read_ahead))
+        for name in names:
+            tensor = loaded[name]
+            if dtype is not None and tensor.is_floating_point() and tensor.element_size() > 1:
+                tensor = tensor.to(dtype)
+            tensors[name] = tensor
+            weight_map[name] = filename
+        save_file(tensors, os.path.join(output_dir, filename), metadata=checkpoint.metadata() or {"format": "pt"})
+        print(f"Wrote {filename} ({len(tensors)} tensors)")
+    checkpoint.close()
+
+    _copy_side_files(model_dir, output_dir)
+    with open(os.path.join(output_dir, INDEX_NAME), "w") as f:
+        json.dump({"metadata": {"total_size": sum(out_bytes(info) for info in infos)},
+                   "weight_map": weight_map}, f, indent=2)
+    return weight_map
+
+
+def reshard_tp(model_dir: str, output_dir: str, tp: int, max_shard_size: int = 5 * 10**9, read_ahead: int = 8):
+    """Per-rank layer-ordered shards plus `model.safetensors.tp{N}.index.json` describing the slices."""
+    with open(os.path.join(model_dir, "config.json")) as f:
+        config = json.load(f)
+    splitter = TPSplitter({**config, **config.get("text_config", {})}, tp)
+    checkpoint = SafetensorsCheckpoint(model_dir)
+    infos = sorted(checkpoint.infos(), key=lambda info: layer_order_key(info.name))
+
+    layout = {}
+    for info in infos:
+        dim, ranges = splitter.split(info.name, info.shape)
+        layout[info.name] = {"split_dim": dim, "ranges": ranges if dim is not None else None}
+
+    def rank_bytes(info):
+        entry = layout[info.name]
+        if entry["split_dim"] is None:
+            return info.nbytes
+        start, end = entry["ranges"][0]
+        return info.nbytes * (end - start) // info.shape[entry["split_dim"]]
+
+    # Every rank gets the same tensors in the same order, so one plan serves all ranks
+    shards = plan_shards(infos, max_shard_size, rank_bytes)
+    os.makedirs(output_dir, exist_ok=True)
+    rank_maps = [{} for _ in range(tp)]
+    rank_sizes = [0] * tp
+    for i, shard in enumerate(shards):
+        names = [info.name for info in shard]
+        for name in names[:read_ahead]:
+            checkpoint.prefetch(name)
+        # One rank at a time from zero-copy views, so only that rank's slices are ever held in
+        # memory; after the first rank the shard's pages come from the page cache
+        for rank in range(tp):
+            tensors = {}
+            for j, (name, tensor) in enumerate(checkpoint.iter_tensors(names=names)):
+                if rank == 0 and j + read_ahead < len(names):
+                    checkpoint.prefetch(names[j + read_ahead])
+                entry = layout[name]
+                start, end = entry["ranges"][rank] if entry["split_dim"] is not None else (0, 0)
+                tensors[name] = _slice(tensor, entry["split_dim"], start, end)
+            filename = f"model-tp{tp}-rank{rank}-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+            save_file(tensors, os.path.join(output_dir, filename), metadata={"format": "pt"})
+            rank_maps[rank].update(dict.fromkeys(tensors, filename))
+            rank_sizes[rank] += sum(t.numel() * t.element_size() for t in tensors.values())
+            del tensors
+        print(f"Wrote part {i + 1}/{len(shards)} for {tp} ranks")
+    checkpoint.close()
+
+    _copy_side_files(model_dir, output_dir)
+    index = {
+        "metadata": {"tensor_parallel_size": tp, "total_size": sum(rank_sizes), "rank_sizes": rank_sizes},
+        "ranks": [{"weight_map": weight_map} for weight_map in rank_maps],
+        "layout": layout,
+    }
+    with open(os.path.join(output_dir, f"model.safetensors.tp{tp}.index.json"), "w") as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reshard a safetensors checkpoint in layer order, optionally per TP rank.")
+    parser.add_argument("model_dir", type=str)
+    parser.add_argument("output_dir", type=str)
+    parser.add_argument("--max-shard-size", type=str, default="5GB", help="Per-file limit, e.g. 5GB or 2GiB")
+    parser.add_argument("--tp", type=int, default=None, help="Pre-split the weights for this tensor-parallel size")
+    parser.add_argument("--dtype", choices=["bfloat16", "float16", "float32"], default=None,
+                        help="Cast floating point tensors while resharding (not with --tp)")
+    parser.add_argument("--read-ahead", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.tp:
+        if args.dtype:
+            parser.error("--dtype can't be combined with --tp")
+        reshard_tp(args.model_dir, args.output_dir, args.tp, parse_size(args.max_shard_size), args.read_ahead)
+    else:
+        reshard(args.model_dir, args.output_dir, parse_size(args.max_shard_size),
+                getattr(torch, args.dtype) if args.dtype else None, args.read_ahead)
@@ -0,0 +1,259 @@
+"""
+Lazy reader for safetensors checkpoints: a single file, a directory of shards with or
+without `model.safetensors.index.json`.
+
+  - only headers are parsed up front; names, dtypes, shapes and byte ranges come from there
+  - every shard is mmapped once and tensors are zero-copy views into the mapping, so
+    nothing is read from disk until the tensor is touched
+  - `iter_tensors` walks the checkpoint in on-disk order (shard by shard, by offset) for
+    sequential I/O, optionally casting, and can materialize the next `read_ahead` tensors
+    on a thread pool while the caller works on the current one
+
+    ckpt = SafetensorsCheckpoint("/path/to/model")
+    print(len(ckpt), ckpt.total_bytes, ckpt.info("lm_head.weight"))
+    for name, tensor in ckpt.iter_tensors(dtype=torch.float32, read_ahead=4):
+        ...
+
+Views share memory with a private copy-on-write mapping: writing to them never touches
+the file, but copy (or cast) anything that has to outlive the checkpoint object.
+"""
+import json
+import mmap
+import os
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import torch
+
+INDEX_NAME = "model.safetensors.index.json"
+
+DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+    "F8_E4M3": torch.float8_e4m3fn,
+    "F8_E5M2": torch.float8_e5m2,
+}
+for _name in ("U16", "U32", "U64"):
+    if hasattr(torch, _name.replace("U", "uint")):
+        DTYPES[_name] = getattr(torch, _name.replace("U", "uint"))
+DTYPE_NAMES = {dtype: name for name, dtype in DTYPES.items()}
+
+
+@dataclass
+class TensorInfo:
+    name: str
+    shard: str  # path of the shard file
+    dtype: str  # safetensors dtype string, e.g. "BF16"
+    shape: Tuple[int, ...]
+    start: int  # absolute byte offsets in the shard file
+    end: int
+
+    @property
+    def nbytes(self) -> int:
+        return self.end - self.start
+
+    @property
+    def numel(self) -> int:
+        n = 1
+        for dim in self.shape:
+            n *= dim
+        return n
+
+    @property
+    def torch_dtype(self) -> torch.dtype:
+        return DTYPES[self.dtype]
+
+
+def read_header(path: str) -> Tuple[Dict[str, TensorInfo], Dict[str, str]]:
+    """Parse only the JSON header of a shard: tensor infos by name and the `__metadata__` dict."""
+    with open(path, "rb") as f:
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+    data_start = 8 + header_len
+    metadata = header.pop("__metadata__", None) or {}
+    infos = {}
+    for name, entry in header.items():
+        begin, end = entry["data_offsets"]
+        infos[name] = TensorInfo(name, path, entry["dtype"], tuple(entry["shape"]),
+                                 data_start + begin, data_start + end)
+    return infos, metadata
+
+
+def find_shards(path: str) -> Tuple[str, List[str], Optional[Dict[str, str]]]:
+    """(directory, shard file names, weight_map from the index or None) for a file or directory."""
+    if os.path.isfile(path):
+        return os.path.dirname(path) or ".", [os.path.basename(path)], None
+    index_path = os.path.join(path, INDEX_NAME)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            weight_map = json.load(f)["weight_map"]
+        return path, sorted(set(weight_map.values())), weight_map
+    shards = sorted(f for f in os.listdir(path) if f.endswith(".safetensors"))
+    if not shards:
+        raise FileNotFoundError(f"No .safetensors files in {path}")
+    return path, shards, None
+
+
+class SafetensorsCheckpoint:
+    def __init__(self, path: str):
+        self.path = path
+        self.directory, self.shards, index_map = find_shards(path)
+        self._headers: Dict[str, Dict[str, TensorInfo]] = {}
+        self._metadata: Dict[str, Dict[str, str]] = {}
+        self._maps: Dict[str, mmap.mmap] = {}
+        if index_map is not None:
+            # The index is enough for name -> shard; headers are parsed when first needed
+            self.weight_map = dict(index_map)
+        else:
+            self.weight_map = {}
+            for shard in self.shards:
+                self.weight_map.update(dict.fromkeys(self._header(shard), shard))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.weight_map)
+
+    def __contains__(self, name: str):
+        return name in self.weight_map
+
+    def keys(self) -> List[str]:
+        return list(self.weight_map)
+
+    def _header(self, shard: str) -> Dict[str, TensorInfo]:
+        if shard not in self._headers:
+            infos, metadata = read_header(os.path.join(self.directory, shard))
+            self._headers[shard] = infos
+            self._metadata[shard] = metadata
+        return self._headers[shard]
+
+    def info(self, name: str) -> TensorInfo:
+        if name not in self.weight_map:
+            raise KeyError(f"{name} not found in {self.path}")
+        return self._header(self.weight_map[name])[name]
+
+    def infos(self, shard: Optional[str] = None) -> List[TensorInfo]:
+        """Tensor infos in on-disk order, for one shard or the whole checkpoint."""
+        shards = [shard] if shard is not None else self.shards
+        result = []
+        for s in shards:
+            result.extend(sorted(self._header(s).values(), key=lambda info: info.start))
+        return result
+
+    def metadata(self, shard: Optional[str] = None) -> Dict[str, str]:
+        shard = shard if shard is not None else self.shards[0]
+        self._header(shard)
+        return self._metadata[shard]
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(info.nbytes for info in self.infos())
+
+    def _map(self, path: str) -> mmap.mmap:
+        if path not in self._maps:
+            with open(path, "rb") as f:
+                # ACCESS_COPY gives writable (private) pages, which torch.frombuffer wants
+                self._maps[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        return self._maps[path]
+
+    def _view(self, info: TensorInfo) -> torch.Tensor:
+        dtype = info.torch_dtype
+        if info.nbytes == 0:
+            return torch.empty(info.shape, dtype=dtype)
+        raw = torch.frombuffer(self._map(info.shard), dtype=torch.uint8, count=info.nbytes, offset=info.start)
+        if info.start % dtype.itemsize:
+            # Misaligned for the element type: has to be copied to be reinterpreted
+            raw = raw.clone()
+        return raw.view(dtype).view(info.shape)
+
+    def get_tensor(self, name: str, dtype: Optional[torch.dtype] = None, copy: bool = False) -> torch.Tensor:
+        """Zero-copy view of a tensor; cast to `dtype` and/or copied into owned memory if asked."""
+        tensor = self._view(self.info(name))
+        if dtype is not None and dtype != tensor.dtype:
+            return tensor.to(dtype)
+        return tensor.clone() if copy else tensor
+
+    def buffer(self, name: str) -> memoryview:
+        """The raw bytes of a tensor as a zero-copy memoryview, e.g. for hashing."""
+        info = self.info(name)
+        return memoryview(self._map(info.shard))[info.start:info.end]
+
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        """All tensors as zero-copy views, e.g. for `load_state_dict(..., assign=True)`."""
+        return {info.name: self._view(info) for info in self.infos()}
+
+    def prefetch(self, name: str):
+        """Ask the kernel to start reading a tensor's pages in the background."""
+        info = self.info(name)
+        mm = self._map(info.shard)
+        if hasattr(mm, "madvise") and info.nbytes:
+            start = info.start - info.start % mmap.PAGESIZE
+            mm.madvise(mmap.MADV_WILLNEED, start, info.end - start)
+
+    def iter_tensors(self, names: Optional[Iterable[str]] = None, dtype: Optional[torch.dtype] = None,
+                     filter: Optional[Callable[[TensorInfo], bool]] = None, read_ahead: int = 0,
+                     num_workers: Optional[int] = None) -> Iterator[Tuple[str, torch.Tensor]]:
+        """
+        Yield (name, tensor) in on-disk order. Without `read_ahead` the tensors are
+        zero-copy views (cast if `dtype` is given). With `read_ahead=N`, up to N upcoming
+        tensors are loaded into owned memory on `num_workers` threads, so disk reads and
+        casts overlap with the caller's work while memory stays bounded.
+        """
+        infos = self.infos()
+        if names is not None:
+            wanted = set(names)
+            missing = wanted - set(self.weight_map)
+            if missing:
+                raise KeyError(f"{sorted(missing)[:5]} not found in {self.path}")
+            infos = [info for info in infos if info.name in wanted]
+        if filter is not None:
+            infos = [info for info in infos if filter(info)]
+
+        if read_ahead <= 0:
+            for info in infos:
+                tensor = self._view(info)
+                yield info.name, tensor.to(dtype) if dtype is not None else tensor
+            return
+
+        def load(info):
+            tensor = self._view(info)
+            return tensor.to(dtype) if dtype is not None and dtype != tensor.dtype else tensor.clone()
+
+        with ThreadPoolExecutor(max_workers=num_workers or min(read_ahead, 4)) as pool:
+            pending = deque()
+            queue = iter(infos)
+            for info in queue:
+                pending.append((info.name, pool.submit(load, info)))
+                if len(pending) >= read_ahead:
+                    break
+            while pending:
+                name, future = pending.popleft()
+                tensor = future.result()
+                info = next(queue, None)
+                if info is not None:
+                    pending.append((info.name, pool.submit(load, info)))
+                yield name, tensor
+
+    def close(self):
+        for mm in self._maps.values():
+            try:
+                mm.close()
+            except BufferError:
+                # Views handed out are still alive; the mapping goes away with them
+                pass
+        self._maps = {}
@@ -0,0 +1,233 @@
+"""
+Async serving layer around vLLM's AsyncLLMEngine.
+
+Adds what a bare `engine.generate` loop is missing when it sits behind a UI:
+  - admission control: at most `max_in_flight` requests run on the engine, at most
+    `max_queued` more wait for a slot, anything beyond that is rejected immediately
+  - cancellation: if the consumer goes away (Gradio client disconnect, task cancel,
+    generator closed early) the engine request is aborted so it stops using KV cache
+  - throttled streaming: deltas are coalesced and flushed at most every
+    `stream_interval` seconds instead of re-sending the full text on every token
+
+The engine only needs `generate(prompt, sampling_params, request_id)` returning an async
+iterator of RequestOutput-like objects and `abort(request_id)`, so `FakeEngine` below can
+stand in for vLLM. Run this file directly to exercise the layer against it:
+
+    python async_serving.py --num-clients 64 --max-in-flight 8 --disconnect-frac 0.25
+"""
+import argparse
+import asyncio
+import time
+import uuid
+from dataclasses import dataclass
+
+
+class ServerBusyError(RuntimeError):
+    """Raised when both the in-flight slots and the admission queue are full."""
+
+
+@dataclass
+class ServingStats:
+    admitted: int = 0
+    rejected: int = 0
+    completed: int = 0
+    aborted: int = 0
+    in_flight: int = 0
+    queued: int = 0
+    max_in_flight_seen: int = 0
+
+
+class AsyncServer:
+    def __init__(self, engine, max_in_flight=32, max_queued=128, stream_interval=0.05):
+        self.engine = engine
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.stream_interval = stream_interval
+        self.stats = ServingStats()
+        self._slots = asyncio.Semaphore(max_in_flight)
+
+    async def _admit(self):
+        # Reject up front instead of letting the wait queue grow without bound
+        if self._slots.locked() and self.stats.queued >= self.max_queued:
+            self.stats.rejected += 1
+            raise ServerBusyError(
+                f"{self.stats.in_flight} requests in flight and {self.stats.queued} queued")
+        self.stats.queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.stats.queued -= 1
+        self.stats.admitted += 1
+        self.stats.in_flight += 1
+        self.stats.max_in_flight_seen = max(self.stats.max_in_flight_seen, self.stats.in_flight)
+
+    def _release(self):
+        self.stats.in_flight -= 1
+        self._slots.release()
+
+    async def stream_deltas(self, prompt, sampling_params, request_id=None):
+        """
+        Yield newly generated text for one request, coalesced to at most one chunk per
+        `stream_interval` seconds. Whatever is left unsent when the engine stream ends is
+        always flushed. Only a request whose last output is marked finished counts as
+        completed; anything else is aborted on the engine.
+        """
+        request_id = request_id or uuid.uuid4().hex
+        await self._admit()
+        finished = False
+        try:
+            sent = 0
+            text = ""
+            last_flush = time.perf_counter()
+            async for request_output in self.engine.generate(prompt, sampling_params, request_id):
+                text = request_output.outputs[0].text
+                finished = request_output.finished
+                now = time.perf_counter()
+                if len(text) > sent and (finished or now - last_flush >= self.stream_interval):
+                    yield text[sent:]
+                    sent = len(text)
+                    last_flush = now
+            if len(text) > sent:
+                yield text[sent:]
+        finally:
+            # Runs on normal exit, on exceptions, on task cancellation and on aclose()
+            # from a consumer that stopped iterating, which is how a disconnect shows up
+            if finished:
+                self.stats.completed += 1
+            else:
+                self.stats.aborted += 1
+                await self.engine.abort(request_id)
+            self._release()
+
+    async def stream_text(self, prompt, sampling_params, request_id=None):
+        """Same as `stream_deltas` but yields the accumulated text, as Gradio expects."""
+        text = ""
+        deltas = self.stream_deltas(prompt, sampling_params, request_id)
+        try:
+            async for delta in deltas:
+                text += delta
+                yield text
+        finally:
+            # Closing this generator must release the slot and abort the request right away,
+            # not whenever the inner generator gets garbage collected
+            await deltas.aclose()
+
+
+@dataclass
+class _FakeCompletion:
+    text: str
+
+
+@dataclass
+class _FakeRequestOutput:
+    request_id: str
+    outputs: list
+    finished: bool
+
+
+class FakeEngine:
+    """
+    Minimal stand-in for AsyncLLMEngine: emits one word per `token_latency` seconds and
+    records which requests were aborted. `sampling_params` only needs `max_tokens`.
+    """
+
+    def __init__(self, token_latency=0.002):
+        self.token_latency = token_latency
+        self.running = set()
+        self.aborted = set()
+        self.max_running = 0
+
+    async def generate(self, prompt, sampling_params, request_id):
+        self.running.add(request_id)
+        self.max_running = max(self.max_running, len(self.running))
+        try:
+            text = ""
+            max_tokens = sampling_params.max_tokens
+            for i in range(max_tokens):
+                if request_id in self.aborted:
+                    return
+                await asyncio.sleep(self.token_latency)
+                text += f" tok{i}"
+                yield _FakeRequestOutput(request_id, [_FakeCompletion(text)], i == max_tokens - 1)
+        finally:
+            self.running.discard(request_id)
+
+    async def abort(self, request_id):
+        self.aborted.add(request_id)
+        self.running.discard(request_id)
+
+
+@dataclass
+class _FakeSamplingParams:
+    max_tokens: int = 100
+
+
+async def run_fake_load(num_clients, max_in_flight, max_queued, disconnect_frac,
+                        max_tokens=100, token_latency=0.002, stream_interval=0.02):
+    """
+    Drive an AsyncServer backed by FakeEngine with concurrent clients, a fraction of which
+    disconnect halfway through, and check the invariants the layer is supposed to keep.
+    """
+    engine = FakeEngine(token_latency=token_latency)
+    server = AsyncServer(engine, max_in_flight=max_in_flight, max_queued=max_queued,
+                         stream_interval=stream_interval)
+    params = _FakeSamplingParams(max_tokens=max_tokens)
+    chunk_counts = []
+
+    async def client(i):
+        request_id = f"req-{i}"
+        # Spread disconnecting clients evenly over arrival order
+        disconnect = int((i + 1) * disconnect_frac) > int(i * disconnect_frac)
+        chunks, text = 0, ""
+        stream = server.stream_text(f"prompt {i}", params, request_id)
+        try:
+            async for text in stream:
+                chunks += 1
+                if disconnect and chunks >= 2:
+                    break
+        except ServerBusyError:
+            return "rejected"
+        finally:
+            await stream.aclose()
+        if not disconnect:
+            assert text == "".join(f" tok{t}" for t in range(max_tokens)), f"{request_id} lost trailing text"
+        chunk_counts.append(chunks)
+        return "disconnected" if disconnect else "completed"
+
+    start = time.perf_counter()
+    outcomes = await asyncio.gather(*(client(i) for i in range(num_clients)))
+    elapsed = time.perf_counter() - start
+
+    assert engine.max_running <= max_in_flight, (engine.max_running, max_in_flight)
+    assert not engine.running, f"requests left running on the engine: {engine.running}"
+    assert server.stats.in_flight == 0 and server.stats.queued == 0
+    assert len(engine.aborted) == outcomes.count("disconnected"), (engine.aborted, outcomes)
+    assert server.stats.completed == outcomes.count("completed"), (server.stats, outcomes)
+    assert server.stats.aborted == outcomes.count("disconnected"), (server.stats, outcomes)
+    return {
+        "elapsed_s": elapsed,
+        "completed": outcomes.count("completed"),
+        "disconnected": outcomes.count("disconnected"),
+        "rejected": outcomes.count("rejected"),
+        "aborted_on_engine": len(engine.aborted),
+        "max_running_on_engine": engine.max_running,
+        "avg_chunks_per_request": sum(chunk_counts) / max(len(chunk_counts), 1),
+        "tokens_per_request": max_tokens,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exercise AsyncServer against a fake engine.")
+    parser.add_argument("--num-clients", type=int, default=64)
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    parser.add_argument("--max-queued", type=int, default=32)
+    parser.add_argument("--disconnect-frac", type=float, default=0.25)
+    parser.add_argument("--max-tokens", type=int, default=100)
+    parser.add_argument("--stream-interval", type=float, default=0.02)
+    args = parser.parse_args()
+
+    results = asyncio.run(run_fake_load(args.num_clients, args.max_in_flight, args.max_queued,
+                                        args.disconnect_frac, max_tokens=args.max_tokens,
+                                        stream_interval=args.stream_interval))
+    for key, value in results.items():
+        print(f"{key:>24}: {value:.3f}" if isinstance(value, float) else f"{key:>24}: {value}")
@@ -1,20 +1,22 @@
-import uuid
 import gradio as gr
 from vllm import AsyncLLMEngine, AsyncEngineArgs, SamplingParams
+from async_serving import AsyncServer, ServerBusyError
 
 # Initialize the language model
 engine_args = AsyncEngineArgs(model="facebook/opt-125m")
 engine = AsyncLLMEngine.from_engine_args(engine_args)
 
+# Bound concurrent engine requests, abort on client disconnect, and coalesce streamed deltas
+server = AsyncServer(engine, max_in_flight=32, max_queued=128, stream_interval=0.05)
+
 async def generate_response(message, history):
     SAMPLING_PARAM = SamplingParams(max_tokens=100)
-    print("PROMPT:", message)
-    stream = await engine.add_request(uuid.uuid4().hex, message, SAMPLING_PARAM)
-    async for request_output in stream:
-        text = request_output.outputs[0].text
-        print("STREAM:", repr(text))
-        yield text
+    try:
+        async for text in server.stream_text(message, SAMPLING_PARAM):
+            yield text
+    except ServerBusyError:
+        raise gr.Error("Server is busy, please retry in a moment.")
 
 # Launch Gradio interface
 gr_interface = gr.ChatInterface(fn=generate_response)
-gr_interface.launch(share=True)
+gr_interface.queue(default_concurrency_limit=None).launch(share=True)
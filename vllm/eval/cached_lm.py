@@ -0,0 +1,302 @@
+"""
+Persistent response cache for lm_eval requests, in front of the vLLM backend.
+
+Every loglikelihood, loglikelihood_rolling and generate_until request is keyed on
+  - the model fingerprint: the checkpoint hash from utils/checkpoint_manifest.py for local
+    directories (only changed shards are rehashed, using the manifest next to the index
+    or a copy kept beside the cache), or the commit a hub model's revision resolves to
+    (`repo@revision` only when the hub can't be reached), plus the model args that change outputs
+  - the prompt tokens (context and continuation, as the backend tokenizes them)
+  - the request kind and its sampling params (generate_until kwargs)
+Answers live in one SQLite file shared by all tasks and runs. Identical requests within a
+run are sent to the backend once, and misses are computed in chunks that are committed as
+they finish, so a crashed or repeated eval only computes what is missing.
+
+    python cached_lm.py --model cached-vllm \\
+        --model_args pretrained=/path/to/model,tensor_parallel_size=4,cache_db=lm_cache.sqlite \\
+        --tasks gsm8k --num_fewshot 5 --batch_size auto
+
+Any other lm_eval arguments are passed through. `python cached_lm.py --self-check` runs the
+cache against a fake backend.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    from lm_eval.api.model import LM
+    from lm_eval.api.registry import register_model
+except ImportError:
+    # The cache and the fake backend work without lm_eval installed
+    LM = object
+    register_model = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+DEFAULT_CACHE_DB = os.path.join(os.path.expanduser("~"), ".cache", "lm_eval_responses.sqlite")
+
+# Model args that do not change any answer, so changing them keeps the cache valid
+IGNORED_MODEL_ARGS = {"gpu_memory_utilization", "batch_size", "max_batch_size", "device", "swap_space",
+                      "data_parallel_size", "enforce_eager", "cache_db", "cache_chunk_size"}
+
+
+class ResponseCache:
+    def __init__(self, path: str = DEFAULT_CACHE_DB):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses "
+                        "(key TEXT PRIMARY KEY, kind TEXT, fingerprint TEXT, value TEXT, created REAL)")
+        self.db.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, object]:
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        # Stay below SQLite's limit on bound parameters
+        for start in range(0, len(unique), 900):
+            batch = unique[start:start + 900]
+            rows = self.db.execute(f"SELECT key, value FROM responses WHERE key IN ({','.join('?' * len(batch))})",
+                                   batch)
+            found.update((key, json.loads(value)) for key, value in rows)
+        return found
+
+    def put_many(self, kind: str, fingerprint: str, items: Dict[str, object]):
+        now = time.time()
+        self.db.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                            [(key, kind, fingerprint, json.dumps(value), now) for key, value in items.items()])
+        self.db.commit()
+
+    def count(self, fingerprint: Optional[str] = None) -> int:
+        if fingerprint is None:
+            return self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return self.db.execute("SELECT COUNT(*) FROM responses WHERE fingerprint = ?", (fingerprint,)).fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+def hub_commit(pretrained: str, revision: Optional[str] = None) -> Optional[str]:
+    """Commit sha `revision` of a hub model currently points at, None when offline."""
+    try:
+        from huggingface_hub import HfApi
+        from huggingface_hub.utils import HfHubHTTPError
+    except ImportError:
+        return None
+    try:
+        return HfApi().model_info(pretrained, revision=revision).sha
+    except HfHubHTTPError:
+        # The hub answered: unknown repo or revision, or no access
+        raise
+    except Exception:
+        return None
+
+
+def model_fingerprint(pretrained: str, model_args: Dict[str, object], revision: Optional[str] = None,
+                      manifest_dir: Optional[str] = None) -> str:
+    """Identity of the weights plus every model arg that can change an answer."""
+    if os.path.isdir(pretrained):
+        from utils.checkpoint_manifest import build_manifest, load_manifest
+
+        # Reuse the manifest next to the index, or our own copy of it, so only changed shards are rehashed
+        own_copy = None
+        if manifest_dir is not None:
+            own_copy = os.path.join(manifest_dir, hashlib.sha256(os.path.abspath(pretrained).encode()).hexdigest() + ".json")
+        stored = load_manifest(pretrained) or (load_manifest(own_copy) if own_copy else None)
+        manifest = build_manifest(pretrained, previous=stored)
+        if own_copy is not None:
+            os.makedirs(manifest_dir, exist_ok=True)
+            with open(own_copy, "w") as f:
+                json.dump(manifest, f)
+        weights = manifest["checkpoint_hash"]
+        with open(os.path.join(pretrained, "config.json"), "rb") as f:
+            weights += hashlib.sha256(f.read()).hexdigest()
+    else:
+        # A branch or tag moves when new weights are pushed, the commit it points at doesn't
+        weights = hub_commit(pretrained, revision)
+        if weights is None:
+            weights = f"{pretrained}@{revision or 'main'}"
+            print(f"[cached_lm] warning: could not resolve {weights} on the hub, keying the cache on the "
+                  f"revision name; answers cached for older weights of this revision may be reused")
+    relevant = {k: v for k, v in sorted(model_args.items())
+                if k not in IGNORED_MODEL_ARGS and k not in ("pretrained", "revision")}
+    return hashlib.sha256(json.dumps([weights, relevant], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _request_key(fingerprint: str, kind: str, payload) -> str:
+    return hashlib.sha256(json.dumps([fingerprint, kind, payload], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _to_tuple(value):
+    # JSON turns (logprob, is_greedy) into a list
+    return tuple(value) if isinstance(value, list) else value
+
+
+class CachedLM(LM):
+    """
+    Wraps an lm_eval LM: requests already answered for this fingerprint come from the
+    cache, the rest go to the backend once per distinct key.
+    """
+
+    def __init__(self, backend, fingerprint: str, cache_db: str = DEFAULT_CACHE_DB, chunk_size: int = 1024,
+                 verbose: bool = True):
+        if LM is not object:
+            super().__init__()
+        self.backend = backend
+        self.fingerprint = fingerprint
+        self.cache = ResponseCache(cache_db)
+        self.chunk_size = chunk_size
+        self.verbose = verbose
+        self.stats = {"requests": 0, "hits": 0, "duplicates": 0, "computed": 0}
+
+    def _tokens(self, text: str):
+        encode = getattr(self.backend, "tok_encode", None)
+        return encode(text) if encode is not None else text
+
+    def _run(self, kind: str, requests, payload: Callable, compute: Callable) -> List:
+        keys = [_request_key(self.fingerprint, kind, payload(req.args)) for req in requests]
+        results = self.cache.get_many(keys)
+        hits = sum(key in results for key in keys)
+
+        # One backend request per missing key, however often it occurs in this run
+        missing = {}
+        for key, req in zip(keys, requests):
+            if key not in results and key not in missing:
+                missing[key] = req
+        todo = list(missing.items())
+        for start in range(0, len(todo), self.chunk_size):
+            chunk = todo[start:start + self.chunk_size]
+            answers = compute([req for _, req in chunk])
+            computed = {key: answer for (key, _), answer in zip(chunk, answers)}
+            self.cache.put_many(kind, self.fingerprint, computed)
+            results.update(computed)
+
+        self.stats["requests"] += len(requests)
+        self.stats["hits"] += hits
+        self.stats["computed"] += len(todo)
+        self.stats["duplicates"] += len(requests) - hits - len(todo)
+        if self.verbose:
+            print(f"[cached_lm] {kind}: {len(requests)} requests, {hits} cached, "
+                  f"{len(requests) - hits - len(todo)} duplicates, {len(todo)} computed", file=sys.stderr)
+        return [_to_tuple(results[key]) for key in keys]
+
+    def loglikelihood(self, requests, *args, **kwargs) -> List[Tuple[float, bool]]:
+        return self._run("loglikelihood", requests,
+                         lambda a: [self._tokens(a[0]), self._tokens(a[1])],
+                         lambda reqs: self.backend.loglikelihood(reqs, *args, **kwargs))
+
+    def loglikelihood_rolling(self, requests, *args, **kwargs) -> List[float]:
+        return self._run("loglikelihood_rolling", requests,
+                         lambda a: [self._tokens(a[0])],
+                         lambda reqs: self.backend.loglikelihood_rolling(reqs, *args, **kwargs))
+
+    def generate_until(self, requests, *args, **kwargs) -> List[str]:
+        return self._run("generate_until", requests,
+                         lambda a: [self._tokens(a[0]), a[1]],
+                         lambda reqs: self.backend.generate_until(reqs, *args, **kwargs))
+
+    # Chat templating is part of the prompt text, so it is simply delegated
+
+    @property
+    def tokenizer_name(self) -> str:
+        return self.backend.tokenizer_name
+
+    def chat_template(self, *args, **kwargs):
+        return self.backend.chat_template(*args, **kwargs)
+
+    def apply_chat_template(self, *args, **kwargs):
+        return self.backend.apply_chat_template(*args, **kwargs)
+
+
+class CachedVLLM(CachedLM):
+    """`--model cached-vllm`: lm_eval's vLLM backend behind the cache; takes the same model_args plus cache_db."""
+
+    @classmethod
+    def create_from_arg_string(cls, arg_string: str, additional_config: Optional[dict] = None):
+        from lm_eval.models.vllm_causallms import VLLM
+        from lm_eval.utils import simple_parse_args_string
+
+        args = simple_parse_args_string(arg_string)
+        cache_db = args.pop("cache_db", DEFAULT_CACHE_DB)
+        chunk_size = int(args.pop("cache_chunk_size", 1024))
+        extra = {k: v for k, v in (additional_config or {}).items() if v is not None}
+        fingerprint = model_fingerprint(args["pretrained"], args, args.get("revision"),
+                                        manifest_dir=os.path.splitext(cache_db)[0] + "_manifests")
+        return cls(VLLM(**args, **extra), fingerprint, cache_db=cache_db, chunk_size=chunk_size)
+
+
+if register_model is not None:
+    register_model("cached-vllm")(CachedVLLM)
+
+
+class FakeRequest:
+    def __init__(self, *args):
+        self.args = args
+
+
+class FakeBackend:
+    """Deterministic stand-in for an lm_eval LM that records what it was asked."""
+
+    def __init__(self):
+        self.calls = {"loglikelihood": 0, "loglikelihood_rolling": 0, "generate_until": 0}
+        self.tokenizer_name = "fake"
+
+    def tok_encode(self, text: str) -> List[int]:
+        return [ord(c) for c in text]
+
+    def loglikelihood(self, requests):
+        self.calls["loglikelihood"] += len(requests)
+        return [(-float(len(r.args[0]) + len(r.args[1])), len(r.args[1]) < 3) for r in requests]
+
+    def loglikelihood_rolling(self, requests):
+        self.calls["loglikelihood_rolling"] += len(requests)
+        return [-float(len(r.args[0])) for r in requests]
+
+    def generate_until(self, requests):
+        self.calls["generate_until"] += len(requests)
+        return [f"{r.args[0][::-1]}|{r.args[1].get('max_gen_toks')}" for r in requests]
+
+
+def run_self_check():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, "cache.sqlite")
+        ll = [FakeRequest(f"question {i % 5}", " yes" if i % 2 else " no") for i in range(20)]
+        gen = [FakeRequest(f"prompt {i % 3}", {"until": ["\n"], "max_gen_toks": 16 * (1 + i % 2)}) for i in range(12)]
+
+        backend = FakeBackend()
+        lm = CachedLM(backend, "model-a", cache_db=db, chunk_size=4, verbose=False)
+        first_ll, first_gen = lm.loglikelihood(ll), lm.generate_until(gen)
+        assert first_ll == FakeBackend().loglikelihood(ll) and first_gen == FakeBackend().generate_until(gen)
+        assert backend.calls["loglikelihood"] == 10 and backend.calls["generate_until"] == 6, backend.calls
+        print(f"first run:  {lm.stats}")
+
+        # Same model again, with a few new prompts: only those reach the backend
+        backend = FakeBackend()
+        lm = CachedLM(backend, "model-a", cache_db=db, verbose=False)
+        assert lm.loglikelihood(ll + [FakeRequest("new", " yes")]) == first_ll + [(-7.0, False)]
+        assert lm.generate_until(gen) == first_gen
+        assert backend.calls == {"loglikelihood": 1, "loglikelihood_rolling": 0, "generate_until": 0}, backend.calls
+        print(f"second run: {lm.stats}")
+
+        # A different fingerprint never sees another model's answers
+        backend = FakeBackend()
+        lm = CachedLM(backend, "model-b", cache_db=db, verbose=False)
+        lm.loglikelihood(ll)
+        assert backend.calls["loglikelihood"] == 10
+        print(f"other model: {lm.stats}, {lm.cache.count()} cached responses in total")
+    print("Self-check passed")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--self-check"]:
+        run_self_check()
+    else:
+        from lm_eval.__main__ import cli_evaluate
+
+        cli_evaluate()
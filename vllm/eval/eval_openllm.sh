@@ -5,6 +5,9 @@
 
 export MODEL_DIR=${1}
 export MODEL_ARGS=${2}
+# Answers are cached per model fingerprint, so reruns only compute missing requests
+export CACHE_DB=${CACHE_DB:-"$HOME/.cache/lm_eval_responses.sqlite"}
+SCRIPT_DIR=$(dirname "$0")
 
 declare -A tasks_fewshot=(
     ["arc_challenge"]=25
@@ -17,8 +20,8 @@ declare -A tasks_fewshot=(
 
 for TASK in "${!tasks_fewshot[@]}"; do
     NUM_FEWSHOT=${tasks_fewshot[$TASK]}
-    lm_eval --model vllm \
-        --model_args pretrained=$MODEL_DIR,$MODEL_ARGS \
+    python "$SCRIPT_DIR/cached_lm.py" --model cached-vllm \
+        --model_args pretrained=$MODEL_DIR,$MODEL_ARGS,cache_db=$CACHE_DB \
         --tasks ${TASK} \
         --num_fewshot ${NUM_FEWSHOT} \
         --write_out \